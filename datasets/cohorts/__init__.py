@@ -1,5 +1,9 @@
 import os 
 from ..database import Database
+from ..util import (
+    get_shard_predicate, get_sample_predicate, get_sample_persons_predicate,
+    get_table_options_str, get_time_partitioning, get_row_id
+)
 
 class Cohort:
     
@@ -25,11 +29,111 @@ class Cohort:
         """
         raise NotImplementedError
 
+    def get_insert_query(self):
+        """
+        Constructs a query that inserts into an existing table
+        """
+        raise NotImplementedError
+
+    def get_person_filters(self, person_id_field="person_id", person_table=None):
+        """
+        A list of SQL predicates that restrict the persons included in the cohort.
+        person_table is the table that `sample_persons` persons are drawn from.
+        """
+        filters = []
+        if self.config["sample_fraction"] is not None:
+            filters.append(
+                get_sample_predicate(
+                    self.config["sample_fraction"],
+                    person_id_field,
+                    self.config["sample_seed"],
+                )
+            )
+        if self.config["sample_persons"] is not None:
+            filters.append(
+                get_sample_persons_predicate(
+                    self.config["sample_persons"],
+                    person_table,
+                    person_id_field,
+                    self.config["sample_seed"],
+                )
+            )
+        if self.config.get("shard_id") is not None:
+            filters.append(
+                get_shard_predicate(
+                    self.config["num_shards"], self.config["shard_id"], person_id_field
+                )
+            )
+        return filters
+
     def create_cohort_table(self):
         """
-        Creates the cohort table in the database
+        Creates the cohort table in the database.
+        If `num_shards` is set, the cohort is created one shard of persons at a time.
+        The first shard creates the table and, once it is done, the remaining shards 
+        are inserted using up to `shard_workers` concurrent jobs.
         """
-        self.db.execute_sql(self.get_create_query())
+        num_shards = self.config["num_shards"]
+        if num_shards is None or num_shards <= 1:
+            self.db.execute_sql(self.get_create_query())
+            return
+
+        queries = []
+        for shard_id in range(num_shards):
+            self.configure(shard_id=shard_id)
+            queries.append(
+                self.get_create_query() if shard_id == 0 else self.get_insert_query()
+            )
+        self.configure(shard_id=None)
+
+        self.db.execute_sql(queries[0])
+        self.db.execute_sql_parallel(
+            queries[1:], max_workers=self.config["shard_workers"]
+        )
+            
+    @classmethod
+    def from_dataframe(cls, df, chunk_size=1000000, **kwargs):
+        """
+        Creates a cohort from a local pandas DataFrame or pyarrow Table, see load_dataframe
+        """
+        cohort = cls(**kwargs)
+        cohort.load_dataframe(df, chunk_size=chunk_size)
+        return cohort
+
+    def load_dataframe(self, df, chunk_size=1000000):
+        """
+        Uploads a local cohort, e.g. the result of rollup_admissions, to the cohort table 
+        with a single load job partitioned and clustered by `partition_by` and `cluster_by`.
+        If the cohort has no `row_id` column, it is computed in the database afterwards.
+        """
+        destination = "{rs_dataset_project}.{rs_dataset}.{cohort_name}".format_map(self.config)
+        self.db.load_dataframe(
+            df,
+            destination,
+            time_partitioning=get_time_partitioning(self.config["partition_by"]),
+            cluster_by=self.config["cluster_by"],
+            chunk_size=chunk_size,
+        )
+
+        columns = df.column_names if hasattr(df, "column_names") else df.columns
+        if self.config["row_id"] not in columns:
+            self.db.execute_sql(self.get_assign_row_id_query())
+
+    def get_assign_row_id_query(self, format_query=True):
+        """
+        Constructs a query that adds `row_id` to the cohort table
+        """
+        query = """
+            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{cohort_name}
+            {table_options_str}
+            AS
+            SELECT *, {row_id_str} AS {row_id}
+            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
+        """
+        if not format_query:
+            return query
+        else:
+            return query.format_map({**self.config, **{"row_id_str": get_row_id()}})
             
     def get_defaults(self):
         return {
@@ -42,8 +146,17 @@ class Cohort:
             "dataset": "starr_omop_cdm5_deid_20210723",
             "rs_dataset": "temp_dataset",
             "cohort_name": "temp_cohort",
+            "row_id": "prediction_id",
             "limit": None,
             "min_stay_hour": None,
+            "sample_fraction": None,
+            "sample_persons": None,
+            "sample_seed": 0,
+            "num_shards": None,
+            "shard_workers": 1,
+            "shard_id": None,
+            "partition_by": "DATETIME_TRUNC(admit_date, MONTH)",
+            "cluster_by": ["person_id"],
         }
 
     def override_defaults(self, **kwargs):
@@ -72,6 +185,9 @@ class Cohort:
             )
             else ""
         )
+        config["table_options_str"] = get_table_options_str(
+            config["partition_by"], config["cluster_by"]
+        )
         config["dataset_project"] = (
             config["dataset_project"]
             if (
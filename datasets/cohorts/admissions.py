@@ -1,6 +1,7 @@
 import os
 from datasets.cohorts import Cohort 
 from datasets.database import Database
+from datasets.util import get_row_id
 
 
 class AdmissionCohort(Cohort):
@@ -24,6 +25,7 @@ class AdmissionCohort(Cohort):
                 AND visit_end_datetime > visit_start_datetime
                 AND visit_end_datetime is not NULL
                 AND visit_start_datetime is not NULL
+                {person_filter_str}
         )
         {where_str}
         {limit_str}
@@ -32,7 +34,18 @@ class AdmissionCohort(Cohort):
         if not format_query:
             return query
         else:
-            return query.format_map(self.config)
+            return query.format_map(
+                {**self.config, **{"person_filter_str": self.get_person_filter_str()}}
+            )
+
+    def get_person_filter_str(self):
+        return "".join(
+            "AND {}\n".format(x)
+            for x in self.get_person_filters(
+                "t1.person_id",
+                "{dataset_project}.{dataset}.person".format_map(self.config),
+            )
+        )
 
     def get_transform_query(self, format_query=True):
         query = """
@@ -117,6 +130,7 @@ class AdmissionCohort(Cohort):
                 ON t1.person_id=t2.person_id AND t1.row_number=t2.row_number
             )
             SELECT person_id, admit_date, discharge_date
+                ,{row_id_str} AS {row_id}
             FROM result
             ORDER BY person_id, row_number
         """
@@ -125,13 +139,32 @@ class AdmissionCohort(Cohort):
             return query
         else:
             return query.format_map(
-                {**self.config, **{"base_query": self.get_base_query()}}
+                {
+                    **self.config,
+                    **{"base_query": self.get_base_query(), "row_id_str": get_row_id()},
+                }
             )
 
     def get_create_query(self, format_query=True):
 
         query = """ 
-            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{cohort_name} AS
+            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{cohort_name}
+            {table_options_str}
+            AS
+            {query}
+        """
+
+        if not format_query:
+            return query
+        else:
+            return query.format_map(
+                {**self.config, **{"query": self.get_transform_query()}}
+            )
+
+    def get_insert_query(self, format_query=True):
+
+        query = """ 
+            INSERT INTO {rs_dataset_project}.{rs_dataset}.{cohort_name}
             {query}
         """
 
@@ -162,12 +195,22 @@ class AdmissionFilteredCohort(Cohort):
         (
             SELECT * 
             FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
+            {person_filter_str}
         )
         """
         if not format_query:
             return query
         else:
-            return query.format_map(self.config)
+            return query.format_map(
+                {**self.config, **{"person_filter_str": self.get_person_filter_str()}}
+            )
+
+    def get_person_filter_str(self):
+        filters = self.get_person_filters(
+            "person_id",
+            "{rs_dataset_project}.{rs_dataset}.{cohort_name}".format_map(self.config),
+        )
+        return "WHERE {}".format(" AND ".join(filters)) if filters else ""
 
     def get_transform_query(self, format_query=True):
         query = """ 
@@ -191,7 +234,9 @@ class AdmissionFilteredCohort(Cohort):
 
     def get_create_query(self, format_query=True):
         query = """ 
-            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{cohort_name_filtered} AS
+            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{cohort_name_filtered}
+            {table_options_str}
+            AS
             {query}
         """
         if not format_query:
@@ -200,3 +245,209 @@ class AdmissionFilteredCohort(Cohort):
             return query.format_map(
                 {**self.config, **{"query": self.get_transform_query()}}
             )
+
+    def get_insert_query(self, format_query=True):
+        query = """ 
+            INSERT INTO {rs_dataset_project}.{rs_dataset}.{cohort_name_filtered}
+            {query}
+        """
+        if not format_query:
+            return query
+        else:
+            return query.format_map(
+                {**self.config, **{"query": self.get_transform_query()}}
+            )
+
+
+class IncrementalAdmissionCohort(AdmissionCohort):
+    """
+    Refreshes an admission cohort built on a previous dataset release.
+        Admissions are recomputed only for persons whose visits changed between 
+        `previous_dataset` and `dataset`. Rows that were added, removed or changed 
+        are recorded in `{cohort_name}_changes` together with their `row_id`.
+    """
+
+    def get_defaults(self):
+        config = super().get_defaults()
+
+        config["previous_dataset_project"] = None
+        config["previous_dataset"] = None
+        config["previous_cohort_name"] = None
+        config["cohort_changes_name"] = None
+        config["changed_persons_table"] = None
+
+        return config
+
+    def get_config(self, **kwargs):
+        config = super().get_config(**kwargs)
+
+        if config["previous_dataset"] is None:
+            raise ValueError("previous_dataset must not be None")
+
+        config["previous_dataset_project"] = (
+            config["previous_dataset_project"]
+            if (
+                (config["previous_dataset_project"] is not None)
+                and (config["previous_dataset_project"] != "")
+            )
+            else config["dataset_project"]
+        )
+        config["previous_cohort_name"] = (
+            config["previous_cohort_name"]
+            if config["previous_cohort_name"] is not None
+            else config["cohort_name"]
+        )
+        config["cohort_changes_name"] = (
+            config["cohort_changes_name"]
+            if config["cohort_changes_name"] is not None
+            else "{}_changes".format(config["cohort_name"])
+        )
+        return config
+
+    def get_person_filters(self, person_id_field="person_id", person_table=None):
+        filters = super().get_person_filters(person_id_field, person_table)
+        if self.config["changed_persons_table"] is not None:
+            filters.append(
+                "{} IN (SELECT person_id FROM {})".format(
+                    person_id_field, self.config["changed_persons_table"]
+                )
+            )
+        return filters
+
+    def get_changed_persons_query(self, format_query=True):
+        """
+        Persons whose visits differ between `previous_dataset` and `dataset`.
+        Visits are compared through a fingerprint of the ordered list of visits of each person
+        """
+        query = """
+            WITH current_visits AS (
+                SELECT person_id
+                    ,FARM_FINGERPRINT(STRING_AGG(visit_key, ',' ORDER BY visit_key)) AS visit_hash
+                    ,COUNT(*) AS visit_count
+                FROM (
+                    SELECT person_id
+                        ,CONCAT(
+                            CAST(visit_concept_id AS STRING), '|',
+                            CAST(visit_start_datetime AS STRING), '|',
+                            CAST(visit_end_datetime AS STRING)
+                        ) AS visit_key
+                    FROM {base_query}
+                )
+                GROUP BY person_id
+            ),
+            previous_visits AS (
+                SELECT person_id
+                    ,FARM_FINGERPRINT(STRING_AGG(visit_key, ',' ORDER BY visit_key)) AS visit_hash
+                    ,COUNT(*) AS visit_count
+                FROM (
+                    SELECT person_id
+                        ,CONCAT(
+                            CAST(visit_concept_id AS STRING), '|',
+                            CAST(visit_start_datetime AS STRING), '|',
+                            CAST(visit_end_datetime AS STRING)
+                        ) AS visit_key
+                    FROM {previous_base_query}
+                )
+                GROUP BY person_id
+            )
+            SELECT person_id
+            FROM current_visits t1
+            FULL OUTER JOIN previous_visits t2 USING (person_id)
+            WHERE t1.visit_hash IS DISTINCT FROM t2.visit_hash
+                OR t1.visit_count IS DISTINCT FROM t2.visit_count
+        """
+        if not format_query:
+            return query
+        else:
+            previous_base_query = self.get_base_query(format_query=False).format_map(
+                {
+                    **self.config,
+                    **{
+                        "dataset_project": self.config["previous_dataset_project"],
+                        "dataset": self.config["previous_dataset"],
+                        "person_filter_str": self.get_person_filter_str(),
+                    },
+                }
+            )
+            return query.format_map(
+                {
+                    **self.config,
+                    **{
+                        "base_query": self.get_base_query(),
+                        "previous_base_query": previous_base_query,
+                    },
+                }
+            )
+
+    def get_create_query(self, format_query=True):
+        query = """
+            CREATE TEMP TABLE changed_persons
+            CLUSTER BY person_id
+            AS
+            {changed_persons_query};
+
+            CREATE TEMP TABLE changed_admissions
+            {table_options_str}
+            AS
+            {transform_query};
+
+            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{cohort_changes_name}
+            {table_options_str}
+            AS
+            WITH previous_admissions AS (
+                SELECT person_id, admit_date, discharge_date
+                    ,{row_id_str} AS {row_id}
+                FROM {rs_dataset_project}.{rs_dataset}.{previous_cohort_name}
+                WHERE person_id IN (SELECT person_id FROM changed_persons)
+            )
+            SELECT person_id, admit_date
+                ,COALESCE(t1.discharge_date, t2.discharge_date) AS discharge_date
+                ,t1.{row_id}
+                ,t2.discharge_date AS previous_discharge_date
+                ,t2.{row_id} AS previous_{row_id}
+                ,CASE
+                    WHEN t2.discharge_date IS NULL THEN 'added'
+                    WHEN t1.discharge_date IS NULL THEN 'removed'
+                    ELSE 'changed'
+                END AS change_type
+            FROM changed_admissions t1
+            FULL OUTER JOIN previous_admissions t2 USING (person_id, admit_date)
+            WHERE t1.discharge_date IS DISTINCT FROM t2.discharge_date;
+
+            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{cohort_name}
+            {table_options_str}
+            AS
+            SELECT person_id, admit_date, discharge_date
+                ,{row_id_str} AS {row_id}
+            FROM {rs_dataset_project}.{rs_dataset}.{previous_cohort_name}
+            WHERE person_id NOT IN (SELECT person_id FROM changed_persons)
+            UNION ALL
+            SELECT person_id, admit_date, discharge_date, {row_id}
+            FROM changed_admissions
+            ORDER BY person_id, admit_date;
+        """
+        if not format_query:
+            return query
+        else:
+            changed_persons_query = self.get_changed_persons_query()
+
+            self.configure(changed_persons_table="changed_persons")
+            transform_query = self.get_transform_query()
+            self.configure(changed_persons_table=None)
+
+            return query.format_map(
+                {
+                    **self.config,
+                    **{
+                        "changed_persons_query": changed_persons_query,
+                        "transform_query": transform_query,
+                        "row_id_str": get_row_id(),
+                    },
+                }
+            )
+
+    def create_cohort_table(self):
+        """
+        Refreshes the cohort table in the database and records the changed rows
+        """
+        self.db.execute_sql(self.get_create_query())
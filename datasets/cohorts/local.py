@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+
+
+def get_column(table, name):
+    """
+    Returns a column of a pandas DataFrame or pyarrow Table as a numpy array
+    """
+    if hasattr(table, "column_names"):
+        return table.column(name).to_numpy()
+    return table[name].to_numpy()
+
+
+def has_column(table, name):
+    """
+    Whether a pandas DataFrame or pyarrow Table has a column
+    """
+    if hasattr(table, "column_names"):
+        return name in table.column_names
+    return name in table.columns
+
+
+def get_sort_order(person_rank, endpoint):
+    """
+    Returns the indices that sort by (person_rank, endpoint).
+    Both are packed into a single int64 key when it fits, which sorts much faster than np.lexsort
+    """
+    # unsigned, since endpoints may be more than 2**63 nanoseconds apart
+    offset = (endpoint.view(np.int64) - endpoint.view(np.int64).min()).view(np.uint64)
+    if not (offset % 10**9).any():
+        offset = offset // 10**9
+    span = int(offset.max()) + 1
+    if (int(person_rank.max()) + 1) * span < 2**63:
+        return np.argsort(person_rank * span + offset.astype(np.int64))
+    return np.lexsort((endpoint, person_rank))
+
+
+def rollup_admissions(
+    visits,
+    person_id_field="person_id",
+    visit_start_field="visit_start_datetime",
+    visit_end_field="visit_end_datetime",
+    visit_concept_ids=(9201, 262),
+    min_stay_hour=None,
+):
+    """
+    Local equivalent of AdmissionCohort.get_transform_query.
+    Merges overlapping visits of each person into admissions.
+    Args:
+        visits: pandas DataFrame or pyarrow Table with one row per visit
+        person_id_field: name of the person identifier column
+        visit_start_field: name of the visit start column
+        visit_end_field: name of the visit end column
+        visit_concept_ids: visit concepts to keep if a visit_concept_id column is present
+        min_stay_hour: Optionally filter visits on length (in hours) prior to the rollup
+    Returns:
+        a DataFrame with columns person_id, admit_date, discharge_date
+    """
+    person_id = np.asarray(get_column(visits, person_id_field))
+    visit_start = np.asarray(
+        get_column(visits, visit_start_field), dtype="datetime64[ns]"
+    )
+    visit_end = np.asarray(get_column(visits, visit_end_field), dtype="datetime64[ns]")
+
+    keep = ~np.isnat(visit_start) & ~np.isnat(visit_end) & (visit_end > visit_start)
+    if visit_concept_ids is not None and has_column(visits, "visit_concept_id"):
+        keep &= np.isin(
+            np.asarray(get_column(visits, "visit_concept_id")), visit_concept_ids
+        )
+    if min_stay_hour is not None and min_stay_hour != "":
+        # Matches DATETIME_DIFF(visit_end_datetime, visit_start_datetime, hour)
+        stay_hours = (
+            visit_end.astype("datetime64[h]") - visit_start.astype("datetime64[h]")
+        ).astype(np.int64)
+        keep &= stay_hours > int(min_stay_hour)
+
+    num_visits = int(keep.sum())
+    if num_visits == 0:
+        return pd.DataFrame(
+            {
+                "person_id": person_id[:0],
+                "admit_date": visit_start[:0],
+                "discharge_date": visit_end[:0],
+            }
+        )
+
+    # Melt visits into endpoints: +1 at each admit and -1 at each discharge
+    person_ids, person_rank = np.unique(person_id[keep], return_inverse=True)
+    person = np.concatenate([person_rank, person_rank]).astype(np.int64)
+    endpoint = np.concatenate([visit_start[keep], visit_end[keep]])
+    endpoint_type = np.concatenate(
+        [np.ones(num_visits, dtype=np.int64), -np.ones(num_visits, dtype=np.int64)]
+    )
+
+    order = get_sort_order(person, endpoint)
+    person, endpoint, endpoint_type = (
+        person[order],
+        endpoint[order],
+        endpoint_type[order],
+    )
+
+    # Collapse endpoints shared within a person
+    is_first = np.ones(len(person), dtype=bool)
+    is_first[1:] = (person[1:] != person[:-1]) | (endpoint[1:] != endpoint[:-1])
+    first_idx = np.flatnonzero(is_first)
+    person, endpoint = person[first_idx], endpoint[first_idx]
+
+    # The endpoint types of each person sum to zero, so a global cumulative
+    # sum equals the per-person cumulative sum
+    count = np.cumsum(np.add.reduceat(endpoint_type, first_idx))
+
+    is_discharge = count == 0
+    is_admit = np.empty_like(is_discharge)
+    is_admit[0] = True
+    is_admit[1:] = is_discharge[:-1]
+
+    return pd.DataFrame(
+        {
+            "person_id": person_ids[person[is_admit]],
+            "admit_date": endpoint[is_admit],
+            "discharge_date": endpoint[is_discharge],
+        }
+    )
+
+
+def sample_admissions(
+    admissions,
+    person_id_field="person_id",
+    window_start_field="admit_date",
+    window_end_field="discharge_date",
+    seed=0,
+):
+    """
+    Local equivalent of AdmissionFilteredCohort.get_transform_query.
+    Samples one admission per person using a hash of the admission.
+    Note that the sampled admissions differ from those selected by FARM_FINGERPRINT in BigQuery.
+    Args:
+        admissions: pandas DataFrame or pyarrow Table, e.g. the result of rollup_admissions
+        seed: changes the sampled admissions
+    """
+    if hasattr(admissions, "to_pandas"):
+        admissions = admissions.to_pandas()
+
+    if len(admissions) == 0:
+        return admissions.reset_index(drop=True)
+
+    person = admissions[person_id_field].to_numpy()
+    # the seed is hashed with the admission, such that each seed gives an independent sample
+    rnd = pd.util.hash_array(
+        pd.util.hash_pandas_object(
+            admissions[[person_id_field, window_start_field, window_end_field]],
+            index=False,
+        ).to_numpy()
+        ^ pd.util.hash_array(np.array([seed], dtype=np.uint64))
+    )
+
+    order = np.lexsort((rnd, person))
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = person[order][1:] != person[order][:-1]
+
+    return (
+        admissions.iloc[order[is_first]]
+        .sort_values([person_id_field, window_start_field])
+        .reset_index(drop=True)
+    )
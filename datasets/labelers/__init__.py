@@ -1,31 +1,43 @@
+import copy
 import os 
 import random  
 import string  
+import zlib
+
+import pandas as pd
+
+from google.api_core.exceptions import NotFound
 
 from ..database import Database
-from ..util import bq_extract_flowsheets_from_observations
+from ..util import (
+    bq_extract_flowsheets_from_observations, get_shard_predicate, get_row_id,
+    get_horizon_ends, get_table_options_str, get_sample_predicate, get_wilson_interval
+)
 
 from .demographics import (
-    AgeQuery, SexQuery, RaceQuery
+    DemographicsQuery, FusedDemographicsQuery, AgeQuery, SexQuery, RaceQuery, 
+    EthnicityQuery
 )
 
 from .operational import (
-    MortalityQuery, LOS7Query, Readmission30Query,
+    MortalityQuery, LOS7Query, ReadmissionQuery,
     ICUAdmissionQuery
 )
 
 from .lab_based import (
-    HyperkalemiaQuery, HypoglycemiaQuery, NeutropeniaQuery,
+    ThresholdLabQuery, HyperkalemiaQuery, HypoglycemiaQuery, NeutropeniaQuery,
     HyponatremiaQuery, AcuteKidneyInjuryQuery, AnemiaQuery, 
     ThrombocytopeniaQuery
 )
 
 from .dx_based import (
-    HypoglycemiaDxQuery, AKIDxQuery, AnemiaDxQuery, 
+    DxLabelQuery, FusedDxLabelQuery, HypoglycemiaDxQuery, AKIDxQuery, AnemiaDxQuery, 
     HyperkalemiaDxQuery, HyponatremiaDxQuery, ThrombocytopeniaDxQuery,
     NeutropeniaDxQuery
 )
 
+from .analysis import get_input_tables, hoist_shared_ctes
+
     
 class Labeler:
     def __init__(self, *args, **kwargs):
@@ -47,6 +59,7 @@ class Labeler:
             "cohort_name": "temp_cohort",
             'target_table_name':'temp_cohort_labeled',
             'row_id':'prediction_id',
+            'assign_row_id':False,
             'window_start_field':'admit_date',
             'window_end_field':'discharge_date',
             'temp_dataset': "temp",
@@ -54,6 +67,21 @@ class Labeler:
             'flowsheets_extract_name':None,
             'overwrite_flowsheets_extract':False,
             'flowsheet_concept_id':'2000006253',
+            'num_shards':None,
+            'shard_workers':1,
+            'prune_measurements':True,
+            'fuse_dx_labelers':False,
+            'fuse_demographics_labelers':False,
+            'window_horizons':None,
+            'readmission_horizons':None,
+            'partition_by':None,
+            'cluster_by':None,
+            'session_temp_tables':False,
+            'temp_table_expiration_hours':24,
+            'label_store_name':None,
+            'label_store_partitions':4000,
+            'share_ctes':False,
+            'preview_maximum_bytes_billed':10**11,
         }
     
     def override_default_config(self, **kwargs):
@@ -81,6 +109,12 @@ class Labeler:
             else config["gcloud_project"]
         )
         
+        # partition by the window start and cluster by the row id unless overridden
+        if config["partition_by"] is None:
+            config["partition_by"] = f"DATETIME_TRUNC({config['window_start_field']}, MONTH)"
+        if config["cluster_by"] is None:
+            config["cluster_by"] = [config["row_id"]]
+        
         return config
     
     def check_config(self):
@@ -98,10 +132,11 @@ class Labeler:
             AgeQuery(),
             SexQuery(),
             RaceQuery(),
+            EthnicityQuery(),
             MortalityQuery(),
             LOS7Query(),
             ICUAdmissionQuery(),
-            #Readmission30Query(), # not properly implemented
+            ReadmissionQuery(),
             HyperkalemiaQuery(),
             HypoglycemiaQuery(),
             NeutropeniaQuery(),
@@ -144,9 +179,11 @@ class Labeler:
             for x in queries
         }
     
-    def get_label_query(self, labeler_ids:list=None, exclude_labeler_ids:list=None):
-        """Build label query"""
-        
+    def get_selected_queries(self, labeler_ids:list=None, exclude_labeler_ids:list=None):
+        """
+        Returns the dictionary of queries of `labeler_ids` (all labelers by default) 
+        without `exclude_labeler_ids`
+        """
         if labeler_ids is None:
             labeler_ids = self.queries.keys()
             
@@ -157,13 +194,124 @@ class Labeler:
             if labeler_id not in self.queries.keys():
                 raise ValueError(f"Provided labeler_id {labeler_id} not defined")
                 
-        queries = {k:self.queries[k] for k in labeler_ids}
+        return {k:self.queries[k] for k in labeler_ids}
+    
+    def get_input_tables(self, labeler_ids:list=None, exclude_labeler_ids:list=None):
+        """
+        Returns a dictionary mapping labeler ids to the tables read by their formatted queries
+        """
+        cohort_table = self.get_cohort_table()
+        input_tables = {}
+        for labeler_id, query in self.get_selected_queries(labeler_ids, exclude_labeler_ids).items():
+            query = self.get_configured_query(query)
+            input_tables[labeler_id] = get_input_tables(
+                self.format_query(query, query.base_query, cohort_table)
+            )
+        return input_tables
+    
+    def get_cohort_table(
+        self, 
+        shard_id:int=None, 
+        cohort_name:str=None, 
+        sample_fraction:float=None, 
+        sample_seed:int=0,
+    ):
+        """
+        Reference to the cohort that labelers read from, `cohort_name` by default. 
+        Restricted to the persons of a single shard if shard_id is provided and to a 
+        deterministic sample of a fraction of the persons if sample_fraction is provided.
+        Computes `row_id` if `assign_row_id` is set, for cohorts that do not provide one.
+        """
+        cohort_table = "{rs_dataset_project}.{rs_dataset}.{cohort_name}".format_map({
+            **self.config, 
+            'cohort_name':cohort_name if cohort_name is not None else self.config['cohort_name'],
+        })
+        
+        filters = []
+        if shard_id is not None:
+            filters.append(get_shard_predicate(self.config['num_shards'], shard_id))
+        if sample_fraction is not None:
+            filters.append(get_sample_predicate(sample_fraction, 'person_id', sample_seed))
+        
+        if not filters and not self.config['assign_row_id']:
+            return cohort_table
+        
+        row_id_str = ""
+        if self.config['assign_row_id']:
+            row_id_str = ", {} AS {}".format(
+                get_row_id(
+                    'person_id', 
+                    self.config['window_start_field'], 
+                    self.config['window_end_field']
+                ),
+                self.config['row_id'],
+            )
+            
+        where_str = "WHERE {}".format(" AND ".join(filters)) if filters else ""
+        
+        return f"""(
+            SELECT *{row_id_str}
+            FROM {cohort_table} 
+            {where_str}
+        )"""
+    
+    def get_label_query(
+        self, 
+        labeler_ids:list=None, 
+        exclude_labeler_ids:list=None, 
+        shard_id:int=None,
+        cohort_table:str=None,
+        target_table:str=None,
+        temp_target:bool=False,
+        extract_flowsheets:bool=True,
+        declare_window:bool=True,
+    ):
+        """
+        Build label query.
+        If shard_id is provided, only persons in that shard are labeled. Shard 0 creates 
+        the target table and the remaining shards insert into it.
+        cohort_table and target_table optionally override the cohort reference returned by 
+        get_cohort_table and the full name of the target table.
+        If temp_target, the target table is an intermediate table, see get_temp_table.
+        If not extract_flowsheets, an existing flowsheets extract is read but not created.
+        If not declare_window, the window variables are only set, as they are declared by 
+        an earlier script of the session, see get_window_declarations.
+        """
+        
+        queries = self.get_selected_queries(labeler_ids, exclude_labeler_ids)
+        
+        if self.config['fuse_dx_labelers']:
+            dx_queries = [
+                query for query in queries.values() if isinstance(query, DxLabelQuery)
+            ]
+            if len(dx_queries) > 1:
+                queries = {
+                    k:query for k,query in queries.items() 
+                    if not isinstance(query, DxLabelQuery)
+                }
+                fused_query = FusedDxLabelQuery(dx_queries)
+                queries[fused_query.config['labeler_id']] = fused_query
+        
+        if self.config['fuse_demographics_labelers']:
+            demographics_queries = [
+                query for query in queries.values() if isinstance(query, DemographicsQuery)
+            ]
+            if len(demographics_queries) > 1:
+                fused_query = FusedDemographicsQuery(demographics_queries)
+                fused_queries = {}
+                for k,query in queries.items():
+                    if not isinstance(query, DemographicsQuery):
+                        fused_queries[k] = query
+                    else:
+                        # keep the column order of the individual queries
+                        fused_queries[fused_query.config['labeler_id']] = fused_query
+                queries = fused_queries
         
         q_main = ""
         q_join = ""
         q_cleanup = ""
         
-        if self.config['extract_labs_from_flowsheets']:
+        if self.config['extract_labs_from_flowsheets'] and extract_flowsheets and not shard_id:
             q_main+=bq_extract_flowsheets_from_observations(
                 bq_project = self.config['dataset_project'],
                 bq_dataset = self.config['dataset'],
@@ -176,54 +324,1067 @@ class Labeler:
         
         rs_dataset_project = self.config['rs_dataset_project']
         rs_dataset = self.config['rs_dataset']
-        temp_dataset = self.config['temp_dataset']
-        window_start_field = self.config['window_start_field']
-        window_end_field = self.config['window_end_field']
-        target_table_name = self.config['target_table_name']
-        cohort_name = self.config['cohort_name']
+        row_id = self.config['row_id']
+        if cohort_table is None:
+            cohort_table = self.get_cohort_table(shard_id)
+        if target_table is None:
+            target_table = f"{rs_dataset_project}.{rs_dataset}.{self.config['target_table_name']}"
         
         rnd_suffix = ''.join((random.choice(string.ascii_lowercase) for x in range(5)))
         
-        # create temp label table for each task
+        # DECLARE must come first in the script
+        q_window = self.get_window_assignments(cohort_table)
+        if declare_window:
+            q_window = self.get_window_declarations() + q_window
+        q_main = q_window + q_main
+
+        formatted_queries = {}
         for labeler_id, query in queries.items():
+            query = self.get_configured_query(query)
+            formatted_queries[labeler_id] = self.format_query(query, query.base_query, cohort_table)
+        
+        # compute the CTEs shared by several labelers once
+        if self.config['share_ctes']:
+            stages, formatted_queries = hoist_shared_ctes(
+                formatted_queries,
+                lambda fingerprint: self.get_temp_table(f"temp_stage_{fingerprint}_{rnd_suffix}"),
+            )
+            for stage_table, stage_query in stages:
+                q_main += f"""
+            {self.get_create_temp_table_str(stage_table)}
+            AS {stage_query};
+            """
+                q_cleanup += self.get_drop_temp_table_str(stage_table)
+        
+        # create temp label table for each task
+        for labeler_id, i_q in formatted_queries.items():
             
-            if self.config['extract_labs_from_flowsheets']:
-                query.config = {**query.config, **self.config}
-                query.base_query = query.get_base_query()
-                
-            i_q = query.base_query.format_map({**self.config, **query.config})
+            temp_table = self.get_temp_table(f"temp_{labeler_id}_{rnd_suffix}")
             
             q_main += f"""
-            CREATE OR REPLACE TABLE {rs_dataset_project}.{temp_dataset}.temp_{labeler_id}_{rnd_suffix}
+            {self.get_create_temp_table_str(temp_table, f"CLUSTER BY {row_id}")}
             AS {i_q};
             """
             
             q_join += f"""
-            LEFT JOIN {rs_dataset_project}.{temp_dataset}.temp_{labeler_id}_{rnd_suffix} USING (person_id, {window_start_field}, {window_end_field})
+            LEFT JOIN {temp_table} USING ({row_id})
             """
             
-            q_cleanup += f"""
-            DROP TABLE {rs_dataset_project}.{temp_dataset}.temp_{labeler_id}_{rnd_suffix};
-            """
+            q_cleanup += self.get_drop_temp_table_str(temp_table)
         
         # join w/ cohort 
-        q_main += f"""
-        CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{target_table_name} AS
-        (
+        if not shard_id:
+            if temp_target:
+                q_create = self.get_create_temp_table_str(
+                    target_table, self.get_table_options_str()
+                )
+            else:
+                q_create = f"CREATE OR REPLACE TABLE {target_table}\n            {self.get_table_options_str()}"
+            
+            q_main += f"""
+            {q_create}
+            AS
+            (
+                SELECT * 
+                FROM {cohort_table} 
+                {q_join}
+            );
+            """
+        else:
+            q_main += f"""
+            INSERT INTO {target_table}
             SELECT * 
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} 
-            {q_join}
-        );
+            FROM {cohort_table} 
+            {q_join};
+            """
         
-        {q_cleanup}
-        """
+        q_main += q_cleanup
         
         return q_main
             
         
+    def get_multi_cohort_label_queries(
+        self, 
+        cohort_names:list, 
+        target_table_names:list=None,
+        labeler_ids:list=None, 
+        exclude_labeler_ids:list=None,
+    ):
+        """
+        Build the queries labeling several cohorts in one run, executed in order:
+            1. union of the distinct rows of the cohorts, keyed by `row_id`
+            2. labels of the union, so that shared persons and scans are paid for once
+            3. labels of each cohort for the labelers that use the other cohort rows of 
+               the person (e.g. readmission), which differ between cohorts
+            4. one target table per cohort, joining each cohort to its labels
+        Target tables default to `{cohort_name}_labeled`.
+        """
+        if target_table_names is None:
+            target_table_names = [f"{x}_labeled" for x in cohort_names]
+            
+        if len(target_table_names) != len(cohort_names):
+            raise ValueError("Provide one target table name per cohort")
+        
+        rs_dataset_project = self.config['rs_dataset_project']
+        rs_dataset = self.config['rs_dataset']
+        row_id = self.config['row_id']
+        
+        queries = self.get_selected_queries(labeler_ids, exclude_labeler_ids)
+        context_labeler_ids = [k for k, query in queries.items() if query.uses_cohort_context]
+        shared_labeler_ids = [k for k in queries if k not in context_labeler_ids]
+        
+        rnd_suffix = ''.join((random.choice(string.ascii_lowercase) for x in range(5)))
+        union_table = self.get_temp_table(f"temp_cohort_union_{rnd_suffix}")
+        union_labeled_table = self.get_temp_table(f"temp_cohort_union_labeled_{rnd_suffix}")
+        
+        # keep the cohort fields used by the labelers, including named horizon end fields
+        key_fields = ['person_id', self.config['window_start_field'], self.config['window_end_field']]
+        for horizon in (self.config['window_horizons'] or {}).values():
+            if isinstance(horizon, str) and horizon not in key_fields:
+                key_fields.append(horizon)
+        key_fields_str = ", ".join(key_fields + [row_id])
+        
+        cohort_tables = [
+            f"""(
+                SELECT DISTINCT {key_fields_str}
+                FROM {self.get_cohort_table(cohort_name=cohort_name)}
+            )"""
+            for cohort_name in cohort_names
+        ]
+        
+        q_union = "\n            \n            UNION DISTINCT\n".join(
+            f"""
+            SELECT *
+            FROM {cohort_table}"""
+            for cohort_table in cohort_tables
+        )
+        
+        # variables cannot be redeclared within a session
+        declare_window = not self.config['session_temp_tables']
+        
+        result = []
+        labeled_tables = [[] for _ in cohort_names]
+        q_cleanup = ""
+        if shared_labeler_ids:
+            result.append(f"""
+            {self.get_create_temp_table_str(union_table, self.get_table_options_str())}
+            AS {q_union};
+            """)
+            result.append(self.get_label_query(
+                shared_labeler_ids, 
+                cohort_table=union_table, 
+                target_table=union_labeled_table,
+                temp_target=True,
+                declare_window=declare_window,
+            ))
+            for tables in labeled_tables:
+                tables.append(union_labeled_table)
+            q_cleanup += self.get_drop_temp_table_str(union_table)
+            q_cleanup += self.get_drop_temp_table_str(union_labeled_table)
+        
+        if context_labeler_ids:
+            for i, cohort_table in enumerate(cohort_tables):
+                context_labeled_table = self.get_temp_table(
+                    f"temp_cohort_{i}_context_labeled_{rnd_suffix}"
+                )
+                result.append(self.get_label_query(
+                    context_labeler_ids,
+                    cohort_table=cohort_table, 
+                    target_table=context_labeled_table,
+                    temp_target=True,
+                    extract_flowsheets=not shared_labeler_ids,
+                    declare_window=declare_window,
+                ))
+                labeled_tables[i].append(context_labeled_table)
+                q_cleanup += self.get_drop_temp_table_str(context_labeled_table)
+        
+        split_query = ""
+        for cohort_name, target_table_name, tables in zip(
+            cohort_names, target_table_names, labeled_tables
+        ):
+            q_join = "".join(
+                f"""
+                LEFT JOIN (
+                    SELECT * EXCEPT ({", ".join(key_fields)}) 
+                    FROM {labeled_table}
+                ) USING ({row_id})"""
+                for labeled_table in tables
+            )
+            split_query += f"""
+            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{target_table_name}
+            {self.get_table_options_str()}
+            AS
+            (
+                SELECT * 
+                FROM {self.get_cohort_table(cohort_name=cohort_name)} {q_join}
+            );
+            """
+        result.append(split_query + q_cleanup)
+        
+        if not declare_window:
+            result[0] = self.get_window_declarations() + result[0]
+        
+        return result
+    
+    def create_multi_cohort_label_tables(
+        self, 
+        cohort_names:list, 
+        target_table_names:list=None,
+        labeler_ids:list=None, 
+        exclude_labeler_ids:list=None,
+    ):
+        """
+        Labels several cohorts in one run, see get_multi_cohort_label_queries
+        """
+        self.execute_queries(
+            self.get_multi_cohort_label_queries(
+                cohort_names, target_table_names, labeler_ids, exclude_labeler_ids
+            )
+        )
+    
+    def get_incremental_label_queries(
+        self, 
+        labeler_ids:list=None, 
+        exclude_labeler_ids:list=None,
+        invalidate_table:str=None,
+    ):
+        """
+        Build the queries updating an existing `target_table_name` with the cohort rows it 
+        is missing, executed in order:
+            1. remove the target rows of the persons with rows added to or removed from the 
+               cohort and, if `invalidate_table` is provided, the rows of its persons 
+               (e.g. the changes table of an IncrementalAdmissionCohort), then collect the 
+               cohort rows missing from the target
+            2. labels of the missing rows only
+            3. MERGE of the new labels into the target
+        All the rows of a changed person are relabeled, since labels such as readmission 
+        depend on the other cohort rows of the person.
+        The labelers must be the same as those that created the target table.
+        """
+        rs_dataset_project = self.config['rs_dataset_project']
+        rs_dataset = self.config['rs_dataset']
+        row_id = self.config['row_id']
+        target_table = f"{rs_dataset_project}.{rs_dataset}.{self.config['target_table_name']}"
+        cohort_table = self.get_cohort_table()
+        
+        rnd_suffix = ''.join((random.choice(string.ascii_lowercase) for x in range(5)))
+        pending_table = self.get_temp_table(f"temp_cohort_pending_{rnd_suffix}")
+        pending_labeled_table = self.get_temp_table(f"temp_cohort_pending_labeled_{rnd_suffix}")
+        
+        # variables cannot be redeclared within a session
+        declare_window = not self.config['session_temp_tables']
+        
+        pending_query = ""
+        if not declare_window:
+            pending_query += self.get_window_declarations()
+        
+        if invalidate_table is not None:
+            pending_query += f"""
+            DELETE FROM {target_table}
+            WHERE person_id IN (SELECT person_id FROM {invalidate_table});
+            """
+        
+        pending_query += f"""
+            DELETE FROM {target_table}
+            WHERE person_id IN (
+                SELECT c.person_id
+                FROM {cohort_table} c
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {target_table} t WHERE t.{row_id} = c.{row_id}
+                )
+                
+                UNION DISTINCT
+                
+                SELECT t.person_id
+                FROM {target_table} t
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM {cohort_table} c WHERE c.{row_id} = t.{row_id}
+                )
+            );
+            
+            {self.get_create_temp_table_str(pending_table, self.get_table_options_str())}
+            AS 
+            SELECT c.*
+            FROM {cohort_table} c
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {target_table} t WHERE t.{row_id} = c.{row_id}
+            );
+            """
+        
+        label_query = self.get_label_query(
+            labeler_ids, 
+            exclude_labeler_ids, 
+            cohort_table=pending_table, 
+            target_table=pending_labeled_table,
+            temp_target=True,
+            declare_window=declare_window,
+        )
+        
+        merge_query = f"""
+            MERGE {target_table} t
+            USING {pending_labeled_table} s
+            ON t.{row_id} = s.{row_id}
+            WHEN NOT MATCHED THEN
+                INSERT ROW;
+            """
+        merge_query += self.get_drop_temp_table_str(pending_table)
+        merge_query += self.get_drop_temp_table_str(pending_labeled_table)
+        
+        return [pending_query, label_query, merge_query]
+    
+    def update_label_table(
+        self, 
+        labeler_ids:list=None, 
+        exclude_labeler_ids:list=None,
+        invalidate_table:str=None,
+    ):
+        """
+        Incrementally labels the cohort rows missing from `target_table_name`, 
+        see get_incremental_label_queries. Creates the label table if it does not exist.
+        """
+        try:
+            self.db.client.get_table(
+                "{rs_dataset_project}.{rs_dataset}.{target_table_name}".format_map(self.config)
+            )
+        except NotFound:
+            self.create_label_table(labeler_ids, exclude_labeler_ids)
+            return
+            
+        self.execute_queries(
+            self.get_incremental_label_queries(
+                labeler_ids, exclude_labeler_ids, invalidate_table
+            )
+        )
+    
+    def execute_queries(self, queries:list):
+        """
+        Executes queries in order. If `session_temp_tables` is set, they are executed 
+        within one session so that their temporary tables are shared
+        """
+        if self.config['session_temp_tables']:
+            self.db.execute_sql_in_session(queries)
+        else:
+            for query in queries:
+                self.db.execute_sql(query)
+    
+    def get_temp_table(self, name:str, permanent:bool=False):
+        """
+        Reference to an intermediate table: a temporary table of the script or session if 
+        `session_temp_tables` is set, and a table in `temp_dataset` otherwise or if permanent
+        """
+        if self.config['session_temp_tables'] and not permanent:
+            return name
+        return f"{self.config['rs_dataset_project']}.{self.config['temp_dataset']}.{name}"
+    
+    def get_create_temp_table_str(
+        self, 
+        table:str, 
+        table_options_str:str="", 
+        permanent:bool=False,
+    ):
+        """
+        Header of the statement creating an intermediate table. Tables in `temp_dataset` 
+        expire after `temp_table_expiration_hours` in case they are not dropped, e.g. on failure
+        """
+        if self.config['session_temp_tables'] and not permanent:
+            return f"CREATE TEMP TABLE {table}\n            {table_options_str}"
+        
+        expiration_hours = self.config['temp_table_expiration_hours']
+        if expiration_hours:
+            table_options_str += (
+                "\n            OPTIONS(expiration_timestamp=TIMESTAMP_ADD("
+                f"CURRENT_TIMESTAMP(), INTERVAL {int(expiration_hours)} HOUR))"
+            )
+        return f"CREATE OR REPLACE TABLE {table}\n            {table_options_str}"
+    
+    def get_drop_temp_table_str(self, table:str, permanent:bool=False):
+        """
+        Statement dropping an intermediate table. Temporary tables need no cleanup
+        """
+        if self.config['session_temp_tables'] and not permanent:
+            return ""
+        return f"""
+            DROP TABLE {table};
+            """
+    
+    def get_table_options_str(self):
+        """
+        PARTITION BY and CLUSTER BY clauses of the cohort-level tables created by the labeler,
+        set by `partition_by` and `cluster_by`
+        """
+        return get_table_options_str(self.config['partition_by'], self.config['cluster_by'])
+    
+    def get_window_declarations(self):
+        """
+        Script variables bounding the measurement scans, see get_window_assignments.
+        Variables of a session cannot be redeclared, so queries executed in one session 
+        declare them once
+        """
+        if not self.config['prune_measurements']:
+            return ""
+        
+        return """
+            DECLARE label_window_start DATETIME;
+            DECLARE label_window_end DATETIME;
+            """
+    
+    def get_window_assignments(self, cohort_table:str):
+        """
+        Sets the window variables to the earliest window start and the latest window 
+        (or horizon) end of the cohort, so that a partitioned or clustered measurement 
+        table is pruned
+        """
+        if not self.config['prune_measurements']:
+            return ""
+        
+        window_start_field = self.config['window_start_field']
+        window_end_field = self.config['window_end_field']
+        
+        label_window_end = window_end_field
+        horizon_ends = get_horizon_ends(self.config['window_horizons'], window_start_field)
+        if horizon_ends:
+            label_window_end = (
+                f"GREATEST({window_end_field}, {', '.join(end for _, end in horizon_ends)})"
+            )
+        
+        return f"""
+            SET label_window_start = (
+                SELECT DATETIME(MIN({window_start_field})) FROM {cohort_table}
+            );
+            SET label_window_end = (
+                SELECT DATETIME(MAX({label_window_end})) FROM {cohort_table}
+            );
+            """
+    
+    def get_query_parameters(self, query):
+        """
+        Labeler-level parameters read by the query templates. Query defaults (e.g. thresholds)
+        are only overridden through namespaced parameters such as `readmission_horizons`.
+        """
+        parameters = {
+            'window_start_field':self.config['window_start_field'],
+            'window_horizons':self.config['window_horizons'],
+            'extract_labs_from_flowsheets':self.config['extract_labs_from_flowsheets'],
+            'flowsheets_extract_name':self.config['flowsheets_extract_name'],
+        }
+        if (
+            isinstance(query, ReadmissionQuery) 
+            and self.config['readmission_horizons'] is not None
+        ):
+            parameters['horizons'] = self.config['readmission_horizons']
+        return parameters
+    
+    def get_configured_query(self, query):
+        """
+        Copy of a query configured with get_query_parameters, leaving self.queries unchanged
+        """
+        query = copy.copy(query)
+        query.config = {**query.config, **self.get_query_parameters(query)}
+        query.base_query = query.get_base_query()
+        return query
+    
+    def format_query(self, query, base_query:str, cohort_table:str, window_horizons:bool=True):
+        """
+        Fills the placeholders of a query template for the given cohort table.
+        With window horizons, queries that support them label up to the latest horizon end.
+        """
+        measurement_prune_str = ""
+        if self.config['prune_measurements']:
+            lookback_days = query.config.get('lookback_days', 0)
+            measurement_prune_str = (
+                f"AND m.measurement_datetime >= "
+                f"DATETIME_SUB(label_window_start, INTERVAL {lookback_days} DAY) "
+                f"AND m.measurement_datetime <= label_window_end"
+            )
+            
+        query_format = {
+            **self.config, **query.config, 
+            'cohort_table':cohort_table,
+            'measurement_prune_str':measurement_prune_str,
+        }
+        
+        horizon_ends = query.get_window_horizons() if window_horizons else []
+        if horizon_ends:
+            horizon_window_end = f"GREATEST({', '.join(end for _, end in horizon_ends)})"
+            query_format['cohort_table'] = (
+                f"(SELECT *, {horizon_window_end} AS horizon_window_end FROM {cohort_table})"
+            )
+            query_format['window_end_field'] = 'horizon_window_end'
+            
+        return base_query.format_map(query_format)
+    
     def create_label_table(self, labeler_ids:list=None, exclude_labeler_ids:list=None):
         """
-        Creates the cohort table in the database
+        Creates the cohort table in the database.
+        If `num_shards` is set, the cohort is labeled one shard of persons at a time.
+        The first shard creates the target table and, once it is done, the remaining 
+        shards are inserted using up to `shard_workers` concurrent jobs.
+        """
+        num_shards = self.config['num_shards']
+        if num_shards is None or num_shards <= 1:
+            self.db.execute_sql(self.get_label_query(labeler_ids, exclude_labeler_ids))
+            return
+        
+        queries = [
+            self.get_label_query(labeler_ids, exclude_labeler_ids, shard_id=shard_id)
+            for shard_id in range(num_shards)
+        ]
+        self.db.execute_sql(queries[0])
+        self.db.execute_sql_parallel(queries[1:], max_workers=self.config['shard_workers'])
+    
+    def get_threshold_sweep_query(
+        self, 
+        thresholds:dict, 
+        sweep_table_name:str=None, 
+        inclusive:bool=False,
+    ):
+        """
+        Build a query for a threshold sweep of lab-based labelers.
+        `thresholds` maps labeler_ids of threshold lab labelers to a list of thresholds.
+        The resulting table has one row per cohort row, labeler and threshold with 
+        whether and when the measurements first crossed the threshold.
+        Crossings are strict unless inclusive, e.g. `<= 3.9` rather than `< 3.9` for the
+        mild hypoglycemia threshold. Labelers whose thresholds are not raw values 
+        (e.g. relative to a baseline for aki_lab) do not support sweeps.
+        Defaults to `{target_table_name}_threshold_sweep`.
+        """
+        for labeler_id in thresholds:
+            if labeler_id not in self.queries.keys():
+                raise ValueError(f"Provided labeler_id {labeler_id} not defined")
+            if (
+                not isinstance(self.queries[labeler_id], ThresholdLabQuery)
+                or self.queries[labeler_id].config['sweep_direction'] is None
+            ):
+                raise ValueError(f"Labeler {labeler_id} does not support threshold sweeps")
+        
+        if sweep_table_name is None:
+            sweep_table_name = f"{self.config['target_table_name']}_threshold_sweep"
+            
+        rs_dataset_project = self.config['rs_dataset_project']
+        rs_dataset = self.config['rs_dataset']
+        cohort_table = self.get_cohort_table()
+        
+        q_main = self.get_window_declarations() + self.get_window_assignments(cohort_table)
+        for i, (labeler_id, labeler_thresholds) in enumerate(thresholds.items()):
+            query = self.get_configured_query(self.queries[labeler_id])
+            
+            i_q = self.format_query(
+                query, 
+                query.get_threshold_sweep_query(labeler_thresholds, inclusive), 
+                cohort_table, 
+                window_horizons=False,
+            )
+            
+            if i == 0:
+                q_main += f"""
+            CREATE OR REPLACE TABLE {rs_dataset_project}.{rs_dataset}.{sweep_table_name}
+            CLUSTER BY labeler_id, threshold
+            AS {i_q};
+            """
+            else:
+                q_main += f"""
+            INSERT INTO {rs_dataset_project}.{rs_dataset}.{sweep_table_name}
+            {i_q};
+            """
+        
+        return q_main
+    
+    def create_threshold_sweep_table(
+        self, 
+        thresholds:dict, 
+        sweep_table_name:str=None, 
+        inclusive:bool=False,
+    ):
+        """
+        Creates the threshold sweep table in the database, see get_threshold_sweep_query
+        """
+        self.db.execute_sql(
+            self.get_threshold_sweep_query(thresholds, sweep_table_name, inclusive)
+        )
+    
+    def get_label_store_table(self):
+        """
+        Full name of the long-format label store, `label_store_name` or 
+        `{target_table_name}_long` by default
+        """
+        label_store_name = (
+            self.config['label_store_name'] 
+            or f"{self.config['target_table_name']}_long"
+        )
+        return f"{self.config['rs_dataset_project']}.{self.config['rs_dataset']}.{label_store_name}"
+    
+    def get_label_store_columns_table(self):
+        """
+        Full name of the catalog of the label store, with the position and BigQuery type of 
+        each label column of each labeler
+        """
+        return f"{self.get_label_store_table()}_columns"
+    
+    def get_label_store_key(self, labeler_id:str):
+        """
+        Integer partition of a labeler in the label store, a stable hash of labeler_id
+        """
+        return zlib.crc32(labeler_id.encode()) % self.config['label_store_partitions']
+    
+    def get_label_store_query(self, labeler_ids:list=None, exclude_labeler_ids:list=None):
+        """
+        Build a query writing the labels to the long-format label store, with one row per 
+        cohort row, labeler and non-null label column. The store is partitioned by labeler 
+        and clustered by `row_id`, so that adding or refreshing a labeler only rewrites 
+        the partition of that labeler. Columns:
+            label_name: name of the column in the wide label table
+            value: numeric and boolean labels
+            value_string: string labels
+            event_datetime: date, datetime and timestamp labels
+            value_type: 'number', 'boolean', 'string' or 'datetime'
+        The position and BigQuery type of the label columns are written to the catalog 
+        table get_label_store_columns_table, so that get_pivot_query restores them.
+        The intermediate label tables are always in `temp_dataset`, where their schema is 
+        read from INFORMATION_SCHEMA.
+        Diagnosis-based labelers are not fused, so that each labeler has its own partition.
+        """
+        queries = self.get_selected_queries(labeler_ids, exclude_labeler_ids)
+        
+        row_id = self.config['row_id']
+        label_store_table = self.get_label_store_table()
+        label_store_columns_table = self.get_label_store_columns_table()
+        cohort_table = self.get_cohort_table()
+        
+        rnd_suffix = ''.join((random.choice(string.ascii_lowercase) for x in range(5)))
+        label_columns_table = self.get_temp_table(f"temp_label_columns_{rnd_suffix}", permanent=True)
+        
+        q_main = self.get_window_declarations() + self.get_window_assignments(cohort_table)
+        q_main += f"""
+            CREATE TABLE IF NOT EXISTS {label_store_table} (
+                {row_id} INT64,
+                labeler_id STRING,
+                labeler_key INT64,
+                label_name STRING,
+                value FLOAT64,
+                value_string STRING,
+                event_datetime DATETIME,
+                value_type STRING
+            )
+            PARTITION BY RANGE_BUCKET(
+                labeler_key, GENERATE_ARRAY(0, {self.config['label_store_partitions']}, 1)
+            )
+            CLUSTER BY {row_id};
+            
+            CREATE TABLE IF NOT EXISTS {label_store_columns_table} (
+                labeler_id STRING,
+                label_name STRING,
+                ordinal_position INT64,
+                data_type STRING
+            );
+            """
+        q_columns = []
+        q_write = ""
+        q_cleanup = ""
+        
+        for labeler_id, query in queries.items():
+            query = self.get_configured_query(query)
+            
+            i_q = self.format_query(query, query.base_query, cohort_table)
+            temp_table_name = f"temp_{labeler_id}_{rnd_suffix}"
+            temp_table = self.get_temp_table(temp_table_name, permanent=True)
+            labeler_key = self.get_label_store_key(labeler_id)
+            
+            q_main += f"""
+            {self.get_create_temp_table_str(temp_table, f"CLUSTER BY {row_id}", permanent=True)}
+            AS {i_q};
+            """
+            
+            q_columns.append(f"""
+                SELECT '{labeler_id}' AS labeler_id
+                    ,column_name AS label_name
+                    ,ordinal_position
+                    ,data_type
+                FROM `{self.config['rs_dataset_project']}.{self.config['temp_dataset']}`.INFORMATION_SCHEMA.COLUMNS
+                WHERE table_name = '{temp_table_name}' AND column_name != '{row_id}'""")
+            
+            # unpivot the label columns through the JSON representation of each row and 
+            # route each value to the field of the type of its column
+            q_write += f"""
+            DELETE FROM {label_store_table}
+            WHERE labeler_key = {labeler_key} AND labeler_id = '{labeler_id}';
+            
+            INSERT INTO {label_store_table}
+            WITH label_values AS (
+                SELECT {row_id}, label_name
+                    ,label_json[label_name] AS label_value
+                FROM (SELECT {row_id}, TO_JSON(t) AS label_json FROM {temp_table} t)
+                CROSS JOIN UNNEST(JSON_KEYS(label_json, 1)) AS label_name
+                WHERE label_name != '{row_id}'
+            ),
+            typed_label_values AS (
+                SELECT v.*, c.data_type
+                    ,CASE 
+                        WHEN c.data_type = 'BOOL' THEN 'boolean'
+                        WHEN c.data_type IN ('INT64', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC') THEN 'number'
+                        WHEN c.data_type IN ('DATE', 'DATETIME', 'TIMESTAMP') THEN 'datetime'
+                        ELSE 'string'
+                    END AS value_type
+                FROM label_values v
+                INNER JOIN {label_columns_table} c
+                    ON c.labeler_id = '{labeler_id}' AND c.label_name = v.label_name
+                WHERE JSON_TYPE(v.label_value) != 'null'
+            )
+            SELECT {row_id}
+                ,'{labeler_id}' AS labeler_id
+                ,{labeler_key} AS labeler_key
+                ,label_name
+                ,CASE value_type
+                    WHEN 'number' THEN FLOAT64(label_value, wide_number_mode=>'round')
+                    WHEN 'boolean' THEN IF(BOOL(label_value), 1, 0)
+                END AS value
+                ,CASE 
+                    WHEN data_type = 'STRING' THEN STRING(label_value)
+                    WHEN value_type = 'string' THEN TO_JSON_STRING(label_value)
+                END AS value_string
+                ,CASE data_type
+                    WHEN 'TIMESTAMP' THEN DATETIME(CAST(STRING(label_value) AS TIMESTAMP))
+                    WHEN 'DATE' THEN CAST(CAST(STRING(label_value) AS DATE) AS DATETIME)
+                    WHEN 'DATETIME' THEN CAST(STRING(label_value) AS DATETIME)
+                END AS event_datetime
+                ,value_type
+            FROM typed_label_values;
+            """
+            
+            q_cleanup += self.get_drop_temp_table_str(temp_table, permanent=True)
+        
+        q_columns_str = "\n                UNION ALL".join(q_columns)
+        q_main += f"""
+            {self.get_create_temp_table_str(label_columns_table, permanent=True)}
+            AS {q_columns_str};
+            """
+        q_cleanup += self.get_drop_temp_table_str(label_columns_table, permanent=True)
+        
+        labeler_ids_str = ", ".join(f"'{x}'" for x in queries)
+        
+        # readers of the store never see a labeler without its labels
+        q_main += f"""
+            BEGIN TRANSACTION;
+            
+            DELETE FROM {label_store_columns_table}
+            WHERE labeler_id IN ({labeler_ids_str});
+            
+            INSERT INTO {label_store_columns_table}
+            SELECT * FROM {label_columns_table};
+            {q_write}
+            COMMIT TRANSACTION;
+            """
+        q_main += q_cleanup
+        
+        return q_main
+    
+    def update_label_store(self, labeler_ids:list=None, exclude_labeler_ids:list=None):
+        """
+        Writes the labels of `labeler_ids` to the label store, see get_label_store_query
+        """
+        self.db.execute_sql(self.get_label_store_query(labeler_ids, exclude_labeler_ids))
+    
+    def get_label_store_types(self, labeler_ids:list=None):
+        """
+        Returns a dictionary mapping the label columns in the label store to their 
+        BigQuery type, in the column order of the labelers
+        """
+        labeler_ids = list(self.get_selected_queries(labeler_ids).keys())
+        
+        query = f"""
+            SELECT labeler_id, label_name, ordinal_position, data_type
+            FROM {self.get_label_store_columns_table()}
+            WHERE labeler_id IN ({", ".join(f"'{x}'" for x in labeler_ids)})
+        """
+        rows = sorted(
+            self.db.execute_sql(query), 
+            key=lambda row: (labeler_ids.index(row['labeler_id']), row['ordinal_position'])
+        )
+        return {row['label_name']:row['data_type'] for row in rows}
+    
+    def get_pivot_query(
+        self, 
+        labeler_ids:list=None, 
+        target_table_name:str=None, 
+        label_types:dict=None,
+    ):
+        """
+        Build a query materializing the wide label table of `labeler_ids` from the label store.
+        label_types maps the label columns, in order, to their BigQuery type and is read 
+        from the label store by default, see get_label_store_types. The columns are cast 
+        back to their type and columns without any value are kept.
+        Defaults to `target_table_name`.
+        """
+        if label_types is None:
+            label_types = self.get_label_store_types(labeler_ids)
+        
+        labeler_ids = list(self.get_selected_queries(labeler_ids).keys())
+        labeler_keys = sorted(set(self.get_label_store_key(x) for x in labeler_ids))
+        
+        if target_table_name is None:
+            target_table_name = self.config['target_table_name']
+        
+        row_id = self.config['row_id']
+        
+        q_pivot = ""
+        for label_name, data_type in label_types.items():
+            if data_type in ('INT64', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC'):
+                value = f"CAST(MAX(IF(label_name = '{label_name}', value, NULL)) AS {data_type})"
+            elif data_type == 'BOOL':
+                value = f"CAST(CAST(MAX(IF(label_name = '{label_name}', value, NULL)) AS INT64) AS BOOL)"
+            elif data_type in ('DATE', 'DATETIME', 'TIMESTAMP'):
+                value = f"CAST(MAX(IF(label_name = '{label_name}', event_datetime, NULL)) AS {data_type})"
+            else:
+                value = f"MAX(IF(label_name = '{label_name}', value_string, NULL))"
+            q_pivot += f"""
+                    ,{value} AS {label_name}"""
+        
+        return f"""
+            CREATE OR REPLACE TABLE {self.config['rs_dataset_project']}.{self.config['rs_dataset']}.{target_table_name}
+            {self.get_table_options_str()}
+            AS
+            (
+                SELECT * 
+                FROM {self.get_cohort_table()} 
+                LEFT JOIN (
+                    SELECT {row_id}{q_pivot}
+                    FROM {self.get_label_store_table()}
+                    WHERE labeler_key IN ({", ".join(str(x) for x in labeler_keys)})
+                        AND labeler_id IN ({", ".join(f"'{x}'" for x in labeler_ids)})
+                    GROUP BY {row_id}
+                ) USING ({row_id})
+            );
+            """
+    
+    def create_pivot_table(self, labeler_ids:list=None, target_table_name:str=None):
+        """
+        Materializes the wide label table from the label store, see get_pivot_query
+        """
+        self.db.execute_sql(self.get_pivot_query(labeler_ids, target_table_name))
+    
+    def get_compare_query(self, reference_table_name:str, columns:list):
+        """
+        Counts the rows of `target_table_name` not in `reference_table_name` and vice versa, 
+        comparing only the provided columns
+        """
+        rs_dataset_project = self.config['rs_dataset_project']
+        rs_dataset = self.config['rs_dataset']
+        target_table_name = self.config['target_table_name']
+        columns_str = ", ".join(f"`{x}`" for x in columns)
+        
+        return f"""
+        SELECT 
+            (
+                SELECT COUNT(*) FROM (
+                    SELECT {columns_str} FROM {rs_dataset_project}.{rs_dataset}.{target_table_name}
+                    EXCEPT DISTINCT
+                    SELECT {columns_str} FROM {rs_dataset_project}.{rs_dataset}.{reference_table_name}
+                )
+            ) AS rows_not_in_reference,
+            (
+                SELECT COUNT(*) FROM (
+                    SELECT {columns_str} FROM {rs_dataset_project}.{rs_dataset}.{reference_table_name}
+                    EXCEPT DISTINCT
+                    SELECT {columns_str} FROM {rs_dataset_project}.{rs_dataset}.{target_table_name}
+                )
+            ) AS reference_rows_not_in_target
         """
-        self.db.execute_sql(self.get_label_query(labeler_ids, exclude_labeler_ids))
-    
\ No newline at end of file
+    
+    def compare_label_tables(self, reference_table_name:str):
+        """
+        Checks that `target_table_name` is unchanged relative to `reference_table_name`, 
+        e.g. a label table created before a change to the labelers. Column order is ignored.
+        Returns a dictionary with the columns missing from or added to `target_table_name` 
+        and the number of rows that differ over the shared columns.
+        """
+        rs_dataset_project = self.config['rs_dataset_project']
+        rs_dataset = self.config['rs_dataset']
+        
+        target_columns = [
+            x.name for x in self.db.client.get_table(
+                f"{rs_dataset_project}.{rs_dataset}.{self.config['target_table_name']}"
+            ).schema
+        ]
+        reference_columns = [
+            x.name for x in self.db.client.get_table(
+                f"{rs_dataset_project}.{rs_dataset}.{reference_table_name}"
+            ).schema
+        ]
+        columns = sorted(set(target_columns) & set(reference_columns))
+        
+        result = list(
+            self.db.execute_sql(self.get_compare_query(reference_table_name, columns))
+        )[0]
+        
+        return {
+            'missing_columns':[x for x in reference_columns if x not in target_columns],
+            'added_columns':[x for x in target_columns if x not in reference_columns],
+            'rows_not_in_reference':result['rows_not_in_reference'],
+            'reference_rows_not_in_target':result['reference_rows_not_in_target'],
+        }
+    
+    def get_summary_query(self, label_columns:list, numeric_columns:list, strata:list=None):
+        """
+        Build a query computing the number of positives of each label column and the 
+        number of non-null values and approximate quantiles (in 0.5% steps) of each 
+        numeric column of `target_table_name`, optionally grouped by the `strata` columns
+        """
+        strata = strata or []
+        
+        q_columns = "".join(
+            f"""
+            ,COUNT(`{x}`) AS label_{i}_count
+            ,COUNTIF(`{x}` = 1) AS label_{i}_positive"""
+            for i, x in enumerate(label_columns)
+        )
+        q_columns += "".join(
+            f"""
+            ,COUNT(`{x}`) AS numeric_{i}_count
+            ,APPROX_QUANTILES(`{x}`, 200) AS numeric_{i}_quantiles"""
+            for i, x in enumerate(numeric_columns)
+        )
+        
+        q_strata = "".join(f"`{x}`, " for x in strata)
+        q_group = (
+            "GROUP BY {0}\n        ORDER BY {0}".format(", ".join(f"`{x}`" for x in strata)) 
+            if strata else ""
+        )
+        
+        return f"""
+        SELECT {q_strata}COUNT(*) AS row_count{q_columns}
+        FROM {self.config['rs_dataset_project']}.{self.config['rs_dataset']}.{self.config['target_table_name']}
+        {q_group}
+        """
+    
+    def summarize(self, strata:list=None):
+        """
+        Summarizes `target_table_name` within BigQuery. Label columns are the integer 
+        columns with `_label` in their name and numeric columns are the other numeric 
+        columns, excluding `row_id` and person_id.
+        Returns a DataFrame with one row per column (and stratum) with the prevalence of 
+        the labels and the null rate, median, 2.5% and 97.5% quantiles of numeric columns.
+        """
+        strata = strata or []
+        schema = self.db.client.get_table(
+            "{rs_dataset_project}.{rs_dataset}.{target_table_name}".format_map(self.config)
+        ).schema
+        
+        excluded = [self.config['row_id'], 'person_id'] + strata
+        numeric_types = ('INTEGER', 'INT64', 'FLOAT', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC')
+        label_columns = [
+            x.name for x in schema 
+            if x.field_type in ('INTEGER', 'INT64') and '_label' in x.name
+            and x.name not in excluded
+        ]
+        numeric_columns = [
+            x.name for x in schema 
+            if x.field_type in numeric_types and x.name not in label_columns
+            and x.name not in excluded
+        ]
+        
+        rows = self.db.execute_sql(
+            self.get_summary_query(label_columns, numeric_columns, strata)
+        )
+        
+        result = []
+        for row in rows:
+            stratum = {x:row[x] for x in strata}
+            row_count = row['row_count']
+            for i, column in enumerate(label_columns):
+                count = row[f'label_{i}_count']
+                positive = row[f'label_{i}_positive']
+                result.append({
+                    **stratum,
+                    'column':column,
+                    'type':'label',
+                    'row_count':row_count,
+                    'positive':positive,
+                    'prevalence':positive / count if count else None,
+                    'null_rate':1 - count / row_count if row_count else None,
+                })
+            for i, column in enumerate(numeric_columns):
+                count = row[f'numeric_{i}_count']
+                quantiles = row[f'numeric_{i}_quantiles'] or []
+                result.append({
+                    **stratum,
+                    'column':column,
+                    'type':'numeric',
+                    'row_count':row_count,
+                    'null_rate':1 - count / row_count if row_count else None,
+                    'median':quantiles[100] if quantiles else None,
+                    'quantile_025':quantiles[5] if quantiles else None,
+                    'quantile_975':quantiles[195] if quantiles else None,
+                })
+        
+        return pd.DataFrame(
+            result,
+            columns=strata + [
+                'column', 'type', 'row_count', 'positive', 'prevalence', 'null_rate', 
+                'median', 'quantile_025', 'quantile_975',
+            ],
+        )
+    
+    def preview(
+        self, 
+        labeler_ids:list=None, 
+        fraction:float=0.01, 
+        seed:int=0, 
+        maximum_bytes_billed:int=None,
+    ):
+        """
+        Labels a deterministic sample of a `fraction` of the persons of the cohort using 
+        temporary tables only, such that labeler definitions can be checked quickly.
+        The measurement scans are bounded by the windows of the sampled rows and the job 
+        fails rather than bill more than `maximum_bytes_billed` 
+        (`preview_maximum_bytes_billed` by default). With `extract_labs_from_flowsheets`, 
+        the existing flowsheets extract is read but never created or overwritten.
+        Returns the labels and a DataFrame with the prevalence of each label column and 
+        its 95% Wilson score interval. The intervals treat cohort rows as independent.
+        """
+        if maximum_bytes_billed is None:
+            maximum_bytes_billed = self.config['preview_maximum_bytes_billed']
+        
+        rnd_suffix = ''.join((random.choice(string.ascii_lowercase) for x in range(5)))
+        
+        session_temp_tables = self.config['session_temp_tables']
+        self.configure(session_temp_tables=True)
+        try:
+            target_table = self.get_temp_table(f"temp_preview_{rnd_suffix}")
+            query = self.get_label_query(
+                labeler_ids, 
+                cohort_table=self.get_cohort_table(
+                    sample_fraction=fraction, sample_seed=seed
+                ),
+                target_table=target_table,
+                temp_target=True,
+                extract_flowsheets=False,
+            )
+        finally:
+            self.configure(session_temp_tables=session_temp_tables)
+        
+        query += f"""
+            SELECT * FROM {target_table} ORDER BY {self.config['row_id']};
+            """
+        
+        labels = self.db.execute_sql(
+            query, maximum_bytes_billed=maximum_bytes_billed
+        ).to_dataframe()
+        
+        result = []
+        for column in labels.columns:
+            if '_label' not in column or labels[column].dtype.kind not in 'iuf':
+                continue
+            n = int(labels[column].notnull().sum())
+            positive = int((labels[column] == 1).sum())
+            lower, upper = get_wilson_interval(positive, n)
+            result.append({
+                'column':column,
+                'n':n,
+                'positive':positive,
+                'prevalence':positive / n if n else None,
+                'lower':lower,
+                'upper':upper,
+            })
+        
+        return labels, pd.DataFrame(
+            result, columns=['column', 'n', 'positive', 'prevalence', 'lower', 'upper']
+        )
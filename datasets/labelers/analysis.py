@@ -0,0 +1,222 @@
+import hashlib
+import re
+
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<comment>--[^\n]*|\#[^\n]*|/\*.*?\*/)
+    |(?P<string>'(?:\\.|[^'\\])*'|"(?:\\.|[^"\\])*")
+    |(?P<quoted>`[^`]*`)
+    |(?P<word>[A-Za-z_][A-Za-z0-9_]*)
+    |(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)
+    |(?P<space>\s+)
+    |(?P<symbol>.)
+    """,
+    re.VERBOSE | re.DOTALL,
+)
+
+
+def tokenize(query):
+    """
+    Splits a BigQuery SQL query into a list of (kind, text, start) tokens without
+    whitespace and comments. kind is one of string, quoted, word, number or symbol
+    """
+    return [
+        (match.lastgroup, match.group(), match.start())
+        for match in TOKEN_PATTERN.finditer(query)
+        if match.lastgroup not in ("comment", "space")
+    ]
+
+
+def is_keyword(token, keyword):
+    return token[0] == "word" and token[1].upper() == keyword
+
+
+def find_closing(tokens, i):
+    """
+    Index of the parenthesis closing the one at tokens[i]
+    """
+    depth = 0
+    for j in range(i, len(tokens)):
+        if tokens[j][1] == "(":
+            depth += 1
+        elif tokens[j][1] == ")":
+            depth -= 1
+            if depth == 0:
+                return j
+    raise ValueError("Unbalanced parentheses in query")
+
+
+def split_ctes(query):
+    """
+    Splits the top-level WITH clause of a query.
+    Returns a list of (name, body) of the CTEs in order and the final statement
+    """
+    tokens = tokenize(query)
+    if not tokens or not is_keyword(tokens[0], "WITH"):
+        return [], query.strip()
+
+    ctes = []
+    i = 1
+    while True:
+        if (
+            i + 2 >= len(tokens)
+            or not is_keyword(tokens[i + 1], "AS")
+            or tokens[i + 2][1] != "("
+        ):
+            raise ValueError("Unexpected WITH clause at position {}".format(tokens[i][2]))
+        name = tokens[i][1].strip("`")
+        j = find_closing(tokens, i + 2)
+        ctes.append((name, query[tokens[i + 2][2] + 1 : tokens[j][2]].strip()))
+        if j + 1 < len(tokens) and tokens[j + 1][1] == ",":
+            i = j + 2
+        else:
+            break
+
+    statement = query[tokens[j + 1][2] :].strip() if j + 1 < len(tokens) else ""
+    return ctes, statement
+
+
+def get_references(body, names):
+    """
+    Names in `names` referenced as tables by a query body
+    """
+    names = {x.lower() for x in names}
+    tokens = tokenize(body)
+    return {
+        token[1].lower()
+        for k, token in enumerate(tokens)
+        if token[0] == "word"
+        and token[1].lower() in names
+        and (k == 0 or tokens[k - 1][1] != ".")
+        and (k + 1 == len(tokens) or tokens[k + 1][1] != ".")
+    }
+
+
+def get_cte_fingerprints(query):
+    """
+    Fingerprints of the CTEs of a query, as a list of (name, body, fingerprint, references).
+    The fingerprint of a CTE does not depend on whitespace, comments or the names of
+    the CTEs it references, which are replaced by their own fingerprints
+    """
+    ctes, _ = split_ctes(query)
+    fingerprints = {}
+    result = []
+    for name, body in ctes:
+        normalized = " ".join(
+            fingerprints.get(text.lower(), text) if kind == "word" else text
+            for kind, text, _ in tokenize(body)
+        )
+        fingerprint = hashlib.sha1(normalized.encode()).hexdigest()[:12]
+        result.append(
+            (name, body, fingerprint, get_references(body, fingerprints.keys()))
+        )
+        fingerprints[name.lower()] = fingerprint
+    return result
+
+
+def get_input_tables(query):
+    """
+    Tables read by a query, i.e. names following FROM or JOIN that are not CTEs of the query
+    """
+    cte_names = set()
+    tables = set()
+    tokens = tokenize(query)
+    for k, token in enumerate(tokens):
+        if (
+            token[0] == "word"
+            and k + 2 < len(tokens)
+            and is_keyword(tokens[k + 1], "AS")
+            and tokens[k + 2][1] == "("
+        ):
+            cte_names.add(token[1].lower())
+
+    for k, token in enumerate(tokens[:-1]):
+        if not (is_keyword(token, "FROM") or is_keyword(token, "JOIN")):
+            continue
+        # join names of the form project.dataset.table, possibly with dashes or backticks
+        name = ""
+        for kind, text, _ in tokens[k + 1 :]:
+            if kind in ("word", "quoted", "number") or text in (".", "-"):
+                if kind == "word" and name and not name.endswith((".", "-")):
+                    break
+                name += text.strip("`")
+            else:
+                break
+        if not name or is_keyword(tokens[k + 1], "UNNEST"):
+            continue
+        if name.lower() not in cte_names:
+            tables.add(name)
+    return sorted(tables)
+
+
+def hoist_shared_ctes(queries, get_stage_table, min_count=2):
+    """
+    Hoists the CTEs shared by at least `min_count` queries into stages computed once.
+    Args:
+        queries: a dictionary of formatted queries, e.g. keyed by labeler_id
+        get_stage_table: function returning the table of a stage from its fingerprint
+        min_count: the number of queries that must share a CTE for it to be hoisted
+    Returns:
+        stages: a list of (stage_table, query) in dependency order
+        queries: the queries with the bodies of the shared CTEs replaced by their stage
+    """
+    analyzed = {key: get_cte_fingerprints(query) for key, query in queries.items()}
+
+    counts = {}
+    for ctes in analyzed.values():
+        for fingerprint in {x[2] for x in ctes}:
+            counts[fingerprint] = counts.get(fingerprint, 0) + 1
+    shared = {x for x, count in counts.items() if count >= min_count}
+
+    stages = {}
+    result = {}
+    for key, query in queries.items():
+        ctes = analyzed[key]
+        if not any(x[2] in shared for x in ctes):
+            result[key] = query
+            continue
+
+        fingerprints = {name.lower(): fingerprint for name, _, fingerprint, _ in ctes}
+        q_ctes = []
+        for name, body, fingerprint, references in ctes:
+            if fingerprint not in shared:
+                q_ctes.append(f"{name} AS (\n{body}\n)")
+                continue
+
+            stage_table = get_stage_table(fingerprint)
+            if fingerprint not in stages:
+                # the CTEs referenced by a shared CTE are shared as well
+                stages[fingerprint] = (
+                    stage_table,
+                    get_stage_query(
+                        body,
+                        [
+                            (x, get_stage_table(fingerprints[x]))
+                            for x in sorted(references)
+                        ],
+                    ),
+                )
+            q_ctes.append(f"{name} AS (\n SELECT * FROM {stage_table}\n)")
+
+        _, statement = split_ctes(query)
+        result[key] = "WITH {}\n{}".format(",\n".join(q_ctes), statement)
+
+    return list(stages.values()), result
+
+
+def get_stage_query(body, references):
+    """
+    Query of a stage computing a CTE body, where references is a list of
+    (name, stage_table) of the CTEs it reads
+    """
+    if not references:
+        return body
+
+    q_references = ",\n".join(
+        f"{name} AS (\n SELECT * FROM {stage_table}\n)" for name, stage_table in references
+    )
+    tokens = tokenize(body)
+    if is_keyword(tokens[0], "WITH"):
+        return "WITH {},\n{}".format(q_references, body[tokens[1][2] :])
+    return "WITH {}\n{}".format(q_references, body)
@@ -1,4 +1,12 @@
+from ..util import get_horizon_ends
+
+
 class LabelQuery:
+    # whether the query emits one set of label columns per window horizon
+    supports_window_horizons = False
+    # whether the labels of a row depend on the other cohort rows of the person (e.g. readmission)
+    uses_cohort_context = False
+    
     def __init__(self, *args, **kwargs):
         self.config = self.get_query_config()
         self.base_query = self.get_base_query()
@@ -8,4 +16,52 @@ class LabelQuery:
         raise NotImplementedError
         
     def get_base_query(self):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+    
+    def get_person_dimension_query(self):
+        """
+        CTE `person_dimension` with the age (in days at the window start), sex, race and 
+        ethnicity of each cohort row. The CTE is identical across labelers, so that it is 
+        computed once with `share_ctes`
+        """
+        return """
+        person_dimension AS
+        (
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
+                ,DATE_DIFF(t1.{window_start_field}, p.birth_datetime, DAY) as age_days
+                ,p.gender_concept_id
+                ,p.race_concept_id
+                ,p.ethnicity_concept_id
+            FROM {cohort_table} t1
+            LEFT JOIN `{dataset_project}.{dataset}.person` p
+                ON t1.person_id = p.person_id
+        )"""
+    
+    def get_window_horizons(self):
+        """
+        (name, end expression) of each window horizon, empty if horizons are not used
+        """
+        if not self.supports_window_horizons:
+            return []
+        return get_horizon_ends(
+            self.config.get('window_horizons'), 
+            self.config.get('window_start_field', 'admit_date'),
+        )
+    
+    def get_horizon_ends_query(self):
+        """
+        CTE `horizon_ends` with one row per cohort row and window horizon
+        """
+        horizon_structs = ",".join(
+            f"""
+                STRUCT('{name}' AS horizon, {end} AS horizon_end)"""
+            for name, end in self.get_window_horizons()
+        )
+        return f"""
+        horizon_ends AS
+        (
+            SELECT {{row_id}}, h.horizon, h.horizon_end
+            FROM {{cohort_table}}
+            CROSS JOIN UNNEST([{horizon_structs}
+            ]) h
+        )"""
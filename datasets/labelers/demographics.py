@@ -1,24 +1,55 @@
 from .base import LabelQuery
 
 
-class AgeQuery(LabelQuery):
+class DemographicsQuery(LabelQuery):
+    """
+    Labels computed from the person table. The columns are expressions over `age_days`
+    (at the window start) and the concept names of the person attributes in `person_concepts`
+    """
+    # (name, person field) of the concepts joined by the query
+    person_concepts = []
+
+    def get_label_columns(self):
+        raise NotImplementedError
+
+    def get_demographics_query(self, person_concepts, label_columns):
+        q_concepts = "".join(
+            f"""
+                ,{name}.concept_name AS {name}"""
+            for name, _ in person_concepts
+        )
+        q_joins = "".join(
+            f"""
+            LEFT JOIN {{dataset_project}}.{{dataset}}.concept AS {name}
+                ON pd.{field}={name}.concept_id"""
+            for name, field in person_concepts
+        )
+        return f"""
+        WITH {self.get_person_dimension_query().strip()},
+        demographics AS (
+            SELECT pd.{{row_id}}
+                ,pd.age_days{q_concepts}
+            FROM person_dimension pd{q_joins}
+        )
+        SELECT {{row_id}}{label_columns}
+        FROM demographics
+        """
+
+    def get_base_query(self):
+        return self.get_demographics_query(self.person_concepts, self.get_label_columns())
+
+
+class AgeQuery(DemographicsQuery):
     def get_query_config(self):
         return {
             "labeler_info":'Age group labels according to 1)pediatric age group and 2)intervals',
             "labeler_id":'age',
         }
-    
-    def get_base_query(self):
+
+    def get_label_columns(self):
         return """
-        WITH temp AS (
-            SELECT t1.person_id, {window_start_field}, {window_end_field}
-                ,DATE_DIFF({window_start_field}, birth_datetime, DAY) as age_days
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-            LEFT JOIN {dataset_project}.{dataset}.person AS t2
-                ON t1.person_id = t2.person_id
-        )
-        SELECT t1.*, age_days
-            ,CASE 
+            ,age_days
+            ,CASE
                 WHEN age_days BETWEEN 0 AND 27 THEN 'term neonatal'
                 WHEN age_days BETWEEN 28 AND 365 THEN 'infancy'
                 WHEN age_days BETWEEN 366 AND 2*365 THEN 'toddler'
@@ -29,7 +60,7 @@ class AgeQuery(LabelQuery):
                 WHEN age_days > 21*365 THEN 'non-pediatric'
                 ELSE 'unknown'
             END as pediatric_age_group
-            ,CASE 
+            ,CASE
                 WHEN age_days BETWEEN 0 AND 17*365 THEN '[0,18)'
                 WHEN age_days BETWEEN 17*365+1 AND 29*365 THEN '[18,30)'
                 WHEN age_days BETWEEN 29*365+1 AND 39*365 THEN '[30,40)'
@@ -40,47 +71,75 @@ class AgeQuery(LabelQuery):
                 WHEN age_days BETWEEN 79*365+1 AND 89*365 THEN '[80,90)'
                 WHEN age_days > 89*365 THEN '[90,)'
                 ELSE 'unknown'
-            END as age_group
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-        LEFT JOIN temp USING (person_id, {window_start_field}, {window_end_field})
-        """
+            END as age_group"""
+
 
+class SexQuery(DemographicsQuery):
+    person_concepts = [('sex', 'gender_concept_id')]
 
-class SexQuery(LabelQuery):
     def get_query_config(self):
         return {
             "labeler_info":'OMOP standard concepts for sex',
             "labeler_id":'sex',
         }
-    
-    def get_base_query(self):
+
+    def get_label_columns(self):
         return """
-        SELECT t1.person_id, {window_start_field}, {window_end_field}
-            ,t3.concept_name as sex
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-        LEFT JOIN {dataset_project}.{dataset}.person AS t2
-            ON t1.person_id = t2.person_id
-        LEFT JOIN {dataset_project}.{dataset}.concept AS t3 
-            ON t2.gender_concept_id=t3.concept_id
-        """
-        
+            ,sex"""
 
 
-    
-class RaceQuery(LabelQuery):
+class RaceQuery(DemographicsQuery):
+    person_concepts = [('race', 'race_concept_id')]
+
     def get_query_config(self):
         return {
             "labeler_info":'OMOP standard concepts for race',
             "labeler_id":'race',
         }
-    
-    def get_base_query(self):
+
+    def get_label_columns(self):
+        return """
+            ,race"""
+
+
+class EthnicityQuery(DemographicsQuery):
+    person_concepts = [('ethnicity', 'ethnicity_concept_id')]
+
+    def get_query_config(self):
+        return {
+            "labeler_info":'OMOP standard concepts for ethnicity',
+            "labeler_id":'ethnicity',
+        }
+
+    def get_label_columns(self):
         return """
-        SELECT t1.person_id, {window_start_field}, {window_end_field}
-            ,t3.concept_name as race
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-        LEFT JOIN {dataset_project}.{dataset}.person AS t2
-            ON t1.person_id = t2.person_id
-        LEFT JOIN {dataset_project}.{dataset}.concept AS t3 
-            ON t2.race_concept_id=t3.concept_id
-        """
\ No newline at end of file
+            ,ethnicity"""
+
+
+class FusedDemographicsQuery(DemographicsQuery):
+    """
+    Computes the labels of several DemographicsQuery with a single join of the cohort
+    to person and concept. The output columns match those of the individual queries.
+    """
+
+    def __init__(self, queries, *args, **kwargs):
+        self.queries = list(queries)
+        super().__init__(*args, **kwargs)
+
+    def get_query_config(self):
+        return {
+            "labeler_info": 'fused demographics labelers: ' + ', '.join(
+                query.config['labeler_id'] for query in self.queries
+            ),
+            "labeler_id":'fused_demographics',
+        }
+
+    def get_base_query(self):
+        person_concepts = []
+        for query in self.queries:
+            person_concepts += [x for x in query.person_concepts if x not in person_concepts]
+
+        return self.get_demographics_query(
+            person_concepts,
+            "".join(query.get_label_columns() for query in self.queries),
+        )
@@ -1,6 +1,31 @@
 from .base import LabelQuery
 
 class DxLabelQuery(LabelQuery):
+    supports_window_horizons = True
+    
+    def get_label_columns(self):
+        """
+        Label columns of the first condition occurrence in the window, or in each window horizon
+        """
+        horizons = self.get_window_horizons()
+        if not horizons:
+            return """
+            ,CASE 
+                WHEN condition_concept_id IS NOT NULL THEN 1 
+                ELSE 0 
+            END AS {labeler_id}_label
+            ,condition_start_DATETIME AS {labeler_id}_start_datetime"""
+        
+        # the first occurrence falls in a horizon if it occurs before the horizon end
+        q_labels = ""
+        for name, end in horizons:
+            q_labels += f"""
+            ,CASE 
+                WHEN condition_start_DATETIME <= {end} THEN 1 
+                ELSE 0 
+            END AS {{labeler_id}}_label_{name}
+            ,IF(condition_start_DATETIME <= {end}, condition_start_DATETIME, NULL) AS {{labeler_id}}_start_datetime_{name}"""
+        return q_labels
     
     def get_base_query(self):
         return """
@@ -32,33 +57,123 @@ class DxLabelQuery(LabelQuery):
         ),
         condition_occurrences_in_window AS 
         (
-            SELECT t1.*
+            SELECT t1.{row_id}
                 ,co.condition_concept_id 
                 ,co.condition_start_DATETIME
                 ,ROW_NUMBER() OVER(
-                    PARTITION BY t1.person_id, t1.{window_start_field}, t1.{window_end_field} 
+                    PARTITION BY t1.{row_id} 
                     ORDER BY co.condition_start_datetime
                 ) AS rn
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1 
+            FROM {cohort_table} t1 
             INNER JOIN all_condition_occurrences co 
                 ON t1.person_id=co.person_id 
                 AND co.condition_start_datetime >= t1.{window_start_field} 
                 AND co.condition_start_datetime <= t1.{window_end_field}
         )
-        SELECT t1.* 
+        SELECT t1.{row_id} """ + self.get_label_columns() + """
+        FROM {cohort_table} t1 
+        LEFT JOIN condition_occurrences_in_window co 
+            ON t1.{row_id} = co.{row_id}
+            AND co.rn = 1
+        """
+
+    
+class FusedDxLabelQuery(LabelQuery):
+    """
+    Computes the labels of several DxLabelQuery in a single pass.
+    The concept sets are expanded into one map keyed by labeler_id, condition_occurrence 
+    is scanned once, and the labels of every query are pivoted with conditional aggregation.
+    The output columns match those of the individual queries.
+    """
+    supports_window_horizons = True
+    
+    def __init__(self, queries, *args, **kwargs):
+        self.queries = list(queries)
+        super().__init__(*args, **kwargs)
+        
+    def get_query_config(self):
+        return {
+            "labeler_info": 'fused diagnosis-based labelers: ' + ', '.join(
+                query.config['labeler_id'] for query in self.queries
+            ),
+            "labeler_id":'fused_dx',
+        }
+    
+    def get_concept_ids(self, query):
+        concept_ids = query.config['condition_concept_ids']
+        if isinstance(concept_ids, str):
+            return concept_ids
+        return ','.join([str(x) for x in concept_ids])
+    
+    def get_base_query(self):
+        q_seed = "\n\n                UNION ALL\n".join(
+            f"""
+                SELECT '{query.config['labeler_id']}' AS labeler_id, concept_id
+                FROM UNNEST([{self.get_concept_ids(query)}]) AS concept_id"""
+            for query in self.queries
+        )
+        
+        horizons = self.get_window_horizons() or [(None, None)]
+        
+        q_labels = ""
+        for query in self.queries:
+            labeler_id = query.config['labeler_id']
+            for name, end in horizons:
+                condition = f"co.labeler_id = '{labeler_id}'"
+                suffix = ""
+                if name is not None:
+                    condition += f" AND co.condition_start_DATETIME <= {end}"
+                    suffix = f"_{name}"
+                q_labels += f"""
             ,CASE 
-                WHEN condition_concept_id IS NOT NULL THEN 1 
+                WHEN COUNTIF({condition}) > 0 THEN 1 
                 ELSE 0 
-            END AS {labeler_id}_label
-            ,condition_start_DATETIME AS {labeler_id}_start_datetime
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1 
+            END AS {labeler_id}_label{suffix}
+            ,MIN(IF({condition}, co.condition_start_DATETIME, NULL)) AS {labeler_id}_start_datetime{suffix}"""
+        
+        return f"""
+        WITH seed_concepts AS 
+        ({q_seed}
+        ),
+        concepts AS 
+        (
+            SELECT DISTINCT labeler_id, concept_id 
+            FROM (
+                SELECT s.labeler_id, c.concept_id 
+                FROM `{{dataset_project}}.{{dataset}}.concept` c
+                INNER JOIN seed_concepts s ON c.concept_id = s.concept_id
+
+                UNION ALL 
+
+                SELECT s.labeler_id, c.concept_id
+                FROM `{{dataset_project}}.{{dataset}}.concept` c
+                INNER JOIN `{{dataset_project}}.{{dataset}}.concept_ancestor` ca 
+                  ON c.concept_id = ca.descendant_concept_id
+                  AND c.invalid_reason is null
+                INNER JOIN seed_concepts s ON ca.ancestor_concept_id = s.concept_id
+            )
+        ),
+        condition_occurrences_in_window AS 
+        (
+            SELECT t1.{{row_id}}
+                ,c.labeler_id
+                ,MIN(co.condition_start_DATETIME) AS condition_start_DATETIME
+            FROM {{cohort_table}} t1 
+            INNER JOIN `{{dataset_project}}.{{dataset}}.condition_occurrence` co
+                ON t1.person_id=co.person_id 
+                AND co.condition_start_datetime >= t1.{{window_start_field}} 
+                AND co.condition_start_datetime <= t1.{{window_end_field}}
+            INNER JOIN concepts c ON co.condition_concept_id=c.concept_id 
+            GROUP BY t1.{{row_id}}, c.labeler_id
+        )
+        SELECT t1.{{row_id}}{q_labels}
+        FROM {{cohort_table}} t1 
         LEFT JOIN condition_occurrences_in_window co 
-            ON t1.person_id = co.person_id
-            AND t1.{window_start_field} = co.{window_start_field}
-            AND t1.{window_end_field} = co.{window_end_field}
-            AND co.rn = 1
+            ON t1.{{row_id}} = co.{{row_id}}
+        GROUP BY t1.{{row_id}}
         """
     
+    
 class HypoglycemiaDxQuery(DxLabelQuery):
     def get_query_config(self):
          return {
@@ -1,28 +1,226 @@
 from .base import LabelQuery
 
 
-class HyperkalemiaQuery(LabelQuery):
+class ThresholdLabQuery(LabelQuery):
+    """
+    Shared query builder for lab-based labelers defined by thresholds on a measurement.
+    Subclasses implement get_measurement_query and define in their config:
+        - summary: (name, aggregate) summarizing the measurements in the window
+        - thresholds: list of (name, condition) pairs, one label per condition
+        - abnormal_threshold: reference range column reported for the first abnormal measurement
+        - sweep_direction: 'above' or 'below', the crossing direction used by threshold sweeps,
+          or None if the labels are not thresholds on value_as_number (no threshold sweeps)
+    The summary and the first measurement meeting each threshold are computed in a 
+    single GROUP BY over the measurements in the window. Measurements at the same time 
+    are ordered by severity, i.e. by decreasing value if the summary is a MAX.
+    With `window_horizons`, the measurements are scanned once up to the latest horizon end
+    and the labels are computed for each horizon.
+    """
+    supports_window_horizons = True
+    
+    def get_measurement_query(self):
+        """
+        CTEs ending with `all_measurements`, with one row per cohort row and measurement
+        """
+        raise NotImplementedError
+        
+    def get_in_window_query(self):
+        return """
+        in_window_measurements AS
+        (
+            SELECT *
+            FROM all_measurements
+            WHERE measurement_datetime >= {window_start_field} 
+                AND measurement_datetime <= {window_end_field} 
+        )"""
+    
+    def get_measurement_order(self):
+        """
+        Order of the measurements of a window, the most severe first among those at the same time
+        """
+        _, summary_aggregate = self.config['summary']
+        if summary_aggregate.strip().upper().startswith('MAX'):
+            return "measurement_datetime, value_as_number DESC"
+        return "measurement_datetime, value_as_number"
+    
+    def get_label_columns(self, source="", suffix=""):
+        """
+        Label columns computed from `threshold_measurements`, optionally qualified by 
+        the alias `source` and with names ending in `suffix`
+        """
+        summary_name, _ = self.config['summary']
+        prefix = f"{source}." if source else ""
+        
+        q_labels = f"""
+            ,{prefix}summary_value as {{labeler_id}}_{summary_name}{suffix}"""
+        for name, _ in self.config['thresholds']:
+            q_labels += f"""
+            ,{prefix}first_{name}.value_as_number as {{labeler_id}}_{name}_measurement{suffix}
+            ,{prefix}first_{name}.measurement_datetime as {{labeler_id}}_{name}_measurement_datetime{suffix}
+            ,case when {prefix}first_{name} is null then 0 else 1 end as {{labeler_id}}_{name}_label{suffix}"""
+        q_labels += f"""
+            ,{prefix}first_abnormal.{self.config['abnormal_threshold']} as {{labeler_id}}_abnormal_threshold{suffix}"""
+        return q_labels
+    
+    def get_threshold_query(self):
+        _, summary_aggregate = self.config['summary']
+        horizons = self.get_window_horizons()
+        
+        q_first = ""
+        for name, condition in self.config['thresholds']:
+            q_first += f"""
+                ,ARRAY_AGG(
+                    IF({condition}, STRUCT(value_as_number, measurement_datetime, range_low, range_high), NULL)
+                    IGNORE NULLS ORDER BY {self.get_measurement_order()} LIMIT 1
+                )[SAFE_OFFSET(0)] AS first_{name}"""
+        
+        if not horizons:
+            return f""",
+        threshold_measurements AS
+        (
+            SELECT {{row_id}}
+                ,{summary_aggregate} as summary_value{q_first}
+            FROM in_window_measurements
+            GROUP BY {{row_id}}
+        )
+        SELECT {{row_id}}{self.get_label_columns()}
+        FROM {{cohort_table}}
+        LEFT JOIN threshold_measurements USING ({{row_id}})
+        """
+        
+        # one group per cohort row and horizon, pivoted into columns suffixed by the horizon name
+        q_labels = ""
+        q_join = ""
+        for i, (name, _) in enumerate(horizons):
+            q_labels += self.get_label_columns(f"h_{i}", f"_{name}")
+            q_join += f"""
+        LEFT JOIN (
+            SELECT * FROM threshold_measurements WHERE horizon = '{name}'
+        ) h_{i} USING ({{row_id}})"""
+        
+        return f""",{self.get_horizon_ends_query()},
+        threshold_measurements AS
+        (
+            SELECT m.{{row_id}}, h.horizon
+                ,{summary_aggregate} as summary_value{q_first}
+            FROM in_window_measurements m
+            INNER JOIN horizon_ends h
+                ON m.{{row_id}} = h.{{row_id}}
+                AND m.measurement_datetime <= h.horizon_end
+            GROUP BY m.{{row_id}}, h.horizon
+        )
+        SELECT {{row_id}}{q_labels}
+        FROM {{cohort_table}}{q_join}
+        """
+    
+    def get_threshold_sweep_query(self, thresholds:list, inclusive:bool=False):
+        """
+        Query for the first measurement crossing each threshold of a grid, with one row per 
+        cohort row and threshold. Crossing is above the threshold if `sweep_direction` is 
+        'above' and below it otherwise, and reaching the threshold counts if inclusive 
+        (e.g. `<= 3.9` for mild hypoglycemia).
+        The in-window measurements are sorted once per cohort row and reduced to the running 
+        records (measurements beyond all earlier ones), since the first measurement crossing 
+        a threshold is always the first record crossing it.
+        """
+        if self.config['sweep_direction'] is None:
+            raise ValueError(f"Labeler {self.config['labeler_id']} does not support threshold sweeps")
+        
+        above = self.config['sweep_direction'] == 'above'
+        record_comparison = '>' if above else '<'
+        comparison = record_comparison + ('=' if inclusive else '')
+        running_aggregate = 'MAX' if above else 'MIN'
+        thresholds_str = ', '.join(str(float(x)) for x in thresholds)
+        measurement_order = self.get_measurement_order()
+        
+        return (
+            self.get_measurement_query().rstrip()
+            + ","
+            + self.get_in_window_query()
+            + f""",
+        record_measurements AS
+        (
+            SELECT {{row_id}}, value_as_number, measurement_datetime
+            FROM (
+                SELECT {{row_id}}, value_as_number, measurement_datetime
+                    ,{running_aggregate}(value_as_number) OVER(
+                        PARTITION BY {{row_id}} 
+                        ORDER BY {measurement_order}
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                    ) AS previous_record
+                FROM in_window_measurements
+                WHERE value_as_number IS NOT NULL
+            )
+            WHERE previous_record IS NULL 
+                OR value_as_number {record_comparison} previous_record
+        ),
+        threshold_crossings AS
+        (
+            SELECT {{row_id}}, threshold
+                ,ARRAY_AGG(
+                    STRUCT(value_as_number, measurement_datetime) 
+                    ORDER BY {measurement_order} LIMIT 1
+                )[OFFSET(0)] AS first_crossing
+            FROM record_measurements
+            CROSS JOIN UNNEST([{thresholds_str}]) AS threshold
+            WHERE value_as_number {comparison} threshold
+            GROUP BY {{row_id}}, threshold
+        )
+        SELECT t1.{{row_id}}
+            ,'{{labeler_id}}' as labeler_id
+            ,grid_threshold as threshold
+            ,case when tc.first_crossing is null then 0 else 1 end as label
+            ,tc.first_crossing.value_as_number as measurement
+            ,tc.first_crossing.measurement_datetime as measurement_datetime
+        FROM {{cohort_table}} t1
+        CROSS JOIN UNNEST([{thresholds_str}]) AS grid_threshold
+        LEFT JOIN threshold_crossings tc 
+            ON t1.{{row_id}} = tc.{{row_id}}
+            AND tc.threshold = grid_threshold
+        """
+        )
+    
+    def get_base_query(self):
+        return (
+            self.get_measurement_query().rstrip()
+            + ","
+            + self.get_in_window_query()
+            + self.get_threshold_query()
+        )
+
+
+class HyperkalemiaQuery(ThresholdLabQuery):
     def get_query_config(self):
         return {
             "labeler_info":'lab-based definition for hyperkalemia using blood potassium concentration (mmol/L). Thresholds: mild(>5.5),moderate(>6),severe(>7), and abnormal range.',
             "labeler_id":'hyperkalemia_lab',
             'extract_labs_from_flowsheets':False, 
             'flowsheets_extract_name':None,
+            'summary':('max_potassium', 'MAX(value_as_number)'),
+            'thresholds':[
+                ('mild', 'value_as_number > 5.5'),
+                ('moderate', 'value_as_number > 6.0'),
+                ('severe', 'value_as_number > 7'),
+                ('abnormal', 'value_as_number > range_high'),
+            ],
+            'abnormal_threshold':'range_high',
+            'sweep_direction':'above',
         }
     
-    def get_base_query(self):
+    def get_measurement_query(self):
         q_f = ""
         if self.config['extract_labs_from_flowsheets']:
             q_f+="""
             UNION ALL
-            SELECT t1.*
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
                 ,f.observation_datetime as measurement_datetime
                 ,CAST(f.meas_value AS FLOAT64) as value_as_number
                 ,NULL as range_low
                 ,NULL as range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{rs_dataset_project}.{rs_dataset}.{flowsheets_extract_name}` f
                 ON t1.person_id=f.person_id
+                AND f.observation_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
                 AND lower(f.display_name) like '%potassium%'
                 AND lower(f.units) = 'mmol/l'
                 AND lower(f.source_display_name) like '%lab%'
@@ -49,7 +247,7 @@ class HyperkalemiaQuery(LabelQuery):
         all_measurements AS
         (
             SELECT
-              t1.*, m.measurement_datetime
+              t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}, m.measurement_datetime
              ,CASE 
                   WHEN m.unit_concept_id = 8840 then m.value_as_number / 18
                   ELSE m.value_as_number 
@@ -62,9 +260,11 @@ class HyperkalemiaQuery(LabelQuery):
                   WHEN m.unit_concept_id = 8840 then m.range_high / 18
                   ELSE m.range_high 
               END AS range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
               on t1.person_id = m.person_id
+              AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+              {measurement_prune_str}
               AND m.unit_concept_id IN (
                     8753, -- mmol/L
                     9557, --mEq/L (1-to-1 -> mmol/L)
@@ -73,129 +273,43 @@ class HyperkalemiaQuery(LabelQuery):
             INNER JOIN measurement_concepts mc 
               ON m.measurement_concept_id = mc.concept_id
         """ + q_f + """
-        ),
-        max_measurements as 
-        (
-            SELECT person_id
-                ,{window_start_field}, {window_end_field}
-                ,max(value_as_number) as max_potassium
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-            GROUP BY person_id, {window_start_field}, {window_end_field}
-        ),
-        abnormal_measurements as 
-        (
-            SELECT person_id 
-                ,{window_start_field}, {window_end_field}
-                ,value_as_number
-                ,range_low,range_high
-                ,case when value_as_number > 5.5 then 1 else 0 end as mild 
-                ,case when value_as_number > 6.0 then 1 else 0 end as moderate 
-                ,case when value_as_number > 7 then 1 else 0 end as severe
-                ,case when value_as_number > range_high then 1 else 0 end as abnormal_range
-                ,measurement_datetime
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field}  
-                AND measurement_datetime <= {window_end_field} 
-                AND (value_as_number > 5.5 OR value_as_number > range_high)
-        ),
-        mild as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, mild
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE mild = 1
-        ), 
-        moderate as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, moderate
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE moderate = 1
-        ),
-        severe as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, severe
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE severe = 1
-        ),
-        abnormal_range as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, abnormal_range
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-                ,range_low, range_high
-            FROM abnormal_measurements 
-            WHERE abnormal_range = 1
-        ),
-        first_mild as (select * from mild where rn = 1),
-        first_moderate as (select * from moderate where rn = 1),
-        first_severe as (select * from severe where rn = 1),
-        first_abnormal_range as (select * from abnormal_range where rn = 1)
-        SELECT person_id, {window_start_field}, {window_end_field} 
-            ,max_potassium as {labeler_id}_max_potassium
-            ,first_mild.value_as_number as {labeler_id}_mild_measurement
-            ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
-            ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
-            ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
-            ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
-            ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
-            ,first_severe.value_as_number as {labeler_id}_severe_measurement
-            ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
-            ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
-            ,first_abnormal_range.value_as_number as {labeler_id}_abnormal_measurement
-            ,first_abnormal_range.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
-            ,case when abnormal_range is null then 0 else abnormal_range end as {labeler_id}_abnormal_label
-            ,range_high as {labeler_id}_abnormal_threshold
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        LEFT JOIN max_measurements using (person_id, {window_start_field}, {window_end_field}) 
-        LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_abnormal_range using (person_id, {window_start_field}, {window_end_field})
+        )
         """
-        
-        
-class HypoglycemiaQuery(LabelQuery):
+
+
+class HypoglycemiaQuery(ThresholdLabQuery):
     def get_query_config(self):
         return {
             "labeler_info":'lab-based definition for hypoglycemia using blood glucose concentration (mmol/L). Thresholds: mild(<3), moderate(<3.5), severe(<=3.9), and abnormal range.',
             "labeler_id":'hypoglycemia_lab',
             'extract_labs_from_flowsheets':False, 
             'flowsheets_extract_name':None,
+            'summary':('min_glucose', 'MIN(value_as_number)'),
+            'thresholds':[
+                ('mild', 'value_as_number <= 3.9'),
+                ('moderate', 'value_as_number < 3.5'),
+                ('severe', 'value_as_number < 3'),
+                ('abnormal', 'value_as_number < range_low'),
+            ],
+            'abnormal_threshold':'range_low',
+            'sweep_direction':'below',
         }
     
-    def get_base_query(self):
+    def get_measurement_query(self):
         
         q_f = ""
         if self.config['extract_labs_from_flowsheets']:
             q_f+="""
             UNION ALL
-            SELECT t1.*
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
                 ,f.observation_datetime as measurement_datetime
                 ,CAST(f.meas_value AS FLOAT64)/18 as value_as_number
                 ,NULL as range_low
                 ,NULL as range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{rs_dataset_project}.{rs_dataset}.{flowsheets_extract_name}` f
                 ON t1.person_id=f.person_id
+                AND f.observation_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
                 AND lower(f.display_name) like '%glucose%'
                 AND lower(f.units) = 'mg/dl' --divide by 18 to get mmol/L
                 AND lower(f.source_display_name) like '%lab%'
@@ -222,7 +336,7 @@ class HypoglycemiaQuery(LabelQuery):
         all_measurements AS
         (
             SELECT
-              t1.*, m.measurement_datetime
+              t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}, m.measurement_datetime
               ,CASE
                   WHEN m.unit_concept_id IN (8840, 9028) THEN m.value_as_number / 18 
                   ELSE m.value_as_number
@@ -235,9 +349,11 @@ class HypoglycemiaQuery(LabelQuery):
                   WHEN m.unit_concept_id IN (8840, 9028) THEN m.range_high / 18 
                   ELSE m.range_high
               END AS range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
               on t1.person_id = m.person_id
+              AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+              {measurement_prune_str}
               AND m.unit_concept_id IN (
                   8840, -- mg/dL
                   9028, -- mg/dL calculated
@@ -246,133 +362,50 @@ class HypoglycemiaQuery(LabelQuery):
             INNER JOIN measurement_concepts mc 
               ON m.measurement_concept_id = mc.concept_id
         """ + q_f + """
-        ),
-        min_measurements as 
-        (
-            SELECT person_id
-                ,{window_start_field}, {window_end_field}
-                ,min(value_as_number) as hg_min_glucose
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-            GROUP BY person_id, {window_start_field}, {window_end_field}
-        ),
-        abnormal_measurements as 
-        (
-            SELECT person_id 
-                ,{window_start_field}, {window_end_field}
-                ,value_as_number
-                ,range_low,range_high
-                ,case when value_as_number <= 3.9 then 1 else 0 end as mild 
-                ,case when value_as_number < 3.5 then 1 else 0 end as moderate 
-                ,case when value_as_number < 3 then 1 else 0 end as severe
-                ,case when value_as_number < range_low then 1 else 0 end as abnormal_range
-                ,measurement_datetime
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-                AND (value_as_number <= 3.9 OR value_as_number < range_low)
-        ),
-        mild as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, mild
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE mild = 1
-        ), 
-        moderate as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, moderate
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE moderate = 1
-        ),
-        severe as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, severe
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE severe = 1
-        ),
-        abnormal_range as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, abnormal_range
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-                ,range_low, range_high
-            FROM abnormal_measurements 
-            WHERE abnormal_range = 1
-        ),
-        first_mild as (select * from mild where rn = 1),
-        first_moderate as (select * from moderate where rn = 1),
-        first_severe as (select * from severe where rn = 1),
-        first_abnormal_range as (select * from abnormal_range where rn = 1)
-        SELECT person_id, {window_start_field}, {window_end_field} 
-            ,hg_min_glucose as {labeler_id}_min_glucose
-            ,first_mild.value_as_number as {labeler_id}_mild_measurement
-            ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
-            ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
-            ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
-            ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
-            ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
-            ,first_severe.value_as_number as {labeler_id}_severe_measurement
-            ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
-            ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
-            ,first_abnormal_range.value_as_number as {labeler_id}_abnormal_measurement
-            ,first_abnormal_range.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
-            ,case when abnormal_range is null then 0 else abnormal_range end as {labeler_id}_abnormal_label
-            ,range_low as {labeler_id}_abnormal_threshold
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        LEFT JOIN min_measurements using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_abnormal_range using (person_id, {window_start_field}, {window_end_field})
+        )
         """
 
 
-class AcuteKidneyInjuryQuery(LabelQuery):
+class AcuteKidneyInjuryQuery(ThresholdLabQuery):
     def get_query_config(self):
         return {
             "labeler_info":'lab-based definition for acute kidney injury based on blood creatinine levels (umol/L) according to KDIGO (stages 1,2, and 3), and abnormal range.',
             "labeler_id":'aki_lab',
             'extract_labs_from_flowsheets':False, 
             'flowsheets_extract_name':None,
+            'summary':('max_creatinine', 'MAX(value_as_number)'),
+            'thresholds':[
+                ('aki1', '(value_as_number/baseline_value >= 1.5 OR value_as_number-baseline_value >= 26.52)'),
+                ('aki2', 'value_as_number/baseline_value >= 2.0'),
+                ('aki3', '(value_as_number/baseline_value >= 3.0 OR value_as_number-baseline_value >= 353.6)'),
+                ('abnormal', 'value_as_number > range_high'),
+            ],
+            'abnormal_threshold':'range_high',
+            # thresholds are relative to the baseline creatinine
+            'sweep_direction':None,
+            'lookback_days':90,
         }
     
-    def get_base_query(self):
+    def get_measurement_query(self):
         q_f = ""
         if self.config['extract_labs_from_flowsheets']:
             q_f+="""
             UNION ALL
-            SELECT t1.*
+            SELECT f.person_id
                 ,f.observation_datetime as measurement_datetime
                 ,CAST(f.meas_value AS FLOAT64)/ 0.0113122  as value_as_number
                 ,NULL as range_low
                 ,NULL as range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-            LEFT JOIN `{rs_dataset_project}.{rs_dataset}.{flowsheets_extract_name}` f
-                ON t1.person_id=f.person_id
+            FROM `{rs_dataset_project}.{rs_dataset}.{flowsheets_extract_name}` f
+            WHERE f.person_id IN (SELECT person_id FROM {cohort_table})
                 AND lower(f.display_name) like '%creatinine%'
                 AND lower(f.units) = 'mg/dl' -- divide by 0.0113122 to get umol/L 
                 AND lower(f.source_display_name) like '%lab%'
             """
         
+        # RANGE frames are defined on UNIX_MICROS, which requires a literal offset
+        lookback_micros = int(self.config['lookback_days']) * 24 * 60 * 60 * 1000000
+        
         return """
         WITH measurement_concepts as (
             SELECT 
@@ -390,10 +423,11 @@ class AcuteKidneyInjuryQuery(LabelQuery):
                 AND ca.ancestor_concept_id in (37029387,4013964,2212294,3051825)
                 AND c.invalid_reason is null 
         ),
-        all_measurements AS
+        -- creatinine series of each person in the cohort, independent of the admissions
+        person_measurements AS
         (
         SELECT
-          t1.*, m.measurement_datetime
+          m.person_id, m.measurement_datetime
           ,case 
               when unit_concept_id = 8840 then value_as_number / 0.0113122 
               when unit_concept_id = 8837 then value_as_number * 0.001 / 0.0113122 
@@ -406,190 +440,121 @@ class AcuteKidneyInjuryQuery(LabelQuery):
               when unit_concept_id = 8840 then range_low / 0.0113122 
               when unit_concept_id = 8837 then range_low * 0.001 / 0.0113122 
           else range_low end as range_low
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-        LEFT JOIN {dataset_project}.{dataset}.measurement m
-            ON t1.person_id = m.person_id
+        FROM {dataset_project}.{dataset}.measurement m
+        INNER JOIN measurement_concepts mc 
+            ON m.measurement_concept_id = mc.concept_id
+        WHERE m.person_id IN (SELECT person_id FROM {cohort_table})
             AND m.unit_concept_id IN (
                 8749,  -- umol/l (x0.0113122 to get mg/dl)
                 8840,  -- mg/dl
                 8837   -- ug/dl (x0.001 to get mg/dl)
               )
-        INNER JOIN measurement_concepts mc 
-            ON m.measurement_concept_id = mc.concept_id
+            {measurement_prune_str}
         """ + q_f + """
         ),
+        all_measurements AS
+        (
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
+                ,m.measurement_datetime, m.value_as_number, m.range_low, m.range_high
+            FROM {cohort_table} t1
+            INNER JOIN person_measurements m
+                ON t1.person_id = m.person_id
+                AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+        ),
         -- GET BASELINE CREATININE MEASUREMENTS (MIN MEASUREMENT BETWEEN ADMISSION TIME AND 3 MONTHS PRIOR)
+        -- each window start is an anchor row in the creatinine series of the person, so the 
+        -- lookback of every admission is computed by a single ordered window per person
         base_3month as (
-            SELECT person_id,{window_start_field}, {window_end_field}
-                ,MIN(m.value_as_number) as value_as_number
-            FROM all_measurements m 
-            WHERE measurement_datetime >= date_add({window_start_field}, INTERVAL -90 day)
-                AND measurement_datetime < {window_start_field} 
-            GROUP BY person_id, {window_start_field}, {window_end_field}
+            SELECT {row_id}, value_as_number
+            FROM (
+                SELECT {row_id}
+                    ,MIN(value_as_number) OVER (
+                        PARTITION BY person_id 
+                        ORDER BY event_micros
+                        RANGE BETWEEN """ + str(lookback_micros) + """ PRECEDING AND 1 PRECEDING
+                    ) as value_as_number
+                FROM (
+                    SELECT person_id, {row_id}
+                        ,UNIX_MICROS(TIMESTAMP({window_start_field})) as event_micros
+                        ,CAST(NULL AS FLOAT64) as value_as_number
+                    FROM {cohort_table}
+                    
+                    UNION ALL
+                    
+                    SELECT person_id, NULL as {row_id}
+                        ,UNIX_MICROS(TIMESTAMP(measurement_datetime)) as event_micros
+                        ,value_as_number
+                    FROM person_measurements
+                )
+            )
+            WHERE {row_id} IS NOT NULL
         ),
+        """ + self.get_person_dimension_query().strip() + """,
         base_by_age_norm as (
-            SELECT m.person_id,{window_start_field},{window_end_field}
+            SELECT {row_id}
                 ,CASE 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN 0 AND 14 THEN 0.92 / 0.0113122 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN 15 AND (2*365-1) THEN 0.36 / 0.0113122 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (2*365) AND (5*365-1) THEN 0.43 / 0.0113122 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (5*365) AND (12*365-1) THEN 0.61 / 0.0113122 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (12*365) AND (15*365-1) THEN 0.81 / 0.0113122 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (15*365) AND (19*365-1) THEN 0.84 / 0.0113122 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) >= (19*365) AND gender_concept_id=8532 THEN 1.1 / 0.0113122 
-                    WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) >= (19*365) AND gender_concept_id<>8532 THEN 1.2 / 0.0113122
+                    WHEN age_days BETWEEN 0 AND 14 THEN 0.92 / 0.0113122 
+                    WHEN age_days BETWEEN 15 AND (2*365-1) THEN 0.36 / 0.0113122 
+                    WHEN age_days BETWEEN (2*365) AND (5*365-1) THEN 0.43 / 0.0113122 
+                    WHEN age_days BETWEEN (5*365) AND (12*365-1) THEN 0.61 / 0.0113122 
+                    WHEN age_days BETWEEN (12*365) AND (15*365-1) THEN 0.81 / 0.0113122 
+                    WHEN age_days BETWEEN (15*365) AND (19*365-1) THEN 0.84 / 0.0113122 
+                    WHEN age_days >= (19*365) AND gender_concept_id=8532 THEN 1.1 / 0.0113122 
+                    WHEN age_days >= (19*365) AND gender_concept_id<>8532 THEN 1.2 / 0.0113122
                     ELSE NULL
                 END AS value_as_number
-            FROM (SELECT DISTINCT person_id, {window_start_field}, {window_end_field} FROM all_measurements) m
-            LEFT JOIN `{dataset_project}.{dataset}.person` person
-                ON m.person_id=person.person_id
+            FROM person_dimension
         ),
         base_measurements as (
-            SELECT b_age.person_id, b_age.{window_start_field}, b_age.{window_end_field} 
+            SELECT b_age.{row_id}
                 ,COALESCE(b_3month.value_as_number, b_age.value_as_number) as value_as_number
             FROM base_by_age_norm b_age 
-            LEFT JOIN base_3month b_3month 
-                ON b_age.person_id=b_3month.person_id 
-                AND b_age.{window_start_field}=b_3month.{window_start_field}
-                AND b_age.{window_end_field}=b_3month.{window_end_field}
-        ),
-        max_measurements as (
-            SELECT m.person_id, {window_start_field}, {window_end_field}
-                ,MAX(m.value_as_number) as aki_max_creatinine
-            FROM all_measurements m 
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-            GROUP BY person_id, {window_start_field}, {window_end_field}
-        ),
-        abnormal_measurements as
-        (
-            SELECT person_id 
-                ,{window_start_field}, {window_end_field}
-                ,m.value_as_number
-                ,range_low,range_high
-                ,case when (
-                    m.value_as_number/b.value_as_number >= 1.5
-                    OR m.value_as_number-b.value_as_number >= 26.52
-                ) then 1 else 0 end as mild 
-                ,case when (
-                    m.value_as_number/b.value_as_number >= 2.0
-                ) then 1 else 0 end as moderate 
-                ,case when (
-                    m.value_as_number/b.value_as_number >= 3.0 
-                    OR m.value_as_number-b.value_as_number >= 353.6
-                ) then 1 else 0 end as severe
-                ,case when m.value_as_number > range_high then 1 else 0 end as abnormal_range
-                ,measurement_datetime
-            FROM all_measurements m
-            LEFT JOIN base_measurements b USING (person_id, {window_start_field}, {window_end_field})
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field}  
-                AND (
-                    (
-                        m.value_as_number/b.value_as_number >= 1.5
-                        OR m.value_as_number-b.value_as_number >= 26.52
-                    )
-                    OR
-                    (
-                        m.value_as_number > range_high
-                    )
-                )
-        ),
-        mild as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, mild
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE mild = 1
-        ), 
-        moderate as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, moderate
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE moderate = 1
-        ),
-        severe as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, severe
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE severe = 1
-        ),
-        abnormal_range as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, abnormal_range
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-                ,range_low, range_high
-            FROM abnormal_measurements 
-            WHERE abnormal_range = 1
-        ),
-        first_mild as (select * from mild where rn = 1),
-        first_moderate as (select * from moderate where rn = 1),
-        first_severe as (select * from severe where rn = 1),
-        first_abnormal_range as (select * from abnormal_range where rn = 1)
-        SELECT person_id, {window_start_field}, {window_end_field} 
-            ,aki_max_creatinine as {labeler_id}_max_creatinine
-            ,first_mild.value_as_number as {labeler_id}_aki1_measurement
-            ,first_mild.measurement_datetime as {labeler_id}_aki1_measurement_datetime
-            ,case when mild is null then 0 else mild end as {labeler_id}_aki1_label
-            ,first_moderate.value_as_number as {labeler_id}_aki2_measurement
-            ,first_moderate.measurement_datetime as {labeler_id}_aki2_measurement_datetime
-            ,case when moderate is null then 0 else moderate end as {labeler_id}_aki2_label
-            ,first_severe.value_as_number as {labeler_id}_aki3_measurement
-            ,first_severe.measurement_datetime as {labeler_id}_aki3_measurement_datetime
-            ,case when severe is null then 0 else severe end as {labeler_id}_aki3_label
-            ,first_abnormal_range.value_as_number as {labeler_id}_abnormal_measurement
-            ,first_abnormal_range.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
-            ,case when abnormal_range is null then 0 else abnormal_range end as {labeler_id}_abnormal_label
-            ,range_high as {labeler_id}_abnormal_threshold
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        LEFT JOIN max_measurements using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_abnormal_range using (person_id, {window_start_field}, {window_end_field})
+            LEFT JOIN base_3month b_3month USING ({row_id})
+        )
         """
     
-    
-class HyponatremiaQuery(LabelQuery):
+    def get_in_window_query(self):
+        return """
+        in_window_measurements AS
+        (
+            SELECT m.*, b.value_as_number as baseline_value
+            FROM all_measurements m
+            LEFT JOIN base_measurements b USING ({row_id})
+        )"""
+
+
+class HyponatremiaQuery(ThresholdLabQuery):
     def get_query_config(self):
         return {
             "labeler_info":'lab-based definition for hyponatremia based on blood sodium concentration (mmol/L). Thresholds: mild (<=135),moderate(<130),severe(<125), and abnormal range.',
             "labeler_id":'hyponatremia_lab',
             'extract_labs_from_flowsheets':False, 
             'flowsheets_extract_name':None,
+            'summary':('min_sodium', 'MIN(value_as_number)'),
+            'thresholds':[
+                ('mild', 'value_as_number <= 135'),
+                ('moderate', 'value_as_number < 130'),
+                ('severe', 'value_as_number < 125'),
+                ('abnormal', 'value_as_number < range_low'),
+            ],
+            'abnormal_threshold':'range_low',
+            'sweep_direction':'below',
         }
     
-    def get_base_query(self):
+    def get_measurement_query(self):
         q_f = ""
         if self.config['extract_labs_from_flowsheets']:
             q_f+="""
             UNION ALL
-            SELECT t1.*
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
                 ,f.observation_datetime as measurement_datetime
                 ,CAST(f.meas_value AS FLOAT64) as value_as_number
                 ,NULL as range_low
                 ,NULL as range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{rs_dataset_project}.{rs_dataset}.{flowsheets_extract_name}` f
                 ON t1.person_id=f.person_id
+                AND f.observation_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
                 AND lower(f.display_name) like '%sodium%'
                 AND lower(f.units) = 'mmol/l'
                 AND lower(f.source_display_name) like '%lab%'
@@ -616,12 +581,14 @@ class HyponatremiaQuery(LabelQuery):
         all_measurements AS
         (
             SELECT
-              t1.*, m.measurement_datetime
+              t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}, m.measurement_datetime
              ,m.value_as_number
              ,range_low, range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
               on t1.person_id = m.person_id
+              AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+              {measurement_prune_str}
               AND m.unit_concept_id IN (
                 8753, -- mmol/L
                 9557 --mEq/L (1-to-1 -> mmol/L)
@@ -629,128 +596,42 @@ class HyponatremiaQuery(LabelQuery):
             INNER JOIN measurement_concepts mc 
               ON m.measurement_concept_id = mc.concept_id
         """ + q_f + """
-        ),
-        min_measurements as 
-        (
-            SELECT person_id
-                ,{window_start_field}, {window_end_field}
-                ,min(value_as_number) as hn_min_sodium
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-            GROUP BY person_id, {window_start_field}, {window_end_field}
-        ),
-        abnormal_measurements as 
-        (
-            SELECT person_id 
-                ,{window_start_field}, {window_end_field}
-                ,value_as_number
-                ,range_low,range_high
-                ,case when value_as_number <= 135 then 1 else 0 end as mild 
-                ,case when value_as_number < 130 then 1 else 0 end as moderate 
-                ,case when value_as_number < 125 then 1 else 0 end as severe
-                ,case when value_as_number < range_low then 1 else 0 end as abnormal_range
-                ,measurement_datetime
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-                AND (value_as_number <= 135 OR value_as_number < range_low)
-        ),
-        mild as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, mild
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE mild = 1
-        ), 
-        moderate as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, moderate
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE moderate = 1
-        ),
-        severe as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, severe
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE severe = 1
-        ),
-        abnormal_range as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, abnormal_range
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-                ,range_low, range_high
-            FROM abnormal_measurements 
-            WHERE abnormal_range = 1
-        ),
-        first_mild as (select * from mild where rn = 1),
-        first_moderate as (select * from moderate where rn = 1),
-        first_severe as (select * from severe where rn = 1),
-        first_abnormal_range as (select * from abnormal_range where rn = 1)
-        SELECT person_id, {window_start_field}, {window_end_field} 
-            ,hn_min_sodium as {labeler_id}_min_sodium
-            ,first_mild.value_as_number as {labeler_id}_mild_measurement
-            ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
-            ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
-            ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
-            ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
-            ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
-            ,first_severe.value_as_number as {labeler_id}_severe_measurement
-            ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
-            ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
-            ,first_abnormal_range.value_as_number as {labeler_id}_abnormal_measurement
-            ,first_abnormal_range.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
-            ,case when abnormal_range is null then 0 else abnormal_range end as {labeler_id}_abnormal_label
-            ,range_low as {labeler_id}_abnormal_threshold
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        LEFT JOIN min_measurements using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_abnormal_range using (person_id, {window_start_field}, {window_end_field})
+        )
         """
-    
-    
-class AnemiaQuery(LabelQuery):
+
+
+class AnemiaQuery(ThresholdLabQuery):
     def get_query_config(self):
         return {
             "labeler_info":'lab-based definition for anemia based on hemoglobin levels (g/L). Thresholds: mild(<120),moderate(<110),severe(<70), and reference range',
             "labeler_id":'anemia_lab',
             'extract_labs_from_flowsheets':False, 
             'flowsheets_extract_name':None,
+            'summary':('min_hgb', 'MIN(value_as_number)'),
+            'thresholds':[
+                ('mild', 'value_as_number < 120'),
+                ('moderate', 'value_as_number < 110'),
+                ('severe', 'value_as_number < 70'),
+                ('abnormal', 'value_as_number < range_low'),
+            ],
+            'abnormal_threshold':'range_low',
+            'sweep_direction':'below',
         }
     
-    def get_base_query(self):
+    def get_measurement_query(self):
         q_f = ""
         if self.config['extract_labs_from_flowsheets']:
             q_f+="""
             UNION ALL
-            SELECT t1.*
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
                 ,f.observation_datetime as measurement_datetime
                 ,CAST(f.meas_value AS FLOAT64)*10 as value_as_number
                 ,NULL as range_low
                 ,NULL as range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{rs_dataset_project}.{rs_dataset}.{flowsheets_extract_name}` f
                 ON t1.person_id=f.person_id
+                AND f.observation_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
                 AND (
                     lower(f.display_name) like '%hemoglobin%'
                     OR lower(f.display_name) like '%hgb%'
@@ -780,7 +661,7 @@ class AnemiaQuery(LabelQuery):
         all_measurements AS
         (
             SELECT
-              t1.*, m.measurement_datetime
+              t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}, m.measurement_datetime
              ,case 
                   when m.unit_concept_id = 8840 then m.value_as_number / 100
                   else m.value_as_number * 10
@@ -794,9 +675,11 @@ class AnemiaQuery(LabelQuery):
                   else m.range_low * 10
               end as range_low
                
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
               on t1.person_id = m.person_id
+              AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+              {measurement_prune_str}
               AND m.unit_concept_id IN (
                 8713 -- g / dL
                 ,8840 -- mg / dL (divide by 1000 to get g/dL)
@@ -804,392 +687,216 @@ class AnemiaQuery(LabelQuery):
             INNER JOIN measurement_concepts mc 
               ON m.measurement_concept_id = mc.concept_id
         """ + q_f + """
-        ),
-        min_measurements as 
-        (
-            SELECT person_id
-                ,{window_start_field}, {window_end_field}
-                ,min(value_as_number) as anemia_min_hgb
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-            GROUP BY person_id, {window_start_field}, {window_end_field}
-        ),
-        abnormal_measurements as 
-        (
-            SELECT person_id 
-                ,{window_start_field}, {window_end_field}
-                ,value_as_number
-                ,range_low,range_high
-                ,case when value_as_number < 120 then 1 else 0 end as mild 
-                ,case when value_as_number < 110 then 1 else 0 end as moderate 
-                ,case when value_as_number < 70 then 1 else 0 end as severe
-                ,case when value_as_number < range_low then 1 else 0 end as abnormal_range
-                ,measurement_datetime
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-                AND (value_as_number < 120 OR value_as_number < range_low)
-        ),
-        mild as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, mild
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE mild = 1
-        ), 
-        moderate as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, moderate
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE moderate = 1
-        ),
-        severe as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, severe
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE severe = 1
-        ),
-        abnormal_range as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, abnormal_range
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-                ,range_low, range_high
-            FROM abnormal_measurements 
-            WHERE abnormal_range = 1
-        ),
-        first_mild as (select * from mild where rn = 1),
-        first_moderate as (select * from moderate where rn = 1),
-        first_severe as (select * from severe where rn = 1),
-        first_abnormal_range as (select * from abnormal_range where rn = 1)
-        SELECT person_id, {window_start_field}, {window_end_field} 
-            ,anemia_min_hgb as {labeler_id}_min_hgb
-            ,first_mild.value_as_number as {labeler_id}_mild_measurement
-            ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
-            ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
-            ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
-            ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
-            ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
-            ,first_severe.value_as_number as {labeler_id}_severe_measurement
-            ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
-            ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
-            ,first_abnormal_range.value_as_number as {labeler_id}_abnormal_measurement
-            ,first_abnormal_range.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
-            ,case when abnormal_range is null then 0 else abnormal_range end as {labeler_id}_abnormal_label
-            ,range_low as {labeler_id}_abnormal_threshold
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        LEFT JOIN min_measurements using (person_id, {window_start_field}, {window_end_field}) 
-        LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_abnormal_range using (person_id, {window_start_field}, {window_end_field})
+        )
         """
-    
-    
-class NeutropeniaQuery(LabelQuery):
+
+
+class NeutropeniaQuery(ThresholdLabQuery):
     def get_query_config(self):
         return {
             "labeler_info":'lab-based definition for neutropenia based on neutrophils count (thousands/uL). Thresholds: mild(<1.5), moderate(<1), severe(<0.5).',
             "labeler_id":'neutropenia_lab',
+            'summary':('min_neutrophils', 'MIN(neutrophils_count)'),
+            'thresholds':[
+                ('mild', 'value_as_number < 1.5'),
+                ('moderate', 'value_as_number < 1'),
+                ('severe', 'value_as_number < 0.500'),
+                ('abnormal', 'value_as_number < range_low AND value_as_number < 1.5'),
+            ],
+            'abnormal_threshold':'range_low',
+            'sweep_direction':'below',
         }
     
-    def get_base_query(self):
+    def get_measurement_query(self):
         return """
-        -- WBC (LEUKOCYTES)
-        WITH wbc_concepts as 
+        -- WBC (LEUKOCYTES), BANDS AND NEUTROPHILS
+        WITH analyte_concepts as 
         (
             SELECT 
-                c.concept_id, 'wbc' as concept_name
+                'wbc' as analyte, c.concept_id
             FROM `{dataset_project}.{dataset}.concept` c
-            WHERE concept_id IN (3000905, 4298431, 3010813)       
-        ),
-        all_wbc as 
-        (
-          SELECT t1.*
-              ,m.measurement_datetime
-              ,CASE
-                  WHEN unit_concept_id = 8647 THEN m.value_as_number/1000
-                  ELSE m.value_as_number
-              END as wbc
-          FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-          LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
-              ON t1.person_id = m.person_id
-              AND m.unit_concept_id IN (
-                8848,  -- 1000/uL
-                8961,  -- 1000/mm^3, equivalent to 8848
-                8647   -- /uL - divide by 1000 to convert to 1000/uL
-              )
-          INNER JOIN wbc_concepts mc 
-              on m.measurement_concept_id = mc.concept_id
-        ),
-        -- BANDS
-        bands_concepts as 
-        (
+            WHERE concept_id IN (3000905, 4298431, 3010813)
+            
+            UNION ALL
+            
             -- 3035839 band form /100 leukocytes (%)
             -- 3018199 band form neutrophils in blood (count) 
             SELECT 
-                c.concept_id, concept_name
+                'bands' as analyte, c.concept_id
             FROM `{dataset_project}.{dataset}.concept` c
             WHERE concept_id in (3035839, 3018199)
-        ),
-        all_bands as
-        (
-            SELECT t1.*
-                ,m.measurement_datetime 
-                ,CASE 
-                    WHEN m.measurement_concept_id = 3035839 AND m.value_as_number<=100
-                      THEN m.value_as_number / 100 * wbc.wbc
-                    WHEN m.measurement_concept_id = 3018199 AND m.unit_concept_id = 8784 
-                      THEN m.value_as_number / 1000
-                    ELSE NULL
-                END AS bands_count
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-            LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
-                ON t1.person_id = m.person_id
-            INNER JOIN bands_concepts mc 
-                ON m.measurement_concept_id = mc.concept_id
-            LEFT JOIN all_wbc wbc 
-                ON m.person_id = wbc.person_id
-                AND m.measurement_datetime = wbc.measurement_datetime
-        ),
-        -- NEUTROPHILS
-        neutrophils_concepts as 
-        (
+            
+            UNION ALL
+            
             SELECT 
-                c.concept_id, concept_name
-            FROM `{dataset_project}.{dataset}.concept` c
-            WHERE concept_id in (37045722, 37049637)
+                'neutrophils' as analyte, concept_id
+            FROM (
+                SELECT 
+                    c.concept_id
+                FROM `{dataset_project}.{dataset}.concept` c
+                WHERE concept_id in (37045722, 37049637)
 
-            UNION DISTINCT 
+                UNION DISTINCT 
 
-            SELECT 
-                c.concept_id, concept_name
-            FROM `{dataset_project}.{dataset}.concept` c
-            INNER JOIN `{dataset_project}.{dataset}.concept_ancestor` ca 
-                ON c.concept_id = ca.descendant_concept_id
-                AND ca.ancestor_concept_id in (37045722, 37049637)
-                AND c.invalid_reason is null 
+                SELECT 
+                    c.concept_id
+                FROM `{dataset_project}.{dataset}.concept` c
+                INNER JOIN `{dataset_project}.{dataset}.concept_ancestor` ca 
+                    ON c.concept_id = ca.descendant_concept_id
+                    AND ca.ancestor_concept_id in (37045722, 37049637)
+                    AND c.invalid_reason is null 
+            )
+        ),
+        all_analytes as 
+        (
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
+                ,m.measurement_datetime
+                ,ac.analyte
+                ,m.measurement_concept_id
+                ,m.unit_concept_id
+                ,m.value_as_number
+                ,m.range_low
+                ,m.range_high
+            FROM {cohort_table} t1
+            INNER JOIN `{dataset_project}.{dataset}.measurement` m 
+                ON t1.person_id = m.person_id
+                AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+                {measurement_prune_str}
+            INNER JOIN analyte_concepts ac 
+                ON m.measurement_concept_id = ac.concept_id
+            WHERE (
+                    ac.analyte = 'wbc' AND m.unit_concept_id IN (
+                        8848,  -- 1000/uL
+                        8961,  -- 1000/mm^3, equivalent to 8848
+                        8647   -- /uL - divide by 1000 to convert to 1000/uL
+                    )
+                )
+                OR ac.analyte = 'bands'
+                OR (
+                    ac.analyte = 'neutrophils' AND m.unit_concept_id in (
+                        8848, -- 1000/uL
+                        8554, -- %
+                        8784, -- cells/uL
+                        8961 -- 1000/mm^3
+                    )
+                )
         ),
-        all_neutrophils as 
-        (
-            SELECT t1.*
-              ,m.measurement_datetime 
-              ,CASE 
-                  -- neutrophils /100 leukocytes
-                  WHEN m.unit_concept_id = 8554 AND m.value_as_number<=100
-                      THEN m.value_as_number / 100 * wbc.wbc
-                  WHEN m.unit_concept_id = 8554 AND m.value_as_number>100
-                      THEN NULL
-                  WHEN m.unit_concept_id = 8784  
-                      THEN m.value_as_number / 1000
-                  ELSE m.value_as_number
-              END AS neutrophils_count
-              ,case 
-                  when m.unit_concept_id = 8554 AND m.range_high<=100
-                      THEN m.range_high / 100 * wbc.wbc
-                  WHEN m.unit_concept_id = 8554 AND m.range_high>100
-                      THEN NULL
-                  WHEN m.unit_concept_id = 8784
-                      THEN m.range_high / 1000
-                  else m.range_high
-              end as range_high
-              ,case 
-                  when m.unit_concept_id = 8554 AND m.range_low<=100
-                      THEN m.range_low / 100 * wbc.wbc
-                  WHEN m.unit_concept_id = 8554 AND m.range_low>100
-                      THEN NULL
-                  WHEN m.unit_concept_id = 8784
-                      THEN m.range_low / 1000
-                  else m.range_low
-              end as range_low
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-            LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
-              ON t1.person_id = m.person_id
-              AND m.unit_concept_id in (
-                  8848, -- 1000/uL
-                  8554, -- %
-                  8784, -- cells/uL
-                  8961 -- 1000/mm^3
-              )
-            INNER JOIN neutrophils_concepts mc 
-              ON m.measurement_concept_id = mc.concept_id
-            LEFT JOIN all_wbc wbc
-              ON m.person_id = wbc.person_id 
-              AND m.measurement_datetime = wbc.measurement_datetime
+        -- one row per measurement time, keeping the lowest value of each analyte
+        analyte_pivot as 
+        (
+            SELECT person_id, {row_id}, {window_start_field}, {window_end_field}, measurement_datetime
+                ,MIN(IF(
+                    analyte = 'wbc', 
+                    CASE WHEN unit_concept_id = 8647 THEN value_as_number/1000 ELSE value_as_number END, 
+                    NULL
+                )) AS wbc
+                ,MIN(IF(
+                    analyte = 'bands' AND measurement_concept_id = 3035839 AND value_as_number<=100, 
+                    value_as_number, 
+                    NULL
+                )) AS bands_percent
+                ,MIN(IF(
+                    analyte = 'bands' AND measurement_concept_id = 3018199 AND unit_concept_id = 8784, 
+                    value_as_number / 1000, 
+                    NULL
+                )) AS bands_count
+                -- percentages above 100 are invalid but their reference range is kept
+                ,ARRAY_AGG(IF(
+                    analyte = 'neutrophils' AND unit_concept_id = 8554,
+                    STRUCT(
+                        IF(value_as_number<=100, value_as_number, NULL) AS value_as_number
+                        ,IF(range_low<=100, range_low, NULL) AS range_low
+                        ,IF(range_high<=100, range_high, NULL) AS range_high
+                    ),
+                    NULL
+                ) IGNORE NULLS ORDER BY value_as_number > 100, value_as_number LIMIT 1)[SAFE_OFFSET(0)] AS neutrophils_percent
+                ,ARRAY_AGG(IF(
+                    analyte = 'neutrophils' AND unit_concept_id <> 8554,
+                    STRUCT(
+                        CASE WHEN unit_concept_id = 8784 THEN value_as_number / 1000 ELSE value_as_number END AS value_as_number
+                        ,CASE WHEN unit_concept_id = 8784 THEN range_low / 1000 ELSE range_low END AS range_low
+                        ,CASE WHEN unit_concept_id = 8784 THEN range_high / 1000 ELSE range_high END AS range_high
+                    ),
+                    NULL
+                ) IGNORE NULLS ORDER BY 
+                    CASE WHEN unit_concept_id = 8784 THEN value_as_number / 1000 ELSE value_as_number END
+                LIMIT 1)[SAFE_OFFSET(0)] AS neutrophils_count
+            FROM all_analytes
+            GROUP BY person_id, {row_id}, {window_start_field}, {window_end_field}, measurement_datetime
+        ),
+        -- absolute counts (thousands/uL) derived from the percentages and the wbc
+        analyte_counts as 
+        (
+            SELECT person_id, {row_id}, {window_start_field}, {window_end_field}, measurement_datetime
+                ,wbc
+                ,LEAST(
+                    COALESCE(bands_percent / 100 * wbc, bands_count), 
+                    COALESCE(bands_count, bands_percent / 100 * wbc)
+                ) AS bands_count
+                ,IF(
+                    neutrophils_count.value_as_number IS NULL 
+                        OR neutrophils_percent.value_as_number / 100 * wbc < neutrophils_count.value_as_number,
+                    STRUCT(
+                        neutrophils_percent.value_as_number / 100 * wbc AS value_as_number
+                        ,neutrophils_percent.range_low / 100 * wbc AS range_low
+                        ,neutrophils_percent.range_high / 100 * wbc AS range_high
+                    ),
+                    neutrophils_count
+                ) AS neutrophils
+            FROM analyte_pivot
         ),
         all_measurements AS
         (
-            SELECT DISTINCT *
-            FROM all_neutrophils
-            FULL OUTER JOIN all_bands USING (person_id, {window_start_field}, {window_end_field}, measurement_datetime)
-            FULL OUTER JOIN all_wbc USING (person_id, {window_start_field}, {window_end_field}, measurement_datetime)
-            WHERE 
-                (
-                    neutrophils_count IS NOT NULL
-                    OR bands_count IS NOT NULL
-                    OR wbc IS NOT NULL
-                ) 
-        ),
-        all_measurements_transformed AS
-        (
-            SELECT person_id, {window_start_field}, {window_end_field}, measurement_datetime
-                ,CASE
-                    WHEN neutrophils_count IS NOT NULL or bands_count IS NOT NULL 
-                        THEN IFNULL(neutrophils_count,0) + IFNULL(bands_count,0)
-                    WHEN wbc IS NOT NULL AND neutrophils_count IS NULL AND bands_count IS NULL
-                        THEN wbc
-                END AS value_as_number
+            SELECT person_id, {row_id}, {window_start_field}, {window_end_field}, measurement_datetime
+                ,neutrophils_count
+                ,COALESCE(neutrophils_count, wbc) AS value_as_number
                 ,range_low, range_high
-            FROM all_measurements
-        ),
-        neutrophils_only_transformed AS 
-        (
-            SELECT person_id, {window_start_field}, {window_end_field}, measurement_datetime
-                ,CASE
-                    WHEN neutrophils_count IS NOT NULL or bands_count IS NOT NULL 
-                        THEN IFNULL(neutrophils_count,0) + IFNULL(bands_count,0)
-                    WHEN wbc IS NOT NULL AND neutrophils_count IS NULL AND bands_count IS NULL
-                        THEN NULL
-                END AS value_as_number
-            FROM all_measurements
-        ),
-        min_measurements AS
-        (
-            SELECT person_id, {window_start_field}, {window_end_field}
-                ,MIN(value_as_number) AS np_min_neutrophils
-            FROM neutrophils_only_transformed
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field}
-            GROUP BY person_id, {window_start_field}, {window_end_field}
-        ),
-        abnormal_measurements as 
-        (
-            SELECT person_id 
-                ,{window_start_field}, {window_end_field}
-                ,value_as_number
-                ,case when value_as_number < 1.5 then 1 else 0 end as mild 
-                ,case when value_as_number < 1 then 1 else 0 end as moderate 
-                ,case when value_as_number < 0.500 then 1 else 0 end as severe
-                ,case when value_as_number < range_low then 1 else 0 end as abnormal
-                ,range_low
-                ,measurement_datetime
-            FROM all_measurements_transformed
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-                AND (value_as_number < 1.5)
-        ),
-        mild as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, mild
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE mild = 1
-        ), 
-        moderate as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, moderate
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE moderate = 1
-        ),
-        severe as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, severe
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE severe = 1
-        ),
-        abnormal as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, abnormal, range_low
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE abnormal = 1
-        ),
-        first_mild as (select * from mild where rn = 1),
-        first_moderate as (select * from moderate where rn = 1),
-        first_severe as (select * from severe where rn = 1),
-        first_abnormal as (select * from abnormal where rn = 1)
-        SELECT person_id, {window_start_field}, {window_end_field} 
-            ,np_min_neutrophils as {labeler_id}_min_neutrophils
-            ,first_mild.value_as_number as {labeler_id}_mild_measurement
-            ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
-            ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
-            ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
-            ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
-            ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
-            ,first_severe.value_as_number as {labeler_id}_severe_measurement
-            ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
-            ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
-            ,first_abnormal.value_as_number as {labeler_id}_abnormal_measurement
-            ,first_abnormal.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
-            ,first_abnormal.range_low as {labeler_id}_abnormal_threshold
-            ,case when abnormal is null then 0 else abnormal end as {labeler_id}_abnormal_label
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        LEFT JOIN min_measurements using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_abnormal using (person_id, {window_start_field}, {window_end_field})
+            FROM (
+                SELECT *
+                    ,CASE
+                        WHEN neutrophils.value_as_number IS NOT NULL OR bands_count IS NOT NULL 
+                            THEN IFNULL(neutrophils.value_as_number,0) + IFNULL(bands_count,0)
+                    END AS neutrophils_count
+                    ,neutrophils.range_low
+                    ,neutrophils.range_high
+                FROM analyte_counts
+            )
+        )
         """
 
     
-class ThrombocytopeniaQuery(LabelQuery):
+class ThrombocytopeniaQuery(ThresholdLabQuery):
     def get_query_config(self):
         return {
             "labeler_info":'lab-based definition for thrombocytopenia based on platelet count (10^9/L). Thresholds: mild (<150), moderate(<100), severe(<50), and reference range.',
             "labeler_id":'thrombocytopenia_lab',
             'extract_labs_from_flowsheets':False, 
             'flowsheets_extract_name':None,
+            'summary':('min_platelet', 'MIN(value_as_number)'),
+            'thresholds':[
+                ('mild', 'value_as_number < 150'),
+                ('moderate', 'value_as_number < 100'),
+                ('severe', 'value_as_number < 50'),
+                ('abnormal', 'value_as_number < range_low'),
+            ],
+            'abnormal_threshold':'range_low',
+            'sweep_direction':'below',
         }
     
-    def get_base_query(self):
+    def get_measurement_query(self):
         q_f = ""
         if self.config['extract_labs_from_flowsheets']:
             q_f+="""
             UNION ALL
-            SELECT t1.*
+            SELECT t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}
                 ,f.observation_datetime as measurement_datetime
                 ,CAST(f.meas_value AS FLOAT64) as value_as_number
                 ,NULL as range_low
                 ,NULL as range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{rs_dataset_project}.{rs_dataset}.{flowsheets_extract_name}` f
                 ON t1.person_id=f.person_id
+                AND f.observation_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
                 AND (
                     lower(f.display_name) like '%platelet%'
                     OR lower(f.display_name) like '%plt%'
@@ -1219,13 +926,15 @@ class ThrombocytopeniaQuery(LabelQuery):
         all_measurements AS
         (
             SELECT
-              t1.*, m.measurement_datetime
+              t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}, m.measurement_datetime
              ,m.value_as_number
              ,m.range_low 
              ,m.range_high
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
               on t1.person_id = m.person_id
+              AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+              {measurement_prune_str}
               AND m.unit_concept_id IN (
                 8848 -- thousands / uL
                 ,8961 -- thousands / mm^3 (equivalent to 8848)
@@ -1233,101 +942,5 @@ class ThrombocytopeniaQuery(LabelQuery):
             INNER JOIN measurement_concepts mc 
               ON m.measurement_concept_id = mc.concept_id
         """ + q_f + """
-        ),
-        min_measurements as 
-        (
-            SELECT person_id
-            ,{window_start_field}, {window_end_field}
-            ,min(value_as_number) as tc_min_platelet
-        FROM all_measurements
-        WHERE measurement_datetime >= {window_start_field} 
-            AND measurement_datetime <= {window_end_field} 
-        GROUP BY person_id, {window_start_field}, {window_end_field}
-        ),
-        abnormal_measurements as 
-        (
-            SELECT person_id 
-                ,{window_start_field}, {window_end_field}
-                ,value_as_number
-                ,range_low,range_high
-                ,case when value_as_number < 150 then 1 else 0 end as mild 
-                ,case when value_as_number < 100 then 1 else 0 end as moderate 
-                ,case when value_as_number < 50 then 1 else 0 end as severe
-                ,case when value_as_number < range_low then 1 else 0 end as abnormal_range
-                ,measurement_datetime
-            FROM all_measurements
-            WHERE measurement_datetime >= {window_start_field} 
-                AND measurement_datetime <= {window_end_field} 
-                AND (value_as_number < 150 OR value_as_number < range_low)
-        ),
-        mild as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, mild
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE mild = 1
-        ), 
-        moderate as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, moderate
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE moderate = 1
-        ),
-        severe as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, severe
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-            FROM abnormal_measurements 
-            WHERE severe = 1
-        ),
-        abnormal_range as (
-            SELECT 
-                person_id, {window_start_field}, {window_end_field}
-                ,value_as_number, measurement_datetime, abnormal_range
-                ,ROW_NUMBER() OVER(
-                    PARTITION BY person_id,{window_start_field}, {window_end_field} 
-                    ORDER BY measurement_datetime
-                    ) AS rn
-                ,range_low, range_high
-            FROM abnormal_measurements 
-            WHERE abnormal_range = 1
-        ),
-        first_mild as (select * from mild where rn = 1),
-        first_moderate as (select * from moderate where rn = 1),
-        first_severe as (select * from severe where rn = 1),
-        first_abnormal_range as (select * from abnormal_range where rn = 1)
-        SELECT person_id, {window_start_field}, {window_end_field} 
-            ,tc_min_platelet as {labeler_id}_min_platelet
-            ,first_mild.value_as_number as {labeler_id}_mild_measurement
-            ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
-            ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
-            ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
-            ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
-            ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
-            ,first_severe.value_as_number as {labeler_id}_severe_measurement
-            ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
-            ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
-            ,first_abnormal_range.value_as_number as {labeler_id}_abnormal_measurement
-            ,first_abnormal_range.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
-            ,case when abnormal_range is null then 0 else abnormal_range end as {labeler_id}_abnormal_label
-            ,range_low as {labeler_id}_abnormal_threshold
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        LEFT JOIN min_measurements using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
-        LEFT JOIN first_abnormal_range using (person_id, {window_start_field}, {window_end_field})
-        """
\ No newline at end of file
+        )
+        """
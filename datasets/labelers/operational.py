@@ -16,18 +16,18 @@ class MortalityQuery(LabelQuery):
     def get_base_query(self):
         return """
         WITH temp AS (
-            SELECT t1.person_id, {window_start_field}, {window_end_field}, death_date,
+            SELECT t1.{row_id}, death_date,
             CASE
                 WHEN death_date BETWEEN CAST({window_start_field} AS DATE) AND CAST({window_end_field} AS DATE) THEN 1
                 ELSE 0
             END as mortality_label
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
             RIGHT JOIN {dataset_project}.{dataset}.death AS t2
                 ON t1.person_id = t2.person_id
         )
-        SELECT t1.*, IFNULL(mortality_label, 0) as mortality_label, death_date
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-        LEFT JOIN temp USING (person_id, {window_start_field}, {window_end_field})
+        SELECT t1.{row_id}, IFNULL(mortality_label, 0) as mortality_label, death_date
+        FROM {cohort_table} t1
+        LEFT JOIN temp USING ({row_id})
         """
         
 
@@ -41,56 +41,56 @@ class LOS7Query(LabelQuery):
     def get_base_query(self):
         return """
         WITH temp AS (
-            SELECT *,
+            SELECT t1.{row_id},
             DATE_DIFF(t1.{window_end_field}, t1.{window_start_field}, DAY) AS los_days
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+            FROM {cohort_table} t1
         )
-        SELECT *, 
+        SELECT {row_id}, los_days, 
         CAST(los_days >= 7 AS INT64) as los_7_label
         FROM temp
         """
     
 
-class Readmission30Query(LabelQuery):
+class ReadmissionQuery(LabelQuery):
+    """
+    Notes:
+        - The next admission is the next window of the same person in the cohort
+        - One label column is returned for each horizon (in days)
+    """
+    uses_cohort_context = True
+    
     def get_query_config(self):
         return {
-            "labeler_info":'1 if readmission occurred within 30 days from the end of the specified time window, 0 otherwise',
-            "labeler_id":'readmission_30',
+            "labeler_info":'1 if readmission occurred within each horizon (7, 30 and 90 days by default) from the end of the specified time window, 0 otherwise',
+            "labeler_id":'readmission',
+            "horizons":[7, 30, 90],
         }
         
     def get_base_query(self):
-         return """
-        WITH temp AS (
-            SELECT *, ROW_NUMBER() OVER(PARTITION BY person_id ORDER BY {window_start_field}) as row_number
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name}
-        ),
-        temp_shifted AS ( -- row shift by one
-            SELECT person_id, {window_start_field}, {window_end_field}, row_number - 1 as row_number
-            FROM temp
-        ),
-        temp_readmission_window AS ( --compare discharges from temp to admits from temp_shifted
-            SELECT t1.person_id, 
-                t1.{window_end_field}, 
-                t2.{window_start_field}, 
-                DATE_DIFF(t2.{window_start_field}, t1.{window_end_field}, DAY) AS readmission_window,
-                t1.row_number
-            FROM temp as t1
-            INNER JOIN temp_shifted as t2
-            ON t1.person_id = t2.person_id AND t1.row_number = t2.row_number
-        ),
-        result AS (
-            SELECT t1.person_id, t1.{window_start_field}, t1.{window_end_field}, t2.readmission_window, 
-            CASE 
-                WHEN readmission_window BETWEEN 0 AND 30 THEN 1
+        q_labels = ""
+        for horizon in self.config['horizons']:
+            q_labels += f"""
+            ,CASE 
+                WHEN readmission_window BETWEEN 0 AND {horizon} THEN 1
                 ELSE 0
-            END as readmission_30_label
-            FROM temp as t1
-            INNER JOIN temp_readmission_window as t2
-            on t1.person_id = t2.person_id AND t1.row_number = t2.row_number
+            END as readmission_{horizon}_label"""
+        
+        return f"""
+        WITH temp AS (
+            SELECT {{row_id}}
+                ,DATE_DIFF(
+                    LEAD({{window_start_field}}) OVER(
+                        PARTITION BY person_id 
+                        ORDER BY {{window_start_field}}, {{window_end_field}}
+                    ),
+                    {{window_end_field}}, 
+                    DAY
+                ) AS readmission_window
+            FROM {{cohort_table}}
         )
-        SELECT t1.*, IFNULL(readmission_30_label, 0) as readmission_30_label, readmission_window
-        FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-        LEFT JOIN result USING (person_id, {window_start_field}, {window_end_field})
+        SELECT {{row_id}}{q_labels}
+            ,readmission_window
+        FROM temp
         """
         
         
@@ -106,10 +106,10 @@ class ICUAdmissionQuery(LabelQuery):
             WITH icu1 AS
             (
              SELECT
-              t1.*,
+              t1.{row_id},
               detail.visit_detail_start_datetime AS icu_start_datetime,
             FROM
-              {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
+              {cohort_table} t1
             LEFT JOIN
               {dataset_project}.{dataset}.visit_detail detail
             ON
@@ -144,7 +144,7 @@ class ICUAdmissionQuery(LabelQuery):
               SELECT
                icu1.*,
                RANK() OVER(
-                   PARTITION BY icu1.person_id, icu1.{window_start_field}, icu1.{window_end_field}
+                   PARTITION BY icu1.{row_id}
                    ORDER BY icu1.icu_start_datetime ASC
                ) rank_
               FROM
@@ -158,8 +158,8 @@ class ICUAdmissionQuery(LabelQuery):
                icu2 
               WHERE rank_ = 1
             )
-            SELECT t1.*, CASE WHEN icu_start_datetime IS NULL THEN 0 ELSE 1 END as icu_admission_label, icu_start_datetime
-            FROM {rs_dataset_project}.{rs_dataset}.{cohort_name} t1
-            LEFT JOIN icu3 USING (person_id, {window_start_field}, {window_end_field})
+            SELECT t1.{row_id}, CASE WHEN icu_start_datetime IS NULL THEN 0 ELSE 1 END as icu_admission_label, icu_start_datetime
+            FROM {cohort_table} t1
+            LEFT JOIN icu3 USING ({row_id})
         """
     
\ No newline at end of file
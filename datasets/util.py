@@ -5,6 +5,7 @@ import os
 import shutil
 import argparse
 import pickle
+import re
 
 def str2bool(v):
     """
@@ -86,6 +87,136 @@ def read_file(
         raise ValueError('"pandas" and "dask" are the only allowable modes')
 
         
+def get_shard_predicate(num_shards, shard_id, person_id_field="person_id"):
+    """
+    Construct a BigQuery SQL predicate that is true for persons assigned to shard `shard_id`
+    out of `num_shards` shards. Shards are assigned by a hash of person_id.
+    """
+    return (
+        f"MOD(ABS(FARM_FINGERPRINT(CAST({person_id_field} AS STRING))), {num_shards}) = {shard_id}"
+    )
+
+
+def get_row_id(
+    person_id_field="person_id",
+    window_start_field="admit_date",
+    window_end_field="discharge_date",
+):
+    """
+    Construct a BigQuery SQL expression for a deterministic INT64 identifier of a cohort row
+    """
+    return (
+        f"FARM_FINGERPRINT(CONCAT(CAST({person_id_field} AS STRING), "
+        f"CAST({window_start_field} AS STRING), CAST({window_end_field} AS STRING)))"
+    )
+
+
+def get_horizon_ends(window_horizons, window_start_field="admit_date"):
+    """
+    Construct BigQuery SQL expressions for the end of each named window horizon.
+    Integer horizons are offsets in hours from the window start and 
+    string horizons name an end field of the cohort.
+    Returns a list of (name, expression)
+    """
+    if not window_horizons:
+        return []
+    
+    horizon_ends = []
+    for name, horizon in window_horizons.items():
+        if isinstance(horizon, str):
+            horizon_ends.append((name, horizon))
+        else:
+            horizon_ends.append(
+                (name, f"DATETIME_ADD({window_start_field}, INTERVAL {int(horizon)} HOUR)")
+            )
+    return horizon_ends
+
+
+def get_table_options_str(partition_by=None, cluster_by=None):
+    """
+    Construct the PARTITION BY and CLUSTER BY clauses of a BigQuery CREATE TABLE statement.
+    partition_by is a partitioning expression, e.g. "DATETIME_TRUNC(admit_date, MONTH)", 
+    and cluster_by is a list of up to four clustering columns.
+    Returns an empty string if neither is set
+    """
+    options = []
+    if partition_by:
+        options.append(f"PARTITION BY {partition_by}")
+    if cluster_by:
+        if isinstance(cluster_by, str):
+            cluster_by = [cluster_by]
+        options.append("CLUSTER BY {}".format(", ".join(cluster_by)))
+    return "\n".join(options)
+
+
+def get_time_partitioning(partition_by):
+    """
+    (field, type) of the time partitioning of a load job equivalent to a PARTITION BY 
+    expression such as "DATETIME_TRUNC(admit_date, MONTH)", "DATE(admit_date)" or "admit_date".
+    Returns None if partition_by is not set
+    """
+    if not partition_by:
+        return None
+    match = re.fullmatch(
+        r"\s*(?:DATE|DATETIME|TIMESTAMP)_TRUNC\(\s*(\w+)\s*,\s*(HOUR|DAY|MONTH|YEAR)\s*\)\s*",
+        partition_by,
+        flags=re.IGNORECASE,
+    )
+    if match:
+        return match.group(1), match.group(2).upper()
+    match = re.fullmatch(r"\s*(?:DATE\(\s*(\w+)\s*\)|(\w+))\s*", partition_by, flags=re.IGNORECASE)
+    if match:
+        return match.group(1) or match.group(2), "DAY"
+    raise ValueError(f"Unsupported partition_by for load jobs: {partition_by}")
+
+
+def get_person_hash(person_id_field="person_id", seed=0):
+    """
+    Construct a BigQuery SQL expression that deterministically hashes persons.
+    Different seeds give independent orderings of persons.
+    """
+    return f"FARM_FINGERPRINT(CONCAT(CAST({person_id_field} AS STRING), ':{seed}'))"
+
+
+def get_sample_predicate(sample_fraction, person_id_field="person_id", seed=0):
+    """
+    Construct a BigQuery SQL predicate that is true for a deterministic 
+    fraction `sample_fraction` of persons
+    """
+    return "MOD(ABS({}), 1000000) < {}".format(
+        get_person_hash(person_id_field, seed), int(round(sample_fraction * 1000000))
+    )
+
+
+def get_wilson_interval(positive, n, z=1.96):
+    """
+    Wilson score interval of a proportion of `positive` out of `n`, 95% by default.
+    Returns (None, None) if n is 0
+    """
+    if not n:
+        return None, None
+    p = positive / n
+    center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+    margin = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+    return center - margin, center + margin
+
+
+def get_sample_persons_predicate(
+    sample_persons, person_table, person_id_field="person_id", seed=0
+):
+    """
+    Construct a BigQuery SQL predicate that is true for a deterministic sample 
+    of `sample_persons` persons drawn from `person_table`, which may have several 
+    rows per person
+    """
+    return f"""{person_id_field} IN (
+        SELECT person_id 
+        FROM (SELECT DISTINCT person_id FROM {person_table}) 
+        ORDER BY {get_person_hash("person_id", seed)}
+        LIMIT {sample_persons}
+    )"""
+
+
 def bq_extract_flowsheets_from_observations(
     bq_dataset:str,
     target_bq_dataset:str, 
@@ -94,6 +225,8 @@ def bq_extract_flowsheets_from_observations(
     target_bq_project:str='som-nero-nigam-starr',
     flowsheet_concept_id:str='2000006253',
     overwrite:bool=False,
+    partition_by:str='DATETIME_TRUNC(observation_datetime, MONTH)',
+    cluster_by:tuple=('person_id',),
     ):
     """
     Construct a BigQuery SQL that extracts flowsheet rows stored as JSON in the OMOP 
@@ -103,16 +236,19 @@ def bq_extract_flowsheets_from_observations(
     flowsheet_concept_id is the custom concept_id that indicates that a row associated
     with the observation_id contains the flowsheet JSON. 
     
-    Important note: the extract is large (>4.5B rows)
+    Important note: the extract is large (>4.5B rows). It is partitioned by `partition_by`
+    and clustered by `cluster_by` so that the labelers prune by date and person
     """
     
     if overwrite:
-        q_create = f"create or replace table `{target_bq_project}.{target_bq_dataset}.{target_bq_table}` as"
+        q_create = f"create or replace table `{target_bq_project}.{target_bq_dataset}.{target_bq_table}`"
     else:
-        q_create = f"create table if not exists `{target_bq_project}.{target_bq_dataset}.{target_bq_table}` as"
+        q_create = f"create table if not exists `{target_bq_project}.{target_bq_dataset}.{target_bq_table}`"
     
     return f"""
-    {q_create} 
+    {q_create}
+    {get_table_options_str(partition_by, cluster_by)}
+    as
     (
     with meas as (
       select observation_id, 
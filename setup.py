@@ -15,6 +15,11 @@ setup(
         "pandas>=1.0.0",
         "google-cloud-bigquery",
         "google-cloud-bigquery-storage",
+        "google-cloud-storage",
         "pandas-gbq",
+        "pyarrow",
     ],
+    extras_require={
+        "test": ["pytest", "duckdb"],
+    },
 )
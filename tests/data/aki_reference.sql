@@ -0,0 +1,130 @@
+-- AcuteKidneyInjuryQuery before the baseline was computed with one ordered window per person.
+-- Measurements at the same time are ordered by decreasing value, as in ThresholdLabQuery
+WITH measurement_concepts as (
+    SELECT 
+        c.concept_id, concept_name
+    FROM `{dataset_project}.{dataset}.concept` c 
+    WHERE c.concept_id in (37029387,4013964,2212294,3051825)
+
+    UNION DISTINCT 
+
+    SELECT 
+        c.concept_id, concept_name
+    FROM `{dataset_project}.{dataset}.concept` c
+    INNER JOIN `{dataset_project}.{dataset}.concept_ancestor` ca 
+        ON c.concept_id = ca.descendant_concept_id
+        AND ca.ancestor_concept_id in (37029387,4013964,2212294,3051825)
+        AND c.invalid_reason is null 
+),
+all_measurements AS
+(
+SELECT
+  t1.person_id, t1.{row_id}, t1.{window_start_field}, t1.{window_end_field}, m.measurement_datetime
+  ,case 
+      when unit_concept_id = 8840 then value_as_number / 0.0113122 
+      when unit_concept_id = 8837 then value_as_number * 0.001 / 0.0113122 
+  else value_as_number end as value_as_number
+  ,case 
+      when unit_concept_id = 8840 then range_high / 0.0113122 
+      when unit_concept_id = 8837 then range_high * 0.001 / 0.0113122 
+  else range_high end as range_high
+  ,case 
+      when unit_concept_id = 8840 then range_low / 0.0113122 
+      when unit_concept_id = 8837 then range_low * 0.001 / 0.0113122 
+  else range_low end as range_low
+FROM {cohort_table} t1
+LEFT JOIN {dataset_project}.{dataset}.measurement m
+    ON t1.person_id = m.person_id
+    AND m.measurement_datetime BETWEEN date_add(t1.{window_start_field}, INTERVAL -{lookback_days} day) AND t1.{window_end_field}
+    AND m.unit_concept_id IN (
+        8749,  -- umol/l (x0.0113122 to get mg/dl)
+        8840,  -- mg/dl
+        8837   -- ug/dl (x0.001 to get mg/dl)
+      )
+INNER JOIN measurement_concepts mc 
+    ON m.measurement_concept_id = mc.concept_id
+
+),
+-- GET BASELINE CREATININE MEASUREMENTS (MIN MEASUREMENT BETWEEN ADMISSION TIME AND 3 MONTHS PRIOR)
+base_3month as (
+    SELECT person_id,{window_start_field}, {window_end_field}
+        ,MIN(m.value_as_number) as value_as_number
+    FROM all_measurements m 
+    WHERE measurement_datetime >= date_add({window_start_field}, INTERVAL -{lookback_days} day)
+        AND measurement_datetime < {window_start_field} 
+    GROUP BY person_id, {window_start_field}, {window_end_field}
+),
+base_by_age_norm as (
+    SELECT m.person_id,{window_start_field},{window_end_field}
+        ,CASE 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN 0 AND 14 THEN 0.92 / 0.0113122 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN 15 AND (2*365-1) THEN 0.36 / 0.0113122 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (2*365) AND (5*365-1) THEN 0.43 / 0.0113122 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (5*365) AND (12*365-1) THEN 0.61 / 0.0113122 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (12*365) AND (15*365-1) THEN 0.81 / 0.0113122 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) BETWEEN (15*365) AND (19*365-1) THEN 0.84 / 0.0113122 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) >= (19*365) AND gender_concept_id=8532 THEN 1.1 / 0.0113122 
+            WHEN DATE_DIFF({window_start_field}, birth_datetime, DAY) >= (19*365) AND gender_concept_id<>8532 THEN 1.2 / 0.0113122
+            ELSE NULL
+        END AS value_as_number
+    FROM (SELECT DISTINCT person_id, {window_start_field}, {window_end_field} FROM all_measurements) m
+    LEFT JOIN `{dataset_project}.{dataset}.person` person
+        ON m.person_id=person.person_id
+),
+base_measurements as (
+    SELECT b_age.person_id, b_age.{window_start_field}, b_age.{window_end_field} 
+        ,COALESCE(b_3month.value_as_number, b_age.value_as_number) as value_as_number
+    FROM base_by_age_norm b_age 
+    LEFT JOIN base_3month b_3month 
+        ON b_age.person_id=b_3month.person_id 
+        AND b_age.{window_start_field}=b_3month.{window_start_field}
+        AND b_age.{window_end_field}=b_3month.{window_end_field}
+),
+in_window_measurements AS
+(
+    SELECT m.*, b.value_as_number as baseline_value
+    FROM all_measurements m
+    LEFT JOIN base_measurements b USING (person_id, {window_start_field}, {window_end_field})
+    WHERE measurement_datetime >= {window_start_field} 
+        AND measurement_datetime <= {window_end_field} 
+),
+threshold_measurements AS
+(
+    SELECT {row_id}
+        ,MAX(value_as_number) as summary_value
+        ,ARRAY_AGG(
+            IF((value_as_number/baseline_value >= 1.5 OR value_as_number-baseline_value >= 26.52), STRUCT(value_as_number, measurement_datetime, range_low, range_high), NULL)
+            IGNORE NULLS ORDER BY measurement_datetime, value_as_number DESC LIMIT 1
+        )[SAFE_OFFSET(0)] AS first_aki1
+        ,ARRAY_AGG(
+            IF(value_as_number/baseline_value >= 2.0, STRUCT(value_as_number, measurement_datetime, range_low, range_high), NULL)
+            IGNORE NULLS ORDER BY measurement_datetime, value_as_number DESC LIMIT 1
+        )[SAFE_OFFSET(0)] AS first_aki2
+        ,ARRAY_AGG(
+            IF((value_as_number/baseline_value >= 3.0 OR value_as_number-baseline_value >= 353.6), STRUCT(value_as_number, measurement_datetime, range_low, range_high), NULL)
+            IGNORE NULLS ORDER BY measurement_datetime, value_as_number DESC LIMIT 1
+        )[SAFE_OFFSET(0)] AS first_aki3
+        ,ARRAY_AGG(
+            IF(value_as_number > range_high, STRUCT(value_as_number, measurement_datetime, range_low, range_high), NULL)
+            IGNORE NULLS ORDER BY measurement_datetime, value_as_number DESC LIMIT 1
+        )[SAFE_OFFSET(0)] AS first_abnormal
+    FROM in_window_measurements
+    GROUP BY {row_id}
+)
+SELECT {row_id}
+    ,summary_value as {labeler_id}_max_creatinine
+    ,first_aki1.value_as_number as {labeler_id}_aki1_measurement
+    ,first_aki1.measurement_datetime as {labeler_id}_aki1_measurement_datetime
+    ,case when first_aki1 is null then 0 else 1 end as {labeler_id}_aki1_label
+    ,first_aki2.value_as_number as {labeler_id}_aki2_measurement
+    ,first_aki2.measurement_datetime as {labeler_id}_aki2_measurement_datetime
+    ,case when first_aki2 is null then 0 else 1 end as {labeler_id}_aki2_label
+    ,first_aki3.value_as_number as {labeler_id}_aki3_measurement
+    ,first_aki3.measurement_datetime as {labeler_id}_aki3_measurement_datetime
+    ,case when first_aki3 is null then 0 else 1 end as {labeler_id}_aki3_label
+    ,first_abnormal.value_as_number as {labeler_id}_abnormal_measurement
+    ,first_abnormal.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
+    ,case when first_abnormal is null then 0 else 1 end as {labeler_id}_abnormal_label
+    ,first_abnormal.range_high as {labeler_id}_abnormal_threshold
+FROM {cohort_table}
+LEFT JOIN threshold_measurements USING ({row_id})
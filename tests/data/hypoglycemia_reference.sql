@@ -0,0 +1,143 @@
+-- HypoglycemiaQuery before thresholds were computed in a single grouped pass.
+-- Measurements at the same time are ordered by increasing value, as in ThresholdLabQuery
+WITH measurement_concepts as 
+(
+    SELECT 
+        c.concept_id, concept_name
+    FROM `{dataset_project}.{dataset}.concept` c 
+    WHERE c.concept_id in (4144235, 1002597)
+
+    UNION DISTINCT
+
+    SELECT 
+        c.concept_id, concept_name
+    FROM `{dataset_project}.{dataset}.concept` c
+    INNER JOIN `{dataset_project}.{dataset}.concept_ancestor` ca 
+        ON c.concept_id = ca.descendant_concept_id
+        AND ca.ancestor_concept_id in (4144235, 1002597)
+        AND c.invalid_reason is null 
+),
+all_measurements AS
+(
+    SELECT
+      t1.person_id, t1.{window_start_field}, t1.{window_end_field}, m.measurement_datetime
+      ,CASE
+          WHEN m.unit_concept_id IN (8840, 9028) THEN m.value_as_number / 18 
+          ELSE m.value_as_number
+      END AS value_as_number
+      ,CASE
+          WHEN m.unit_concept_id IN (8840, 9028) THEN m.range_low / 18 
+          ELSE m.range_low
+      END AS range_low
+      ,CASE
+          WHEN m.unit_concept_id IN (8840, 9028) THEN m.range_high / 18 
+          ELSE m.range_high
+      END AS range_high
+    FROM {cohort_table} t1
+    LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
+      on t1.person_id = m.person_id
+      AND m.unit_concept_id IN (
+          8840, -- mg/dL
+          9028, -- mg/dL calculated
+          8753 -- mmol/L (x 18 to get mg/dl)
+      )
+    INNER JOIN measurement_concepts mc 
+      ON m.measurement_concept_id = mc.concept_id
+
+),
+min_measurements as 
+(
+    SELECT person_id
+        ,{window_start_field}, {window_end_field}
+        ,min(value_as_number) as hg_min_glucose
+    FROM all_measurements
+    WHERE measurement_datetime >= {window_start_field} 
+        AND measurement_datetime <= {window_end_field} 
+    GROUP BY person_id, {window_start_field}, {window_end_field}
+),
+abnormal_measurements as 
+(
+    SELECT person_id 
+        ,{window_start_field}, {window_end_field}
+        ,value_as_number
+        ,range_low,range_high
+        ,case when value_as_number <= 3.9 then 1 else 0 end as mild 
+        ,case when value_as_number < 3.5 then 1 else 0 end as moderate 
+        ,case when value_as_number < 3 then 1 else 0 end as severe
+        ,case when value_as_number < range_low then 1 else 0 end as abnormal_range
+        ,measurement_datetime
+    FROM all_measurements
+    WHERE measurement_datetime >= {window_start_field} 
+        AND measurement_datetime <= {window_end_field} 
+        AND (value_as_number <= 3.9 OR value_as_number < range_low)
+),
+mild as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, mild
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime, value_as_number
+            ) AS rn
+    FROM abnormal_measurements 
+    WHERE mild = 1
+), 
+moderate as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, moderate
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime, value_as_number
+            ) AS rn
+    FROM abnormal_measurements 
+    WHERE moderate = 1
+),
+severe as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, severe
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime, value_as_number
+            ) AS rn
+    FROM abnormal_measurements 
+    WHERE severe = 1
+),
+abnormal_range as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, abnormal_range
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime, value_as_number
+            ) AS rn
+        ,range_low, range_high
+    FROM abnormal_measurements 
+    WHERE abnormal_range = 1
+),
+first_mild as (select * from mild where rn = 1),
+first_moderate as (select * from moderate where rn = 1),
+first_severe as (select * from severe where rn = 1),
+first_abnormal_range as (select * from abnormal_range where rn = 1)
+SELECT {row_id} 
+    ,hg_min_glucose as {labeler_id}_min_glucose
+    ,first_mild.value_as_number as {labeler_id}_mild_measurement
+    ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
+    ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
+    ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
+    ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
+    ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
+    ,first_severe.value_as_number as {labeler_id}_severe_measurement
+    ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
+    ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
+    ,first_abnormal_range.value_as_number as {labeler_id}_abnormal_measurement
+    ,first_abnormal_range.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
+    ,case when abnormal_range is null then 0 else abnormal_range end as {labeler_id}_abnormal_label
+    ,range_low as {labeler_id}_abnormal_threshold
+FROM {cohort_table}
+LEFT JOIN min_measurements using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_abnormal_range using (person_id, {window_start_field}, {window_end_field})
@@ -0,0 +1,258 @@
+-- WBC (LEUKOCYTES)
+WITH wbc_concepts as 
+(
+    SELECT 
+        c.concept_id, 'wbc' as concept_name
+    FROM `{dataset_project}.{dataset}.concept` c
+    WHERE concept_id IN (3000905, 4298431, 3010813)       
+),
+all_wbc as 
+(
+  SELECT t1.person_id, t1.{window_start_field}, t1.{window_end_field}
+      ,m.measurement_datetime
+      ,CASE
+          WHEN unit_concept_id = 8647 THEN m.value_as_number/1000
+          ELSE m.value_as_number
+      END as wbc
+  FROM {cohort_table} t1
+  LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
+      ON t1.person_id = m.person_id
+      AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+      {measurement_prune_str}
+      AND m.unit_concept_id IN (
+        8848,  -- 1000/uL
+        8961,  -- 1000/mm^3, equivalent to 8848
+        8647   -- /uL - divide by 1000 to convert to 1000/uL
+      )
+  INNER JOIN wbc_concepts mc 
+      on m.measurement_concept_id = mc.concept_id
+),
+-- BANDS
+bands_concepts as 
+(
+    -- 3035839 band form /100 leukocytes (%)
+    -- 3018199 band form neutrophils in blood (count) 
+    SELECT 
+        c.concept_id, concept_name
+    FROM `{dataset_project}.{dataset}.concept` c
+    WHERE concept_id in (3035839, 3018199)
+),
+all_bands as
+(
+    SELECT t1.person_id, t1.{window_start_field}, t1.{window_end_field}
+        ,m.measurement_datetime 
+        ,CASE 
+            WHEN m.measurement_concept_id = 3035839 AND m.value_as_number<=100
+              THEN m.value_as_number / 100 * wbc.wbc
+            WHEN m.measurement_concept_id = 3018199 AND m.unit_concept_id = 8784 
+              THEN m.value_as_number / 1000
+            ELSE NULL
+        END AS bands_count
+    FROM {cohort_table} t1
+    LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
+        ON t1.person_id = m.person_id
+        AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+        {measurement_prune_str}
+    INNER JOIN bands_concepts mc 
+        ON m.measurement_concept_id = mc.concept_id
+    LEFT JOIN all_wbc wbc 
+        ON m.person_id = wbc.person_id
+        AND m.measurement_datetime = wbc.measurement_datetime
+),
+-- NEUTROPHILS
+neutrophils_concepts as 
+(
+    SELECT 
+        c.concept_id, concept_name
+    FROM `{dataset_project}.{dataset}.concept` c
+    WHERE concept_id in (37045722, 37049637)
+
+    UNION DISTINCT 
+
+    SELECT 
+        c.concept_id, concept_name
+    FROM `{dataset_project}.{dataset}.concept` c
+    INNER JOIN `{dataset_project}.{dataset}.concept_ancestor` ca 
+        ON c.concept_id = ca.descendant_concept_id
+        AND ca.ancestor_concept_id in (37045722, 37049637)
+        AND c.invalid_reason is null 
+),
+all_neutrophils as 
+(
+    SELECT t1.person_id, t1.{window_start_field}, t1.{window_end_field}
+      ,m.measurement_datetime 
+      ,CASE 
+          -- neutrophils /100 leukocytes
+          WHEN m.unit_concept_id = 8554 AND m.value_as_number<=100
+              THEN m.value_as_number / 100 * wbc.wbc
+          WHEN m.unit_concept_id = 8554 AND m.value_as_number>100
+              THEN NULL
+          WHEN m.unit_concept_id = 8784  
+              THEN m.value_as_number / 1000
+          ELSE m.value_as_number
+      END AS neutrophils_count
+      ,case 
+          when m.unit_concept_id = 8554 AND m.range_high<=100
+              THEN m.range_high / 100 * wbc.wbc
+          WHEN m.unit_concept_id = 8554 AND m.range_high>100
+              THEN NULL
+          WHEN m.unit_concept_id = 8784
+              THEN m.range_high / 1000
+          else m.range_high
+      end as range_high
+      ,case 
+          when m.unit_concept_id = 8554 AND m.range_low<=100
+              THEN m.range_low / 100 * wbc.wbc
+          WHEN m.unit_concept_id = 8554 AND m.range_low>100
+              THEN NULL
+          WHEN m.unit_concept_id = 8784
+              THEN m.range_low / 1000
+          else m.range_low
+      end as range_low
+    FROM {cohort_table} t1
+    LEFT JOIN `{dataset_project}.{dataset}.measurement` m 
+      ON t1.person_id = m.person_id
+      AND m.measurement_datetime BETWEEN t1.{window_start_field} AND t1.{window_end_field}
+      {measurement_prune_str}
+      AND m.unit_concept_id in (
+          8848, -- 1000/uL
+          8554, -- %
+          8784, -- cells/uL
+          8961 -- 1000/mm^3
+      )
+    INNER JOIN neutrophils_concepts mc 
+      ON m.measurement_concept_id = mc.concept_id
+    LEFT JOIN all_wbc wbc
+      ON m.person_id = wbc.person_id 
+      AND m.measurement_datetime = wbc.measurement_datetime
+),
+all_measurements AS
+(
+    SELECT DISTINCT *
+    FROM all_neutrophils
+    FULL OUTER JOIN all_bands USING (person_id, {window_start_field}, {window_end_field}, measurement_datetime)
+    FULL OUTER JOIN all_wbc USING (person_id, {window_start_field}, {window_end_field}, measurement_datetime)
+    WHERE 
+        (
+            neutrophils_count IS NOT NULL
+            OR bands_count IS NOT NULL
+            OR wbc IS NOT NULL
+        ) 
+),
+all_measurements_transformed AS
+(
+    SELECT person_id, {window_start_field}, {window_end_field}, measurement_datetime
+        ,CASE
+            WHEN neutrophils_count IS NOT NULL or bands_count IS NOT NULL 
+                THEN IFNULL(neutrophils_count,0) + IFNULL(bands_count,0)
+            WHEN wbc IS NOT NULL AND neutrophils_count IS NULL AND bands_count IS NULL
+                THEN wbc
+        END AS value_as_number
+        ,range_low, range_high
+    FROM all_measurements
+),
+neutrophils_only_transformed AS 
+(
+    SELECT person_id, {window_start_field}, {window_end_field}, measurement_datetime
+        ,CASE
+            WHEN neutrophils_count IS NOT NULL or bands_count IS NOT NULL 
+                THEN IFNULL(neutrophils_count,0) + IFNULL(bands_count,0)
+            WHEN wbc IS NOT NULL AND neutrophils_count IS NULL AND bands_count IS NULL
+                THEN NULL
+        END AS value_as_number
+    FROM all_measurements
+),
+min_measurements AS
+(
+    SELECT person_id, {window_start_field}, {window_end_field}
+        ,MIN(value_as_number) AS np_min_neutrophils
+    FROM neutrophils_only_transformed
+    WHERE measurement_datetime >= {window_start_field} 
+        AND measurement_datetime <= {window_end_field}
+    GROUP BY person_id, {window_start_field}, {window_end_field}
+),
+abnormal_measurements as 
+(
+    SELECT person_id 
+        ,{window_start_field}, {window_end_field}
+        ,value_as_number
+        ,case when value_as_number < 1.5 then 1 else 0 end as mild 
+        ,case when value_as_number < 1 then 1 else 0 end as moderate 
+        ,case when value_as_number < 0.500 then 1 else 0 end as severe
+        ,case when value_as_number < range_low then 1 else 0 end as abnormal
+        ,range_low
+        ,measurement_datetime
+    FROM all_measurements_transformed
+    WHERE measurement_datetime >= {window_start_field} 
+        AND measurement_datetime <= {window_end_field} 
+        AND (value_as_number < 1.5)
+),
+mild as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, mild
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime
+            ) AS rn
+    FROM abnormal_measurements 
+    WHERE mild = 1
+), 
+moderate as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, moderate
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime
+            ) AS rn
+    FROM abnormal_measurements 
+    WHERE moderate = 1
+),
+severe as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, severe
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime
+            ) AS rn
+    FROM abnormal_measurements 
+    WHERE severe = 1
+),
+abnormal as (
+    SELECT 
+        person_id, {window_start_field}, {window_end_field}
+        ,value_as_number, measurement_datetime, abnormal, range_low
+        ,ROW_NUMBER() OVER(
+            PARTITION BY person_id,{window_start_field}, {window_end_field} 
+            ORDER BY measurement_datetime
+            ) AS rn
+    FROM abnormal_measurements 
+    WHERE abnormal = 1
+),
+first_mild as (select * from mild where rn = 1),
+first_moderate as (select * from moderate where rn = 1),
+first_severe as (select * from severe where rn = 1),
+first_abnormal as (select * from abnormal where rn = 1)
+SELECT {row_id} 
+    ,np_min_neutrophils as {labeler_id}_min_neutrophils
+    ,first_mild.value_as_number as {labeler_id}_mild_measurement
+    ,first_mild.measurement_datetime as {labeler_id}_mild_measurement_datetime
+    ,case when mild is null then 0 else mild end as {labeler_id}_mild_label
+    ,first_moderate.value_as_number as {labeler_id}_moderate_measurement
+    ,first_moderate.measurement_datetime as {labeler_id}_moderate_measurement_datetime
+    ,case when moderate is null then 0 else moderate end as {labeler_id}_moderate_label
+    ,first_severe.value_as_number as {labeler_id}_severe_measurement
+    ,first_severe.measurement_datetime as {labeler_id}_severe_measurement_datetime
+    ,case when severe is null then 0 else severe end as {labeler_id}_severe_label
+    ,first_abnormal.value_as_number as {labeler_id}_abnormal_measurement
+    ,first_abnormal.measurement_datetime as {labeler_id}_abnormal_measurement_datetime
+    ,first_abnormal.range_low as {labeler_id}_abnormal_threshold
+    ,case when abnormal is null then 0 else abnormal end as {labeler_id}_abnormal_label
+FROM {cohort_table}
+LEFT JOIN min_measurements using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_mild using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_moderate using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_severe using (person_id, {window_start_field}, {window_end_field})
+LEFT JOIN first_abnormal using (person_id, {window_start_field}, {window_end_field})
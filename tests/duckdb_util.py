@@ -0,0 +1,202 @@
+"""
+Helpers to run the BigQuery SQL of the labelers against small synthetic tables in DuckDB.
+Only the constructs used by the labelers are translated.
+"""
+import re
+from types import SimpleNamespace
+
+import pandas as pd
+
+
+def find_closing(s, i):
+    depth = 0
+    for j in range(i, len(s)):
+        if s[j] == "(":
+            depth += 1
+        elif s[j] == ")":
+            depth -= 1
+            if depth == 0:
+                return j
+    raise ValueError("Unbalanced parentheses in query")
+
+
+def split_top_level(s, sep=","):
+    result, depth, current, i = [], 0, "", 0
+    while i < len(s):
+        if s[i] == "(":
+            depth += 1
+        elif s[i] == ")":
+            depth -= 1
+        if depth == 0 and s.startswith(sep, i):
+            result.append(current)
+            current = ""
+            i += len(sep)
+            continue
+        current += s[i]
+        i += 1
+    result.append(current)
+    return result
+
+
+def translate_struct(s):
+    while True:
+        match = re.search(r"\bSTRUCT\(", s)
+        if not match:
+            return s
+        i = match.end() - 1
+        j = find_closing(s, i)
+        fields = []
+        for arg in split_top_level(translate_struct(s[i + 1 : j])):
+            arg = arg.strip()
+            named = re.match(r"(?is)(.*)\s+AS\s+(\w+)$", arg)
+            if named:
+                fields.append(f"{named.group(2)} := {named.group(1)}")
+            else:
+                fields.append(f"{arg.split('.')[-1]} := {arg}")
+        s = s[: match.start()] + "struct_pack(" + ", ".join(fields) + ")" + s[j + 1 :]
+
+
+def translate_struct_unnest(s):
+    """
+    UNNEST([STRUCT(...), ...]) to a subquery with one column per struct field
+    """
+    start = 0
+    while True:
+        match = re.compile(r"\bUNNEST\(\s*\[\s*STRUCT\(").search(s, start)
+        if not match:
+            return s
+        i = s.index("(", match.start())
+        j = find_closing(s, i)
+        replacement = f"(SELECT UNNEST({s[i + 1 : j]}, recursive := true))"
+        s = s[: match.start()] + replacement + s[j + 1 :]
+        start = match.start() + len(replacement)
+
+
+def translate_first_value(s):
+    """
+    ARRAY_AGG(IF(cond, value, NULL) IGNORE NULLS ORDER BY x LIMIT 1)[SAFE_OFFSET(0)]
+    to first(value ORDER BY x) FILTER (WHERE cond)
+    """
+    while True:
+        match = re.search(r"ARRAY_AGG\(", s)
+        if not match:
+            return s
+        i = match.end() - 1
+        j = find_closing(s, i)
+        rest = s[j + 1 :]
+        if not rest.startswith("[SAFE_OFFSET(0)]"):
+            raise ValueError("Unsupported ARRAY_AGG: " + s[match.start() : j + 20])
+        body, order = re.split(r"\s+IGNORE NULLS\s+ORDER BY\s+", s[i + 1 : j])
+        order = re.sub(r"\s+LIMIT 1\s*$", "", order)
+        body = body.strip()
+        k = find_closing(body, 2)
+        cond, value, _ = split_top_level(body[3:k])
+        s = (
+            s[: match.start()]
+            + f"first({value} ORDER BY {order}) FILTER (WHERE {cond})"
+            + rest[len("[SAFE_OFFSET(0)]") :]
+        )
+
+
+def translate(query):
+    """
+    Translates a BigQuery query to DuckDB
+    """
+    query = query.replace("`", "")
+    # table options other than those of the config, e.g. of temporary tables
+    query = re.sub(r"(?m)^\s*CLUSTER BY [\w, ]+", "", query)
+    query = re.sub(
+        r"(?i)\bDATE(?:TIME)?_DIFF\(([\w.]+),\s*([\w.]+),\s*(\w+)\)",
+        r"date_diff('\3', \2, \1)",
+        query,
+    )
+    query = re.sub(r"(?i)\bUNIX_MICROS\(TIMESTAMP\(([\w.]+)\)\)", r"epoch_us(\1)", query)
+    query = re.sub(r"(?i)\bAS FLOAT64\)", "AS DOUBLE)", query)
+    query = re.sub(r"(?i)\b(UNION|EXCEPT|INTERSECT) DISTINCT\b", r"\1", query)
+    query = re.sub(
+        r"(?i)\bDATE(?:TIME)?_(ADD|SUB)\(([\w.]+),\s*INTERVAL (-?\d+) (\w+)\)",
+        lambda m: "({} {} INTERVAL ({}) {})".format(
+            m.group(2), "+" if m.group(1).upper() == "ADD" else "-", m.group(3), m.group(4)
+        ),
+        query,
+    )
+    # exact quantiles standing in for approximate ones
+    query = re.sub(
+        r"(?i)\bAPPROX_QUANTILES\(([^,()]+),\s*(\d+)\)",
+        lambda m: "quantile_disc({}, [{}])".format(
+            m.group(1), ", ".join(str(i / int(m.group(2))) for i in range(int(m.group(2)) + 1))
+        ),
+        query,
+    )
+    # UNNEST of a literal array as a table with a single named column
+    query = re.sub(
+        r"(?i)\bUNNEST\((\[[^\[\]]*\])\)\s+AS\s+(\w+)", r"UNNEST(\1) AS \2_table(\2)", query
+    )
+    query = translate_first_value(query)
+    query = translate_struct_unnest(query)
+    query = translate_struct(query)
+    return re.sub(r"(?i)\bCOUNTIF\(", "count_if(", query)
+
+
+def get_connection(duckdb, tables, project="p", dataset="d"):
+    """
+    DuckDB connection with the dataframes in `tables` as {project}.{dataset}.{name}.
+    `dataset` may be a list of datasets, in which case `tables` are keyed by "dataset.name"
+    """
+    con = duckdb.connect()
+    # a 63-bit hash standing in for FARM_FINGERPRINT
+    con.execute("CREATE MACRO farm_fingerprint(s) AS CAST(hash(s) >> 1 AS BIGINT)")
+    con.execute(f"ATTACH ':memory:' AS {project}")
+    for name in [dataset] if isinstance(dataset, str) else dataset:
+        con.execute(f"CREATE SCHEMA {project}.{name}")
+    for name, df in tables.items():
+        name = name if "." in name else f"{dataset}.{name}"
+        con.register("tmp_df", df)
+        con.execute(f"CREATE TABLE {project}.{name} AS SELECT * FROM tmp_df")
+        con.unregister("tmp_df")
+    return con
+
+
+class DuckDBClient:
+    """
+    Stand-in for bigquery.Client running the translated queries on a DuckDB connection
+    """
+    field_types = {
+        "BIGINT": "INT64",
+        "INTEGER": "INT64",
+        "DOUBLE": "FLOAT64",
+        "VARCHAR": "STRING",
+        "BOOLEAN": "BOOL",
+        "TIMESTAMP": "DATETIME",
+        "TIMESTAMP_NS": "DATETIME",
+        "DATE": "DATE",
+    }
+
+    def __init__(self, con):
+        self.con = con
+        self.queries = []
+
+    def query(self, query, job_config=None, **kwargs):
+        self.queries.append(query)
+        cursor = self.con.execute(translate(query))
+        columns = [x[0] for x in cursor.description] if cursor.description else []
+        return DuckDBJob([dict(zip(columns, row)) for row in cursor.fetchall()], columns)
+
+    def get_table(self, name):
+        schema = [
+            SimpleNamespace(name=x[0], field_type=self.field_types.get(x[1], x[1]))
+            for x in self.con.execute(f"DESCRIBE {name}").fetchall()
+        ]
+        return SimpleNamespace(schema=schema)
+
+
+class DuckDBJob:
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.columns = columns
+
+    def result(self, *args, **kwargs):
+        return self.rows
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.rows, columns=self.columns)
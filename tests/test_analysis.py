@@ -0,0 +1,87 @@
+import pytest
+
+from datasets.labelers.analysis import (
+    get_cte_fingerprints, get_input_tables, hoist_shared_ctes, split_ctes
+)
+
+QUERY_A = """
+WITH persons AS (
+    SELECT person_id, year_of_birth FROM `p.d.person` -- persons of the cohort
+    WHERE person_id IN (SELECT person_id FROM p.d.cohort)
+),
+births AS (
+    SELECT year_of_birth, COUNT(*) AS n FROM persons GROUP BY year_of_birth
+)
+SELECT * FROM births
+"""
+
+# the same CTEs as QUERY_A, with other names, whitespace and comments
+QUERY_B = """
+WITH cohort_persons AS (
+    SELECT person_id, year_of_birth 
+    FROM `p.d.person`
+    WHERE person_id IN (SELECT person_id FROM p.d.cohort)
+),
+other AS (
+    SELECT year_of_birth, COUNT(*) AS n FROM cohort_persons GROUP BY year_of_birth
+),
+labels AS (
+    SELECT year_of_birth, n > 1 AS label FROM other
+)
+SELECT * FROM labels
+"""
+
+
+def test_split_ctes():
+    ctes, statement = split_ctes(QUERY_A)
+    assert [name for name, _ in ctes] == ["persons", "births"]
+    assert ctes[1][1] == "SELECT year_of_birth, COUNT(*) AS n FROM persons GROUP BY year_of_birth"
+    assert statement == "SELECT * FROM births"
+    assert split_ctes("SELECT 1") == ([], "SELECT 1")
+
+
+def test_cte_fingerprints():
+    a = get_cte_fingerprints(QUERY_A)
+    b = get_cte_fingerprints(QUERY_B)
+    assert [x[2] for x in a] == [x[2] for x in b[:2]]
+    assert a[1][3] == {"persons"}
+    assert b[2][2] not in {x[2] for x in a}
+
+
+def test_input_tables():
+    assert get_input_tables(QUERY_A) == ["p.d.cohort", "p.d.person"]
+    assert get_input_tables(
+        "SELECT * FROM p.d.cohort t CROSS JOIN UNNEST([1, 2]) AS x LEFT JOIN `p-1.d.death` USING (person_id)"
+    ) == ["p-1.d.death", "p.d.cohort"]
+
+
+def test_hoist_shared_ctes():
+    stages, queries = hoist_shared_ctes(
+        {"a": QUERY_A, "b": QUERY_B, "c": "WITH x AS (SELECT 1) SELECT * FROM x"}, 
+        lambda fingerprint: f"stage_{fingerprint}",
+    )
+    assert len(stages) == 2
+    assert "FROM stage_" in stages[1][1]
+    assert queries["c"] == "WITH x AS (SELECT 1) SELECT * FROM x"
+    for key in ["a", "b"]:
+        assert "p.d.person" not in queries[key]
+        assert get_input_tables(queries[key]) == sorted(x[0] for x in stages)
+
+
+def test_hoist_shared_ctes_round_trip():
+    duckdb = pytest.importorskip("duckdb")
+    con = duckdb.connect()
+    con.execute("ATTACH ':memory:' AS p; CREATE SCHEMA p.d")
+    con.execute("""
+        CREATE TABLE p.d.person AS 
+        SELECT range AS person_id, 1950 + range % 7 AS year_of_birth FROM range(100)
+    """)
+    con.execute("CREATE TABLE p.d.cohort AS SELECT range * 3 AS person_id FROM range(20)")
+
+    queries = {"a": QUERY_A.replace("`", ""), "b": QUERY_B.replace("`", "")}
+    expected = {k: sorted(con.execute(q).fetchall()) for k, q in queries.items()}
+
+    stages, queries = hoist_shared_ctes(queries, lambda fingerprint: f"stage_{fingerprint}")
+    for stage_table, stage_query in stages:
+        con.execute(f"CREATE TABLE {stage_table} AS {stage_query}")
+    assert {k: sorted(con.execute(q).fetchall()) for k, q in queries.items()} == expected
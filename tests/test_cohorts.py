@@ -0,0 +1,273 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from duckdb_util import get_connection, translate
+
+duckdb = pytest.importorskip("duckdb")
+pytest.importorskip("google.cloud.bigquery")
+
+from datasets.cohorts.admissions import (
+    AdmissionCohort, AdmissionFilteredCohort, IncrementalAdmissionCohort
+)
+from datasets.cohorts.local import rollup_admissions, sample_admissions
+from datasets.labelers import Labeler
+
+
+class RecordingClient:
+    """
+    Stand-in for bigquery.Client recording the queries instead of running them
+    """
+    def __init__(self):
+        self.queries = []
+
+    def query(self, query, job_config=None, **kwargs):
+        self.queries.append(query)
+        return self
+
+    def result(self, *args, **kwargs):
+        return self
+
+
+CONFIG = {
+    "dataset_project": "p",
+    "rs_dataset_project": "p",
+    "rs_dataset": "rs",
+    "partition_by": "",
+    "cluster_by": [],
+}
+
+
+def get_cohort(cls=AdmissionCohort, **kwargs):
+    return cls(client=RecordingClient(), **{**CONFIG, **kwargs})
+
+
+def get_visits(rows):
+    return pd.DataFrame(
+        [
+            (person_id, 9201, pd.Timestamp(start), pd.Timestamp(end))
+            for person_id, start, end in rows
+        ],
+        columns=["person_id", "visit_concept_id", "visit_start_datetime", "visit_end_datetime"],
+    )
+
+
+def make_visits(seed, n_persons=200):
+    """
+    Visits of random lengths with overlapping and touching stays, at minute resolution
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for person_id in rng.choice(10**6, n_persons, replace=False):
+        t = pd.Timestamp("2020-01-01") + pd.Timedelta(minutes=int(rng.integers(0, 10**5)))
+        for _ in range(rng.integers(1, 8)):
+            start = t + pd.Timedelta(minutes=int(rng.integers(-3000, 3000)))
+            end = start + pd.Timedelta(minutes=int(rng.integers(-60, 4000)))
+            rows.append((person_id, rng.choice([9201, 262, 9202]), start, end))
+            # the next visit may start at the end of this one
+            t = end if rng.random() < 0.3 else start
+    return pd.DataFrame(
+        rows,
+        columns=["person_id", "visit_concept_id", "visit_start_datetime", "visit_end_datetime"],
+    )
+
+
+def naive_rollup(visits, min_stay_hour=None):
+    visits = visits[
+        visits.visit_concept_id.isin([9201, 262])
+        & (visits.visit_end_datetime > visits.visit_start_datetime)
+    ]
+    if min_stay_hour is not None:
+        stay_hours = (
+            visits.visit_end_datetime.dt.floor("h") - visits.visit_start_datetime.dt.floor("h")
+        ) / pd.Timedelta(hours=1)
+        visits = visits[stay_hours > min_stay_hour]
+
+    rows = []
+    for person_id, group in visits.sort_values("visit_start_datetime").groupby("person_id"):
+        admit, discharge = None, None
+        for start, end in zip(group.visit_start_datetime, group.visit_end_datetime):
+            if discharge is not None and start <= discharge:
+                discharge = max(discharge, end)
+                continue
+            if discharge is not None:
+                rows.append((person_id, admit, discharge))
+            admit, discharge = start, end
+        rows.append((person_id, admit, discharge))
+    return pd.DataFrame(rows, columns=["person_id", "admit_date", "discharge_date"])
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("min_stay_hour", [None, 24])
+def test_rollup_admissions(seed, min_stay_hour):
+    visits = make_visits(seed)
+    expected = naive_rollup(visits, min_stay_hour)
+    result = rollup_admissions(visits, min_stay_hour=min_stay_hour)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    # the same admissions as the query of AdmissionCohort
+    person = visits[["person_id"]].drop_duplicates()
+    con = get_connection(duckdb, {"visit_occurrence": visits, "person": person})
+    cohort = get_cohort(dataset_project="p", dataset="d", min_stay_hour=min_stay_hour)
+    query_result = con.execute(translate(cohort.get_transform_query())).df()
+    pd.testing.assert_frame_equal(
+        result, query_result[result.columns], check_dtype=False
+    )
+
+
+def test_rollup_admissions_wide_span():
+    # endpoints with nanoseconds, more than 2**63 nanoseconds apart
+    visits = pd.DataFrame({
+        "person_id": [2, 1, 1, 2, 2],
+        "visit_concept_id": 9201,
+        "visit_start_datetime": pd.to_datetime(
+            [
+                "1700-01-01 00:00:00.000000001", "2200-01-01", "2200-01-02",
+                "1700-01-01 00:00:00.5", "2200-01-01",
+            ],
+            format="ISO8601",
+        ).as_unit("ns"),
+        "visit_end_datetime": pd.to_datetime(
+            ["1700-01-01 00:00:00.5", "2200-01-02", "2200-01-03", "1700-01-02", "2200-01-02"],
+            format="ISO8601",
+        ).as_unit("ns"),
+    })
+    result = rollup_admissions(visits)
+    pd.testing.assert_frame_equal(result, naive_rollup(visits), check_dtype=False)
+    assert len(result) == 3
+
+
+def test_sample_admissions():
+    admissions = rollup_admissions(make_visits(0))
+    sample = sample_admissions(admissions, seed=1)
+
+    pd.testing.assert_frame_equal(sample, sample_admissions(admissions, seed=1))
+    assert sample.person_id.is_unique
+    assert set(sample.person_id) == set(admissions.person_id)
+    assert len(sample.merge(admissions)) == len(sample)
+    assert not sample.equals(sample_admissions(admissions, seed=2))
+
+
+def get_sampled_persons(con, cohort, visits):
+    """
+    Persons of the base query of a cohort, which must keep every visit of a sampled person
+    """
+    result = con.execute(translate(f"SELECT * FROM {cohort.get_base_query()}")).df()
+    persons = set(result.person_id)
+    assert len(result) == visits.person_id.isin(persons).sum()
+    return persons
+
+
+@pytest.mark.parametrize(
+    "sample_config", [{"sample_fraction": 0.3}, {"sample_persons": 20}]
+)
+def test_sample_persons(sample_config):
+    visits = make_visits(0)
+    visits = visits[visits.visit_end_datetime > visits.visit_start_datetime]
+    visits = visits.assign(visit_concept_id=9201)
+    con = get_connection(
+        duckdb,
+        {"visit_occurrence": visits, "person": visits[["person_id"]].drop_duplicates()},
+    )
+
+    def sample(cohort_class=AdmissionCohort, seed=0):
+        cohort = get_cohort(
+            cohort_class, dataset="d", rs_dataset="d", cohort_name="visit_occurrence",
+            sample_seed=seed, **sample_config,
+        )
+        return get_sampled_persons(con, cohort, visits)
+
+    persons = sample()
+    assert persons == sample()
+    assert persons != sample(seed=1)
+    if "sample_persons" in sample_config:
+        assert len(persons) == 20
+    else:
+        assert 0.2 < len(persons) / visits.person_id.nunique() < 0.4
+
+    # drawn from a table with several rows per person
+    assert sample(AdmissionFilteredCohort) == persons
+    assert sample(AdmissionFilteredCohort, seed=1) == sample(seed=1)
+
+
+def test_incremental_admission_cohort():
+    person = pd.DataFrame({"person_id": [1, 2, 3]})
+    previous_visits = get_visits([
+        # person 1 has the same visit twice, replaced by another visit twice
+        (1, "2020-01-01", "2020-01-03"),
+        (1, "2020-01-01", "2020-01-03"),
+        # person 2 is discharged later in the current release
+        (2, "2020-02-01", "2020-02-04"),
+        (3, "2020-03-01", "2020-03-02"),
+    ])
+    current_visits = get_visits([
+        (1, "2020-01-05", "2020-01-07"),
+        (1, "2020-01-05", "2020-01-07"),
+        (2, "2020-02-01", "2020-02-06"),
+        (3, "2020-03-01", "2020-03-02"),
+    ])
+    con = get_connection(
+        duckdb,
+        {
+            "previous.person": person,
+            "previous.visit_occurrence": previous_visits,
+            "current.person": person,
+            "current.visit_occurrence": current_visits,
+        },
+        dataset=["previous", "current", "rs"],
+    )
+    con.execute(translate(get_cohort(dataset="previous").get_create_query()))
+
+    cohort = get_cohort(IncrementalAdmissionCohort, dataset="current", previous_dataset="previous")
+    changed_persons = con.execute(translate(cohort.get_changed_persons_query())).fetchall()
+    assert sorted(changed_persons) == [(1,), (2,)]
+
+    con.execute(translate(cohort.get_create_query()))
+    changes = con.execute("""
+        SELECT person_id, admit_date, discharge_date, previous_discharge_date, change_type
+        FROM p.rs.temp_cohort_changes
+        ORDER BY person_id, admit_date
+    """).fetchall()
+    assert changes == [
+        (1, pd.Timestamp("2020-01-01"), pd.Timestamp("2020-01-03"), pd.Timestamp("2020-01-03"), "removed"),
+        (1, pd.Timestamp("2020-01-05"), pd.Timestamp("2020-01-07"), None, "added"),
+        (2, pd.Timestamp("2020-02-01"), pd.Timestamp("2020-02-06"), pd.Timestamp("2020-02-04"), "changed"),
+    ]
+
+    # the refreshed cohort matches the cohort built from the current release
+    refreshed = con.execute("SELECT * FROM p.rs.temp_cohort ORDER BY person_id, admit_date").df()
+    con.execute(translate(get_cohort(dataset="current", cohort_name="rebuilt").get_create_query()))
+    rebuilt = con.execute("SELECT * FROM p.rs.rebuilt ORDER BY person_id, admit_date").df()
+    pd.testing.assert_frame_equal(refreshed, rebuilt)
+
+
+def test_assign_row_id_matches_admission_cohort():
+    visits = make_visits(1)
+    con = get_connection(
+        duckdb,
+        {"visit_occurrence": visits, "person": visits[["person_id"]].drop_duplicates()},
+    )
+    con.execute(translate(get_cohort(dataset="d", rs_dataset="d").get_create_query()))
+    expected = con.execute("SELECT * FROM p.d.temp_cohort ORDER BY prediction_id").df()
+    assert expected.prediction_id.notna().all() and expected.prediction_id.is_unique
+
+    # a local cohort uploaded without row_id
+    con.execute("""
+        CREATE TABLE p.d.uploaded AS 
+        SELECT person_id, admit_date, discharge_date FROM p.d.temp_cohort
+    """)
+    cohort = get_cohort(dataset="d", rs_dataset="d", cohort_name="uploaded")
+    con.execute(translate(cohort.get_assign_row_id_query()))
+    result = con.execute("SELECT * FROM p.d.uploaded ORDER BY prediction_id").df()
+    pd.testing.assert_frame_equal(result[expected.columns], expected)
+
+    # the row_id computed by labelers for cohorts without one
+    labeler = Labeler(
+        client=RecordingClient(), rs_dataset_project="p", rs_dataset="d",
+        cohort_name="uploaded", assign_row_id=True,
+    )
+    con.execute("ALTER TABLE p.d.uploaded DROP COLUMN prediction_id")
+    result = con.execute(translate(
+        f"SELECT * FROM {labeler.get_cohort_table()} ORDER BY prediction_id"
+    )).df()
+    pd.testing.assert_frame_equal(result[expected.columns], expected)
@@ -0,0 +1,197 @@
+import os
+import re
+import shutil
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+pytest.importorskip("google.cloud.bigquery")
+
+from datasets.database import Database, get_arrow_schema
+
+
+class LoadClient:
+    """
+    Stand-in for bigquery.Client keeping the Parquet files of load jobs
+    """
+    def __init__(self):
+        self.tables = {}
+
+    def load_table_from_file(self, fp, destination, job_config=None):
+        self.tables[destination] = pq.read_table(fp)
+        return self
+
+    def result(self):
+        return self
+
+
+def test_load_dataframe_with_null_chunks():
+    df = pd.DataFrame({
+        "person_id": [1, 2, 3, 4],
+        "note": [None, None, "a", "b"],
+        "missing": [None, None, None, None],
+        "admit_date": pd.to_datetime(["2020-01-01", None, "2020-01-03", "2020-01-04"]),
+    })
+    client = LoadClient()
+    Database(client=client).load_dataframe(df, "p.d.cohort", chunk_size=2)
+
+    table = client.tables["p.d.cohort"]
+    assert pa.types.is_string(table.schema.field("note").type) or pa.types.is_large_string(
+        table.schema.field("note").type
+    )
+    assert table.schema.field("missing").type == pa.string()
+    assert table.column("note").to_pylist() == [None, None, "a", "b"]
+    assert table.column("person_id").to_pylist() == [1, 2, 3, 4]
+
+
+def test_arrow_schema_from_pyarrow_table():
+    table = pa.table({"x": pa.array([None, None]), "y": [1.0, 2.0]})
+    assert get_arrow_schema(table) == pa.schema([("x", pa.string()), ("y", pa.float64())])
+
+
+class DirectoryBlob:
+    def __init__(self, root, name):
+        self.path = os.path.join(root, name)
+        self.name = name
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+    def delete(self):
+        os.remove(self.path)
+
+
+class DirectoryStorageClient:
+    """
+    Stand-in for storage.Client backed by a local directory with a subdirectory per bucket
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def list_blobs(self, bucket_name, prefix=None):
+        bucket = os.path.join(self.root, bucket_name)
+        for dirpath, _, filenames in os.walk(bucket):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), bucket)
+                if prefix is None or name.startswith(prefix):
+                    yield DirectoryBlob(bucket, name)
+
+
+class ExportClient:
+    """
+    Stand-in for bigquery.Client writing the shards of EXPORT DATA to a DirectoryStorageClient
+    """
+    def __init__(self, root, shards):
+        self.root = root
+        self.shards = shards
+        self.queries = []
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        uri = re.search(r"uri='gs://([^']*)/\*\.parquet'", query).group(1)
+        os.makedirs(os.path.join(self.root, uri), exist_ok=True)
+        for i, shard in enumerate(self.shards):
+            pq.write_table(shard, os.path.join(self.root, uri, f"{i:012d}.parquet"))
+        return self
+
+    def result(self):
+        return self
+
+
+def test_export_table(tmp_path):
+    root = str(tmp_path / "gcs")
+    shards = [pa.table({"x": [i, i + 1]}) for i in range(0, 6, 2)]
+    client = ExportClient(root, shards)
+    storage_client = DirectoryStorageClient(root)
+    db = Database(client=client, storage_client=storage_client)
+
+    # files of earlier exports and of other prefixes are neither downloaded nor deleted
+    stale = pa.table({"x": [-1]})
+    for name in ["export/stale.parquet", "export/old/000000000000.parquet", "other.parquet"]:
+        os.makedirs(os.path.dirname(os.path.join(root, "bucket", name)), exist_ok=True)
+        pq.write_table(stale, os.path.join(root, "bucket", name))
+
+    output_path = str(tmp_path / "output")
+    db.export_table("p.d.features", output_path, "gs://bucket/export/")
+
+    assert sorted(os.listdir(output_path)) == [f"features_{i}.parquet" for i in range(3)]
+    for i, shard in enumerate(shards):
+        assert pq.read_table(os.path.join(output_path, f"features_{i}.parquet")).equals(shard)
+    assert sorted(blob.name for blob in storage_client.list_blobs("bucket")) == [
+        "export/old/000000000000.parquet", "export/stale.parquet", "other.parquet"
+    ]
+
+    # each export writes to its own subprefix
+    db.export_table("p.d.features", str(tmp_path / "output_2"), "gs://bucket/export")
+    uris = [re.search(r"uri='([^']*)'", query).group(1) for query in client.queries]
+    assert all(uri.startswith("gs://bucket/export/") for uri in uris)
+    assert uris[0] != uris[1]
+    assert len(os.listdir(tmp_path / "output_2")) == 3
+
+    # an existing output_path or a location without prefix fails before the export is run
+    for output, gcs_uri in [
+        (output_path, "gs://bucket/export"),
+        (str(tmp_path / "output_3"), "gs://bucket"),
+        (str(tmp_path / "output_3"), "gs://bucket/"),
+        (str(tmp_path / "output_3"), "bucket/export"),
+    ]:
+        with pytest.raises(ValueError):
+            db.export_table("p.d.features", output, gcs_uri)
+    assert len(client.queries) == 2
+    assert not os.path.exists(tmp_path / "output_3")
+
+
+class SessionClient:
+    """
+    Stand-in for bigquery.Client recording the statements and the session of each job
+    """
+    def __init__(self, fail_on=None):
+        self.jobs = []
+        self.fail_on = fail_on
+
+    def query(self, query, job_config=None):
+        if job_config is not None and job_config.create_session:
+            session_id = "new"
+        else:
+            properties = job_config.connection_properties if job_config is not None else []
+            session_id = {x.key: x.value for x in properties}.get("session_id")
+        self.jobs.append((query, session_id))
+        return SessionJob(query, self.fail_on)
+
+
+class SessionJob:
+    def __init__(self, query, fail_on):
+        self.query = query
+        self.fail_on = fail_on
+        self.session_info = SimpleNamespace(session_id="session_1")
+
+    def result(self):
+        if self.query == self.fail_on:
+            raise RuntimeError(self.query)
+        return self.query
+
+
+def test_execute_sql_in_session():
+    client = SessionClient()
+    results = Database(client=client).execute_sql_in_session(["q1;", "q2;", "q3;"])
+
+    assert results == ["q1;", "q2;", "q3;"]
+    assert client.jobs == [
+        ("q1;", "new"),
+        ("q2;", "session_1"),
+        ("q3;", "session_1"),
+        ("CALL BQ.ABORT_SESSION();", "session_1"),
+    ]
+
+    # the session is aborted when a statement fails
+    client = SessionClient(fail_on="q2;")
+    with pytest.raises(RuntimeError):
+        Database(client=client).execute_sql_in_session(["q1;", "q2;", "q3;"])
+    assert client.jobs == [
+        ("q1;", "new"),
+        ("q2;", "session_1"),
+        ("CALL BQ.ABORT_SESSION();", "session_1"),
+    ]
@@ -0,0 +1,112 @@
+"""
+FusedDemographicsQuery labels like the individual demographics queries, checked in DuckDB
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from duckdb_util import DuckDBClient, get_connection, translate
+
+duckdb = pytest.importorskip("duckdb")
+pytest.importorskip("google.cloud.bigquery")
+
+from datasets.labelers import Labeler
+from datasets.labelers.demographics import FusedDemographicsQuery
+
+LABELER_IDS = ["age", "sex", "race", "ethnicity"]
+CONCEPTS = {
+    0: "No matching concept",
+    8507: "MALE",
+    8532: "FEMALE",
+    8516: "Black or African American",
+    8527: "White",
+    38003563: "Hispanic or Latino",
+    38003564: "Not Hispanic or Latino",
+}
+
+
+def make_data(seed, n_persons=200):
+    """
+    Persons of all ages with one or two admissions, some of their concepts unknown
+    or missing from the concept table
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2020-01-01")
+    cohort, persons = [], []
+    for person_id in range(n_persons):
+        persons.append((
+            person_id,
+            start - pd.Timedelta(days=int(rng.integers(0, 100 * 365))),
+            rng.choice([8507, 8532, 0]),
+            rng.choice([8516, 8527, 0, 99]),
+            rng.choice([38003563, 38003564, 0]),
+        ))
+        for _ in range(rng.integers(1, 3)):
+            admit = start + pd.Timedelta(hours=int(rng.integers(0, 24 * 365)))
+            cohort.append((person_id, admit, admit + pd.Timedelta(days=2), len(cohort)))
+
+    return {
+        "cohort": pd.DataFrame(
+            cohort, columns=["person_id", "admit_date", "discharge_date", "prediction_id"]
+        ),
+        "person": pd.DataFrame(
+            persons,
+            columns=[
+                "person_id", "birth_datetime", "gender_concept_id", "race_concept_id",
+                "ethnicity_concept_id",
+            ],
+        ),
+        "concept": pd.DataFrame({
+            "concept_id": list(CONCEPTS), "concept_name": list(CONCEPTS.values()),
+        }),
+    }
+
+
+def get_labeler(con, **kwargs):
+    return Labeler(
+        client=DuckDBClient(con), dataset_project="p", dataset="d", rs_dataset_project="p",
+        rs_dataset="d", temp_dataset="d", cohort_name="cohort", partition_by="", cluster_by=[],
+        prune_measurements=False, temp_table_expiration_hours=0, **kwargs
+    )
+
+
+def run(con, labeler, query):
+    sql = labeler.format_query(query, query.base_query, labeler.get_cohort_table())
+    return con.execute(translate(sql)).df().set_index("prediction_id").sort_index()
+
+
+@pytest.mark.parametrize("seed", range(2))
+def test_fused_demographics_matches_individual_queries(seed):
+    con = get_connection(duckdb, make_data(seed))
+    labeler = get_labeler(con)
+
+    expected = pd.concat(
+        [run(con, labeler, labeler.queries[labeler_id]) for labeler_id in LABELER_IDS], axis=1
+    )
+    result = run(
+        con, labeler, FusedDemographicsQuery([labeler.queries[x] for x in LABELER_IDS])
+    )
+
+    assert expected.sex.nunique() == 3 and expected.race.nunique() == 3
+    assert expected.race.isna().any() and expected.drop(columns="race").notna().all().all()
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_fused_demographics_label_table():
+    con = get_connection(duckdb, make_data(0))
+    labeler_ids = ["sex", "age", "ethnicity", "race"]
+
+    labeler = get_labeler(con, target_table_name="individual")
+    assert not labeler.config["fuse_demographics_labelers"]
+    labeler.create_label_table(labeler_ids)
+    get_labeler(
+        con, target_table_name="fused", fuse_demographics_labelers=True
+    ).create_label_table(labeler_ids)
+
+    expected = con.execute("SELECT * FROM p.d.individual ORDER BY prediction_id").df()
+    result = con.execute("SELECT * FROM p.d.fused ORDER BY prediction_id").df()
+    assert list(expected.columns[4:]) == [
+        "sex", "age_days", "pediatric_age_group", "age_group", "ethnicity", "race"
+    ]
+    pd.testing.assert_frame_equal(result, expected)
@@ -0,0 +1,94 @@
+"""
+FusedDxLabelQuery labels like the individual DxLabelQuery, checked in DuckDB
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from duckdb_util import DuckDBClient, get_connection, translate
+
+duckdb = pytest.importorskip("duckdb")
+pytest.importorskip("google.cloud.bigquery")
+
+from datasets.labelers import Labeler
+from datasets.labelers.dx_based import FusedDxLabelQuery
+
+LABELER_IDS = ["aki_dx", "hyperkalemia_dx", "anemia_dx"]
+# a descendant of both the aki_dx and hyperkalemia_dx concepts
+SHARED_CONCEPT = 999
+CONCEPT_IDS = [197320, 432961, 434610, 439777, SHARED_CONCEPT, 5]
+
+
+def make_data(seed, n_persons=200):
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2020-01-01")
+    cohort, conditions = [], []
+    for person_id in range(n_persons):
+        admit = start + pd.Timedelta(hours=int(rng.integers(0, 1000)))
+        discharge = admit + pd.Timedelta(hours=int(rng.integers(12, 120)))
+        cohort.append((person_id, admit, discharge, person_id))
+        for _ in range(rng.integers(0, 6)):
+            time = admit + pd.Timedelta(hours=int(rng.integers(-24, 150)))
+            conditions.append((person_id, int(rng.choice(CONCEPT_IDS)), time))
+
+    return {
+        "cohort": pd.DataFrame(
+            cohort, columns=["person_id", "admit_date", "discharge_date", "prediction_id"]
+        ),
+        "condition_occurrence": pd.DataFrame(
+            conditions, columns=["person_id", "condition_concept_id", "condition_start_DATETIME"]
+        ),
+        "concept": pd.DataFrame({
+            "concept_id": CONCEPT_IDS,
+            "invalid_reason": [None] * len(CONCEPT_IDS),
+        }),
+        "concept_ancestor": pd.DataFrame({
+            "ancestor_concept_id": [197320, 434610],
+            "descendant_concept_id": [SHARED_CONCEPT, SHARED_CONCEPT],
+        }),
+    }
+
+
+def run(con, labeler, query):
+    query = labeler.get_configured_query(query)
+    sql = labeler.format_query(query, query.base_query, labeler.get_cohort_table())
+    return con.execute(translate(sql)).df().set_index("prediction_id").sort_index()
+
+
+@pytest.mark.parametrize("seed", range(2))
+@pytest.mark.parametrize("window_horizons", [None, {"24h": 24, "discharge": "discharge_date"}])
+def test_fused_dx_matches_individual_queries(seed, window_horizons):
+    con = get_connection(duckdb, make_data(seed))
+    labeler = Labeler(
+        client=DuckDBClient(con), dataset_project="p", dataset="d", rs_dataset_project="p",
+        rs_dataset="d", cohort_name="cohort", window_horizons=window_horizons,
+    )
+    queries = [labeler.queries[x] for x in LABELER_IDS]
+
+    expected = pd.concat([run(con, labeler, query) for query in queries], axis=1)
+    result = run(con, labeler, FusedDxLabelQuery(queries))
+
+    label_columns = [x for x in expected.columns if "_label" in x]
+    assert len(label_columns) == len(LABELER_IDS) * (len(window_horizons or {}) or 1)
+    assert (expected[label_columns].sum() > 0).all()
+    assert list(result.columns) == list(expected.columns)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_shared_concept_labels_both_labelers():
+    tables = make_data(0)
+    tables["condition_occurrence"] = pd.DataFrame({
+        "person_id": [0],
+        "condition_concept_id": [SHARED_CONCEPT],
+        "condition_start_DATETIME": [tables["cohort"].admit_date[0]],
+    })
+    con = get_connection(duckdb, tables)
+    labeler = Labeler(
+        client=DuckDBClient(con), dataset_project="p", dataset="d", rs_dataset_project="p",
+        rs_dataset="d", cohort_name="cohort",
+    )
+    result = run(con, labeler, FusedDxLabelQuery([labeler.queries[x] for x in LABELER_IDS]))
+    assert result.loc[0, ["aki_dx_label", "hyperkalemia_dx_label", "anemia_dx_label"]].tolist() == [
+        1, 1, 0
+    ]
+    assert result[["aki_dx_label", "hyperkalemia_dx_label"]].sum().tolist() == [1, 1]
@@ -0,0 +1,285 @@
+"""
+Lab-based labelers run in DuckDB on small synthetic tables
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from duckdb_util import DuckDBClient, get_connection, translate
+
+duckdb = pytest.importorskip("duckdb")
+pytest.importorskip("google.cloud.bigquery")
+
+from datasets.labelers import Labeler
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), "data")
+
+POTASSIUM = 40653595
+GLUCOSE = 4144235
+CREATININE = 3051825
+
+
+def get_tables(cohort, measurements, persons=None):
+    """
+    Tables read by the lab-based labelers. cohort rows are (person_id, admit_date, discharge_date)
+    and measurements are (person_id, concept_id, value, measurement_datetime), optionally
+    followed by (unit_concept_id, range_low, range_high). Units default to mmol/L, or umol/L
+    for creatinine, and reference ranges to [1, 5]
+    """
+    cohort = pd.DataFrame(cohort, columns=["person_id", "admit_date", "discharge_date"])
+    cohort = cohort.assign(prediction_id=range(len(cohort)))
+    columns = [
+        "person_id", "measurement_concept_id", "value_as_number", "measurement_datetime",
+        "unit_concept_id", "range_low", "range_high",
+    ]
+    measurement = pd.DataFrame(
+        [tuple(x) + (None,) * (len(columns) - len(x)) for x in measurements], columns=columns
+    )
+    default_unit = measurement.measurement_concept_id.map(
+        lambda x: 8749 if x == CREATININE else 8753
+    )
+    measurement = measurement.assign(
+        unit_concept_id=measurement.unit_concept_id.fillna(default_unit).astype(int),
+        range_low=measurement.range_low.fillna(1.0).astype(float),
+        range_high=measurement.range_high.fillna(5.0).astype(float),
+    )
+    concept_ids = [POTASSIUM, GLUCOSE, CREATININE]
+    if persons is None:
+        persons = pd.DataFrame({
+            "person_id": cohort.person_id.unique(),
+            "birth_datetime": pd.Timestamp("1980-01-01"),
+            "gender_concept_id": 8532,
+            "race_concept_id": 0,
+            "ethnicity_concept_id": 0,
+        })
+    return {
+        "cohort": cohort,
+        "measurement": measurement,
+        "person": persons,
+        "concept": pd.DataFrame({
+            "concept_id": concept_ids,
+            "concept_name": "concept",
+            "invalid_reason": [None] * len(concept_ids),
+        }),
+        "concept_ancestor": pd.DataFrame({
+            "ancestor_concept_id": concept_ids, "descendant_concept_id": concept_ids,
+        }),
+    }
+
+
+def get_labels(tables, labeler_id, **kwargs):
+    """
+    Labels of the cohort computed by the base query of a labeler, by prediction_id
+    """
+    con = get_connection(duckdb, tables)
+    labeler = Labeler(
+        client=DuckDBClient(con), dataset_project="p", dataset="d", rs_dataset_project="p",
+        rs_dataset="d", cohort_name="cohort", prune_measurements=False, **kwargs
+    )
+    query = labeler.get_configured_query(labeler.queries[labeler_id])
+    sql = labeler.format_query(query, query.base_query, labeler.get_cohort_table())
+    return con.execute(translate(sql)).df().set_index("prediction_id").sort_index()
+
+
+def get_reference_labels(tables, labeler_id, **kwargs):
+    """
+    Labels of the cohort computed by the former query of a labeler in data/, by prediction_id
+    """
+    name = labeler_id.split("_")[0]
+    with open(os.path.join(DATA_PATH, f"{name}_reference.sql")) as f:
+        reference_query = f.read().format_map({
+            "dataset_project": "p",
+            "dataset": "d",
+            "cohort_table": "p.d.cohort",
+            "row_id": "prediction_id",
+            "window_start_field": "admit_date",
+            "window_end_field": "discharge_date",
+            "labeler_id": labeler_id,
+            **kwargs,
+        })
+    con = get_connection(duckdb, tables)
+    return con.execute(translate(reference_query)).df().set_index("prediction_id").sort_index()
+
+
+def test_window_horizons():
+    admit = pd.Timestamp("2020-01-01")
+    hours = lambda x: admit + pd.Timedelta(hours=x)
+    seconds = lambda x: pd.Timedelta(seconds=x)
+    tables = get_tables(
+        [(1, admit, hours(96)), (2, admit, hours(12))],
+        [
+            # exactly at the end of the 24h horizon
+            (1, POTASSIUM, 5.8, hours(24)),
+            (1, POTASSIUM, 6.5, hours(24) + seconds(1)),
+            # exactly at discharge and after it
+            (1, POTASSIUM, 7.5, hours(96)),
+            (1, POTASSIUM, 8.0, hours(96) + seconds(1)),
+            # after an early discharge but within 24h
+            (2, POTASSIUM, 6.5, hours(20)),
+        ],
+    )
+    labels = get_labels(
+        tables, "hyperkalemia_lab", window_horizons={"24h": 24, "discharge": "discharge_date"}
+    )
+
+    label = lambda name, horizon: labels[f"hyperkalemia_lab_{name}_label_{horizon}"].tolist()
+    assert label("mild", "24h") == [1, 1]
+    assert label("moderate", "24h") == [0, 1]
+    assert label("severe", "24h") == [0, 0]
+    assert label("moderate", "discharge") == [1, 0]
+    assert label("severe", "discharge") == [1, 0]
+    assert labels["hyperkalemia_lab_max_potassium_24h"].tolist() == [5.8, 6.5]
+    assert labels["hyperkalemia_lab_max_potassium_discharge"].tolist()[0] == 7.5
+    assert labels["hyperkalemia_lab_mild_measurement_datetime_24h"].tolist()[0] == hours(24)
+
+
+def make_data(seed, concept_id, units, values, n_persons=200):
+    """
+    One or two admissions per person and measurements of a concept in the given units 
+    (unit_concept_id, factor to mmol/L) with mmol/L values drawn uniformly from `values`.
+    Measurements are on the hour, such that several measurements often share a time.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2020-01-01")
+    cohort, measurements = [], []
+    for person_id in range(n_persons):
+        first_admit = t = start + pd.Timedelta(hours=int(rng.integers(0, 1000)))
+        for _ in range(rng.integers(1, 3)):
+            admit = t
+            discharge = admit + pd.Timedelta(hours=int(rng.integers(24, 120)))
+            cohort.append((person_id, admit, discharge))
+            t = discharge + pd.Timedelta(hours=int(rng.integers(1, 200)))
+
+        n_hours = int((discharge - first_admit) / pd.Timedelta(hours=1)) + 48
+        for _ in range(rng.integers(0, 15)):
+            time = first_admit + pd.Timedelta(hours=int(rng.integers(-24, n_hours)))
+            unit, factor = units[rng.integers(len(units))]
+            value = rng.uniform(*values)
+            low, high = rng.uniform(values[0], values[1], 2) / factor
+            measurements.append(
+                (person_id, concept_id, value / factor, time, unit, min(low, high), max(low, high))
+            )
+    return get_tables(cohort, measurements)
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize(
+    "labeler_id,concept_id,units,values",
+    [
+        # strict thresholds
+        ("hyperkalemia_lab", POTASSIUM, [(8753, 1), (9557, 1), (8840, 1 / 18)], (3, 8)),
+        # inclusive mild threshold (<= 3.9)
+        ("hypoglycemia_lab", GLUCOSE, [(8753, 1), (8840, 1 / 18), (9028, 1 / 18)], (2, 6)),
+    ],
+)
+def test_threshold_labels_match_reference(seed, labeler_id, concept_id, units, values):
+    """
+    ThresholdLabQuery labels like the former query with one ROW_NUMBER per threshold
+    """
+    tables = make_data(seed, concept_id, units, values)
+    times = tables["measurement"][["person_id", "measurement_datetime"]]
+    assert times.duplicated().sum() > 20
+
+    result = get_labels(tables, labeler_id)
+
+    expected = get_reference_labels(tables, labeler_id)
+
+    for threshold in ["mild", "moderate", "severe", "abnormal"]:
+        assert 0 < expected[f"{labeler_id}_{threshold}_label"].sum() < len(expected)
+    assert sorted(result.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(
+        result[expected.columns], expected, check_dtype=False, check_exact=False
+    )
+
+
+def test_aki_baseline_bounds():
+    admit = pd.Timestamp("2020-06-01 08:00")
+    days = lambda x: admit + pd.Timedelta(days=x)
+    tables = get_tables(
+        [(1, admit, days(5)), (2, admit, days(5))],
+        [
+            # exactly 90 days before the window start is in the baseline
+            (1, CREATININE, 50.0, days(-90)),
+            (2, CREATININE, 50.0, days(-90) - pd.Timedelta(seconds=1)),
+            # exactly at the window start is not
+            (1, CREATININE, 30.0, admit),
+            (2, CREATININE, 30.0, admit),
+            (1, CREATININE, 100.0, days(1)),
+            (2, CREATININE, 100.0, days(1)),
+        ],
+    )
+    labels = get_labels(tables, "aki_lab")
+
+    # baselines of 50 and of the adult norm (97.2 umol/L)
+    assert labels["aki_lab_aki2_label"].tolist() == [1, 0]
+    assert labels["aki_lab_aki3_label"].tolist() == [0, 0]
+    assert labels["aki_lab_aki1_label"].tolist() == [1, 0]
+    assert labels["aki_lab_aki1_measurement_datetime"].tolist()[0] == days(1)
+    pd.testing.assert_frame_equal(
+        labels, get_reference_labels(tables, "aki_lab", lookback_days=90)[labels.columns]
+    )
+
+
+def make_aki_data(seed, n_persons=200):
+    """
+    Creatinine measurements (umol/L or mg/dL) of persons of all ages over their admissions and
+    the preceding months, including measurements exactly 90 days before and at admission
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2020-01-01")
+    cohort, measurements, persons = [], [], []
+    for person_id in range(n_persons):
+        persons.append((
+            person_id,
+            start - pd.Timedelta(days=int(rng.integers(0, 80 * 365))),
+            rng.choice([8532, 8507]),
+        ))
+        first_admit = t = start + pd.Timedelta(hours=int(rng.integers(0, 24 * 365)))
+        for _ in range(rng.integers(1, 3)):
+            admit = t
+            discharge = admit + pd.Timedelta(hours=int(rng.integers(24, 240)))
+            cohort.append((person_id, admit, discharge))
+            t = discharge + pd.Timedelta(days=int(rng.integers(1, 120)))
+
+            for time in [admit - pd.Timedelta(days=90), admit]:
+                if rng.random() < 0.5:
+                    measurements.append((person_id, time, rng.uniform(20, 80)))
+
+        n_hours = int((discharge - first_admit) / pd.Timedelta(hours=1)) + 24 * 120
+        for _ in range(rng.integers(0, 20)):
+            time = discharge - pd.Timedelta(hours=int(rng.integers(0, n_hours)))
+            measurements.append((person_id, time, rng.uniform(40, 400)))
+
+    rows = []
+    for person_id, time, value in measurements:
+        unit, factor = [(8749, 1), (8840, 0.0113122)][rng.integers(2)]
+        high = rng.uniform(80, 120) * factor
+        rows.append((person_id, CREATININE, value * factor, time, unit, 0, high))
+    persons = pd.DataFrame(persons, columns=["person_id", "birth_datetime", "gender_concept_id"])
+    persons = persons.assign(race_concept_id=0, ethnicity_concept_id=0)
+    return get_tables(cohort, rows, persons)
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_aki_labels_match_reference(seed):
+    """
+    The baseline of each window from an ordered window over the creatinine of the person is
+    the minimum over the 90 days before the window start, as in the former grouped query
+    """
+    tables = make_aki_data(seed)
+    cohort, measurement = tables["cohort"], tables["measurement"]
+    lookback_start = cohort.assign(measurement_datetime=cohort.admit_date - pd.Timedelta(days=90))
+    for boundary in [lookback_start, cohort.assign(measurement_datetime=cohort.admit_date)]:
+        assert len(boundary.merge(measurement, on=["person_id", "measurement_datetime"])) > 20
+
+    result = get_labels(tables, "aki_lab")
+    expected = get_reference_labels(tables, "aki_lab", lookback_days=90)
+
+    for threshold in ["aki1", "aki2", "aki3", "abnormal"]:
+        assert 0 < expected[f"aki_lab_{threshold}_label"].sum() < len(expected)
+    assert sorted(result.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(
+        result[expected.columns], expected, check_dtype=False, check_exact=False
+    )
@@ -0,0 +1,251 @@
+import pandas as pd
+import pytest
+
+from duckdb_util import DuckDBClient, get_connection
+
+pytest.importorskip("google.cloud.bigquery")
+
+from datasets.labelers import Labeler
+
+
+class RecordingClient:
+    """
+    Stand-in for bigquery.Client recording the queries instead of running them
+    """
+    def __init__(self):
+        self.queries = []
+
+    def query(self, query, job_config=None, **kwargs):
+        self.queries.append(query)
+        return self
+
+    def result(self, *args, **kwargs):
+        return self
+
+    def __iter__(self):
+        return iter([])
+
+    def to_dataframe(self):
+        return pd.DataFrame()
+
+
+def get_labeler(**kwargs):
+    return Labeler(client=RecordingClient(), **kwargs)
+
+
+def test_label_query_does_not_mutate_queries():
+    labeler = get_labeler(window_horizons={"24h": 24}, readmission_horizons=[30])
+    configs = {k: dict(query.config) for k, query in labeler.queries.items()}
+    base_queries = {k: query.base_query for k, query in labeler.queries.items()}
+
+    labeler.get_label_query()
+    labeler.get_input_tables()
+
+    assert {k: query.config for k, query in labeler.queries.items()} == configs
+    assert {k: query.base_query for k, query in labeler.queries.items()} == base_queries
+
+
+def test_readmission_horizons():
+    query = get_labeler(readmission_horizons=[30]).get_label_query(["readmission"])
+    assert "readmission_30_label" in query
+    assert "readmission_7_label" not in query
+
+    query = get_labeler().get_label_query(["readmission"])
+    assert all(f"readmission_{x}_label" in query for x in [7, 30, 90])
+
+
+def test_threshold_sweep_comparison():
+    labeler = get_labeler()
+    query = labeler.get_threshold_sweep_query({"hypoglycemia_lab": [3.9]})
+    assert "value_as_number < threshold" in query
+
+    query = labeler.get_threshold_sweep_query({"hypoglycemia_lab": [3.9]}, inclusive=True)
+    assert "value_as_number <= threshold" in query
+    assert "value_as_number < previous_record" in query
+
+    with pytest.raises(ValueError):
+        labeler.get_threshold_sweep_query({"aki_lab": [1.5]})
+
+
+def test_multi_cohort_labels_readmission_per_cohort():
+    labeler = get_labeler()
+    queries = labeler.get_multi_cohort_label_queries(
+        ["cohort_a", "cohort_b"], labeler_ids=["age", "readmission"]
+    )
+    union_query, shared_query, context_a, context_b, split_query = queries
+    assert "cohort_a" in union_query and "cohort_b" in union_query
+    assert "readmission" not in shared_query
+    assert "LEAD" in context_a and "cohort_a" in context_a and "cohort_b" not in context_a
+    assert "LEAD" in context_b and "cohort_b" in context_b and "cohort_a" not in context_b
+    assert "cohort_a_labeled" in split_query and "cohort_b_labeled" in split_query
+
+
+@pytest.mark.parametrize("session_temp_tables", [False, True])
+def test_window_variables_declared_once_per_script_or_session(session_temp_tables):
+    labeler = get_labeler(session_temp_tables=session_temp_tables)
+    for queries in [
+        labeler.get_multi_cohort_label_queries(
+            ["cohort_a", "cohort_b"], labeler_ids=["aki_lab", "readmission"]
+        ),
+        labeler.get_incremental_label_queries(["aki_lab"]),
+    ]:
+        label_queries = [query for query in queries if "SET label_window_start" in query]
+        assert len(label_queries) == len(queries) - 2
+        if session_temp_tables:
+            # executed in one session, so that the first script declares the variables
+            assert "".join(queries).count("DECLARE label_window_start") == 1
+            assert queries[0].lstrip().startswith("DECLARE label_window_start")
+        else:
+            for query in label_queries:
+                assert query.count("DECLARE label_window_start") == 1
+                assert query.lstrip().startswith("DECLARE label_window_start")
+        for query in label_queries:
+            assert query.index("SET label_window_start") < query.index("CREATE")
+
+
+def test_incremental_relabels_changed_persons():
+    duckdb = pytest.importorskip("duckdb")
+    labeler = get_labeler(
+        session_temp_tables=True, partition_by="", cluster_by=[], prune_measurements=False,
+    )
+    pending_query = labeler.get_incremental_label_queries(["los_7"])[0]
+    pending_query = pending_query.replace(
+        "som-nero-nigam-starr.temp_dataset.temp_cohort_labeled", "target"
+    ).replace("som-nero-nigam-starr.temp_dataset.temp_cohort", "cohort")
+
+    con = duckdb.connect()
+    # person 1 has a new row and a row of person 3 left the cohort
+    con.execute("""
+        CREATE TABLE cohort AS SELECT * FROM (VALUES (1, 1), (2, 1), (3, 2), (4, 3)) 
+        v(prediction_id, person_id)
+    """)
+    con.execute("""
+        CREATE TABLE target AS SELECT * FROM (VALUES (1, 1), (3, 2), (4, 3), (5, 3)) 
+        v(prediction_id, person_id)
+    """)
+    con.execute(pending_query)
+
+    pending_table = pending_query.split("CREATE TEMP TABLE")[1].split()[0]
+    assert con.execute("SELECT prediction_id FROM target").fetchall() == [(3,)]
+    assert sorted(con.execute(f"SELECT prediction_id FROM {pending_table}").fetchall()) == [
+        (1,), (2,), (4,)
+    ]
+
+
+def test_table_options_follow_cohort_fields():
+    labeler = get_labeler(window_start_field="index_datetime", row_id="row_id")
+    assert labeler.get_table_options_str() == (
+        "PARTITION BY DATETIME_TRUNC(index_datetime, MONTH)\nCLUSTER BY row_id"
+    )
+    assert get_labeler(partition_by="", cluster_by=[]).get_table_options_str() == ""
+
+
+def test_pivot_restores_types_and_order():
+    label_types = {
+        "age_days": "INT64",
+        "pediatric_age_group": "STRING",
+        "age_group": "STRING",
+        "flag": "BOOL",
+        "event_date": "DATE",
+    }
+    query = get_labeler().get_pivot_query(["age"], label_types=label_types)
+    positions = [query.index(f"AS {x}\n") for x in label_types]
+    assert positions == sorted(positions)
+    assert "AS INT64) AS age_days" in query
+    assert "AS INT64) AS BOOL) AS flag" in query
+    assert "event_datetime, NULL)) AS DATE) AS event_date" in query
+
+
+def test_share_ctes_hoists_person_dimension():
+    labeler = get_labeler(share_ctes=True)
+    query = labeler.get_label_query(["age", "sex", "aki_lab"])
+    stages = [x for x in query.split(";") if "temp_stage_" in x and "AS SELECT" in x]
+    assert len(stages) == 1
+    assert ".person`" in stages[0]
+    assert query.count("SELECT * FROM som-nero-nigam-starr.temp.temp_stage_") == 3
+
+    # the fused demographics query reads the stage once
+    labeler = get_labeler(share_ctes=True, fuse_demographics_labelers=True)
+    query = labeler.get_label_query(["age", "sex", "aki_lab"])
+    assert query.count("SELECT * FROM som-nero-nigam-starr.temp.temp_stage_") == 2
+
+
+def test_flowsheets_extract_name_reaches_queries():
+    labeler = get_labeler(extract_labs_from_flowsheets=True, flowsheets_extract_name="flowsheets")
+    query = labeler.get_label_query(["hypoglycemia_lab"])
+    assert "temp_dataset.flowsheets` f" in query
+
+
+def test_preview_does_not_write_flowsheets_extract():
+    client = RecordingClient()
+    labeler = Labeler(
+        client=client, 
+        extract_labs_from_flowsheets=True, 
+        flowsheets_extract_name="flowsheets",
+        overwrite_flowsheets_extract=True,
+    )
+    labeler.preview(["hypoglycemia_lab"])
+    # the extract is read but not created from the observation table
+    assert "temp_dataset.flowsheets` f" in client.queries[0]
+    assert ".observation`" not in client.queries[0]
+
+
+def get_duckdb_labeler(tables, **kwargs):
+    duckdb = pytest.importorskip("duckdb")
+    con = get_connection(duckdb, tables)
+    labeler = Labeler(
+        client=DuckDBClient(con), dataset_project="p", dataset="d",
+        rs_dataset_project="p", rs_dataset="d", **kwargs
+    )
+    return labeler, con
+
+
+def test_compare_label_tables():
+    reference = pd.DataFrame({
+        "prediction_id": [1, 2, 3],
+        "age_days": [10, 20, 30],
+        "sex": ["F", "M", None],
+        "removed": [0, 0, 0],
+    })
+    target = reference.drop(columns="removed").assign(added=1)
+    target.loc[1, "age_days"] = 21
+    labeler, _ = get_duckdb_labeler(
+        {"reference": reference, "labeled": target}, target_table_name="labeled"
+    )
+
+    assert labeler.compare_label_tables("reference") == {
+        "missing_columns": ["removed"],
+        "added_columns": ["added"],
+        "rows_not_in_reference": 1,
+        "reference_rows_not_in_target": 1,
+    }
+    assert labeler.compare_label_tables("labeled")["rows_not_in_reference"] == 0
+
+
+def test_summarize():
+    n = 201
+    labeled = pd.DataFrame({
+        "prediction_id": range(n),
+        "person_id": range(n),
+        "sex": ["F", "M", "M"] * (n // 3),
+        "aki_lab_aki1_label": [1, 0, 0, 0] * (n // 4) + [1],
+        "hypoglycemia_lab_min_glucose": [float(x) if x % 10 else None for x in range(n)],
+    })
+    labeler, _ = get_duckdb_labeler({"labeled": labeled}, target_table_name="labeled")
+
+    summary = labeler.summarize().set_index("column")
+    assert list(summary.index) == ["aki_lab_aki1_label", "hypoglycemia_lab_min_glucose"]
+    label = summary.loc["aki_lab_aki1_label"]
+    assert label["type"] == "label" and label["row_count"] == n
+    assert label["positive"] == 51 and label["prevalence"] == pytest.approx(51 / n)
+    numeric = summary.loc["hypoglycemia_lab_min_glucose"]
+    assert numeric["null_rate"] == pytest.approx(21 / n)
+    values = labeled.hypoglycemia_lab_min_glucose.dropna()
+    assert values.quantile(0.49) <= numeric["median"] <= values.quantile(0.51)
+    assert values.quantile(0.02) <= numeric["quantile_025"] <= values.quantile(0.03)
+    assert values.quantile(0.97) <= numeric["quantile_975"] <= values.quantile(0.98)
+
+    summary = labeler.summarize(strata=["sex"])
+    positives = summary[summary.column == "aki_lab_aki1_label"].set_index("sex").positive
+    expected = labeled.groupby("sex").aki_lab_aki1_label.sum()
+    assert positives.to_dict() == expected.to_dict()
@@ -0,0 +1,161 @@
+"""
+NeutropeniaQuery pivots WBC, bands and neutrophils from a single measurement scan.
+Checks that it labels synthetic data like the original query with one CTE per analyte,
+kept in data/neutropenia_reference.sql
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from duckdb_util import get_connection, translate
+
+duckdb = pytest.importorskip("duckdb")
+
+from datasets.labelers.lab_based import NeutropeniaQuery
+
+REFERENCE_PATH = os.path.join(os.path.dirname(__file__), "data", "neutropenia_reference.sql")
+
+CONFIG = {
+    "dataset_project": "p",
+    "dataset": "d",
+    "cohort_table": "p.d.cohort",
+    "row_id": "prediction_id",
+    "window_start_field": "admit_date",
+    "window_end_field": "discharge_date",
+    "measurement_prune_str": "",
+}
+
+CONCEPT_IDS = [3000905, 4298431, 3010813, 3035839, 3018199, 37045722, 37049637, 99999]
+
+
+def make_data(seed, n_persons=300, duplicates=False):
+    """
+    Cohort of one or two (possibly overlapping) admissions per person and at most one
+    WBC, bands and neutrophils measurement per person and measurement time. With duplicates,
+    about half of the measurements are repeated at the same time with a higher value.
+    """
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2020-01-01")
+    cohort, measurements = [], []
+    for person_id in range(n_persons):
+        first_admit = t = start + pd.Timedelta(days=int(rng.integers(0, 100)))
+        for _ in range(rng.integers(1, 3)):
+            admit = t
+            discharge = admit + pd.Timedelta(hours=int(rng.integers(24, 200)))
+            cohort.append((person_id, admit, discharge, len(cohort)))
+            t = discharge + pd.Timedelta(days=int(rng.integers(-2, 30)))
+
+        # measurement times between the first admission and the end of the last one
+        n_hours = int((discharge - first_admit) / pd.Timedelta(hours=1)) + 1
+        n_times = min(n_hours, int(rng.integers(0, 12)))
+        for hours in rng.choice(n_hours, n_times, replace=False):
+            t = first_admit + pd.Timedelta(hours=int(hours))
+            if rng.random() < 0.5:
+                unit = rng.choice([8848, 8961, 8647])
+                value = rng.uniform(0.5, 12) * (1000 if unit == 8647 else 1)
+                measurements.append((person_id, 3000905, unit, value, None, None, t))
+            if rng.random() < 0.5:
+                if rng.random() < 0.5:
+                    measurements.append((person_id, 3035839, 8554, rng.uniform(0, 30), None, None, t))
+                else:
+                    measurements.append((person_id, 3018199, 8784, rng.uniform(0, 800), None, None, t))
+            if rng.random() < 0.7:
+                concept_id = rng.choice([37045722, 37049637, 99999])
+                unit = rng.choice([8848, 8554, 8784, 8961])
+                if unit == 8554:
+                    value, low, high = rng.uniform(0, 110), 40.0, 75.0
+                elif unit == 8784:
+                    value, low, high = rng.uniform(0, 6000), 1800.0, 7000.0
+                else:
+                    value, low, high = rng.uniform(0, 4), 1.8, 7.0
+                measurements.append((person_id, concept_id, unit, value, low, high, t))
+
+    cohort = pd.DataFrame(
+        cohort, columns=["person_id", "admit_date", "discharge_date", "prediction_id"]
+    )
+    measurements = pd.DataFrame(
+        measurements,
+        columns=[
+            "person_id", "measurement_concept_id", "unit_concept_id", "value_as_number",
+            "range_low", "range_high", "measurement_datetime",
+        ],
+    ).astype({"range_low": float, "range_high": float})
+    if duplicates:
+        repeated = measurements[rng.random(len(measurements)) < 0.5]
+        repeated = repeated.assign(
+            value_as_number=repeated.value_as_number * rng.uniform(1.05, 1.5, len(repeated))
+        )
+        measurements = (
+            pd.concat([measurements, repeated])
+            .sample(frac=1, random_state=seed)
+            .reset_index(drop=True)
+        )
+    concept = pd.DataFrame({
+        "concept_id": CONCEPT_IDS,
+        "concept_name": ["concept"] * len(CONCEPT_IDS),
+        "invalid_reason": [None] * len(CONCEPT_IDS),
+    })
+    concept_ancestor = pd.DataFrame({
+        "ancestor_concept_id": [37045722, 37049637, 37045722],
+        "descendant_concept_id": [37045722, 37049637, 99999],
+    })
+    return {
+        "cohort": cohort,
+        "measurement": measurements,
+        "concept": concept,
+        "concept_ancestor": concept_ancestor,
+    }
+
+
+def run(query, tables):
+    con = get_connection(duckdb, tables)
+    return (
+        con.execute(translate(query))
+        .df()
+        .sort_values("prediction_id")
+        .reset_index(drop=True)
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_neutropenia_matches_reference(seed):
+    query = NeutropeniaQuery()
+    config = {**CONFIG, **query.config}
+    with open(REFERENCE_PATH) as f:
+        reference_query = f.read()
+
+    tables = make_data(seed)
+    expected = run(reference_query.format_map(config), tables)
+    result = run(query.base_query.format_map(config), tables)
+
+    assert expected[query.config["labeler_id"] + "_mild_label"].sum() > 0
+    assert sorted(result.columns) == sorted(expected.columns)
+    pd.testing.assert_frame_equal(
+        result[expected.columns], expected, check_dtype=False, check_exact=False
+    )
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_neutropenia_duplicate_measurements(seed):
+    """
+    Repeated WBC, bands and neutrophils measurements at one time give one row per
+    prediction_id labeled with the lowest value of each analyte
+    """
+    query = NeutropeniaQuery()
+    base_query = query.base_query.format_map({**CONFIG, **query.config})
+
+    tables = make_data(seed, duplicates=True)
+    keys = ["person_id", "measurement_concept_id", "measurement_datetime"]
+    measurements = tables["measurement"]
+    for concept_ids in [[3000905], [3035839, 3018199], [37045722, 37049637, 99999]]:
+        analyte = measurements[measurements.measurement_concept_id.isin(concept_ids)]
+        assert analyte.duplicated(keys).sum() > 20
+
+    result = run(base_query, tables)
+    assert result.prediction_id.tolist() == tables["cohort"].prediction_id.tolist()
+
+    expected = run(base_query, make_data(seed))
+    assert expected[query.config["labeler_id"] + "_mild_label"].sum() > 0
+    pd.testing.assert_frame_equal(result, expected, check_exact=False)
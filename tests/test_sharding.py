@@ -0,0 +1,110 @@
+import re
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from duckdb_util import get_connection, translate
+
+pytest.importorskip("google.cloud.bigquery")
+
+from datasets.cohorts.admissions import AdmissionCohort
+from datasets.labelers import Labeler
+
+
+class JobClient:
+    """
+    Stand-in for bigquery.Client recording when each query is submitted and when it is done
+    """
+    def __init__(self):
+        self.events = []
+        self.lock = threading.Lock()
+
+    def query(self, query, job_config=None, **kwargs):
+        with self.lock:
+            self.events.append(("submit", query))
+        return Job(self, query)
+
+
+class Job:
+    def __init__(self, client, query):
+        self.client = client
+        self.query = query
+
+    def result(self, *args, **kwargs):
+        # slow jobs, such that unordered submissions would interleave
+        time.sleep(0.01)
+        with self.client.lock:
+            self.client.events.append(("done", self.query))
+        return self
+
+
+def check_shard_order(events, num_shards):
+    """
+    The CREATE of shard 0 is done before the INSERT of any other shard is submitted,
+    and each shard is submitted once
+    """
+    submitted = [query for event, query in events if event == "submit"]
+    assert len(submitted) == num_shards
+    assert "CREATE OR REPLACE TABLE" in submitted[0]
+    assert all("INSERT INTO" in query for query in submitted[1:])
+
+    create_done = events.index(("done", submitted[0]))
+    assert all(events.index(("submit", query)) > create_done for query in submitted[1:])
+
+    shard_ids = [
+        int(re.search(rf"\), {num_shards}\) = (\d+)", query).group(1)) for query in submitted
+    ]
+    assert sorted(shard_ids) == list(range(num_shards))
+
+
+CONFIG = {
+    "dataset_project": "p",
+    "dataset": "d",
+    "rs_dataset_project": "p",
+    "rs_dataset": "d",
+    "partition_by": "",
+    "cluster_by": [],
+}
+
+
+def test_sharded_cohort_waits_for_create():
+    client = JobClient()
+    AdmissionCohort(client=client, num_shards=4, shard_workers=3, **CONFIG).create_cohort_table()
+    check_shard_order(client.events, 4)
+
+
+def test_sharded_labeler_waits_for_create():
+    client = JobClient()
+    Labeler(client=client, num_shards=4, shard_workers=3).create_label_table(["age"])
+    check_shard_order(client.events, 4)
+
+
+def test_shards_partition_persons():
+    duckdb = pytest.importorskip("duckdb")
+    persons = range(100)
+    visits = pd.DataFrame({
+        "person_id": [x for x in persons for _ in range(2)],
+        "visit_concept_id": 9201,
+        "visit_start_datetime": pd.Timestamp("2020-01-01"),
+        "visit_end_datetime": [
+            pd.Timestamp("2020-01-02") + pd.Timedelta(days=10 * i) for _ in persons for i in range(2)
+        ],
+    })
+    con = get_connection(
+        duckdb, {"visit_occurrence": visits, "person": pd.DataFrame({"person_id": persons})}
+    )
+
+    client = JobClient()
+    AdmissionCohort(client=client, num_shards=4, **CONFIG).create_cohort_table()
+    for event, query in client.events:
+        if event == "submit":
+            con.execute(translate(query))
+    sharded = con.execute("SELECT * FROM p.d.temp_cohort ORDER BY prediction_id").df()
+
+    con.execute(translate(AdmissionCohort(client=JobClient(), **CONFIG).get_create_query()))
+    expected = con.execute("SELECT * FROM p.d.temp_cohort ORDER BY prediction_id").df()
+
+    assert len(expected) == len(persons)
+    pd.testing.assert_frame_equal(sharded, expected)